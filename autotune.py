@@ -0,0 +1,198 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import time
+from generation import load_backend, measure_once
+from prompt_templates import TEMPLATES, EXAMPLE_SUFFIXES
+
+# Best settings found so far, keyed by host, model file and backend
+TUNING_PATH = os.path.expanduser("~/.mistral_autotune.json")
+
+# A RAG prompt: long enough that prompt batching matters, short enough to calibrate quickly
+CALIBRATION_PROMPT = TEMPLATES["rag_answer"] + EXAMPLE_SUFFIXES["rag_answer"]
+CALIBRATION_TOKENS = 24
+# Reply length the score is estimated for (a short story)
+TYPICAL_REPLY_TOKENS = 200
+# Prompt batch sizes tried, each with every thread count (None = library default)
+BATCH_SIZES = [None, 64, 128, 256, 512]
+# Calibration stops trying new settings after this long and keeps the best so far
+CALIBRATION_BUDGET = 150
+
+
+# Function to count the CPUs this process may really use: physical cores, logical cores,
+# and the affinity mask / cgroup quota a shared host or container imposes
+def cpu_topology():
+    logical = os.cpu_count() or 1
+    try:
+        import psutil
+        physical = psutil.cpu_count(logical=False) or logical
+    except ImportError:
+        physical = logical
+    available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else logical
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r") as file:
+            quota, period = file.read().split()
+        if quota != "max":
+            available = min(available, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return {"physical": physical, "logical": logical, "available": available}
+
+
+# Function to pick thread counts worth trying; more threads than usable cores only oversubscribes
+def thread_candidates(topology):
+    usable_physical = min(topology["physical"], topology["available"])
+    usable_logical = min(topology["logical"], topology["available"])
+    candidates = {max(1, usable_physical // 4), max(1, usable_physical // 2), max(1, usable_physical - 1), usable_physical, usable_logical}
+    return sorted(candidates)
+
+
+# Function to build the key settings are stored under; a replaced model file gets new settings
+def tuning_key(model_path, backend=None):
+    backend = backend or os.environ.get("MISTRAL_BACKEND") or "auto"
+    if model_path and os.path.exists(model_path):
+        stat = os.stat(model_path)
+        model = f"{os.path.abspath(model_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+    else:
+        model = model_path or ""
+    return f"{platform.node()}|{model}|{backend}"
+
+
+# Stores the best settings per host and model file
+class TuningCache:
+    def __init__(self, path=TUNING_PATH):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as file:
+                    self.entries = json.load(file)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        if self.path:
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as file:
+                json.dump(self.entries, file, indent=2)
+            os.replace(temporary_path, self.path)
+
+
+# Function to score one timing run: estimated latency of a typical request, lower is better
+def estimate_reply_seconds(run):
+    decode_rate = run["decode_tokens_per_second"] or 0.0
+    return run["ttft_seconds"] + (TYPICAL_REPLY_TOKENS / decode_rate if decode_rate else run["latency_seconds"])
+
+
+# Function to load the model for calibration and page it in; returns (model, load seconds)
+def load_for_calibration(model_path, context_length, backend, threads, batch_size):
+    start_time = time.perf_counter()
+    model = load_backend(model_path, context_length, backend, threads=threads, batch_size=batch_size)
+    # First run warms caches and pages the model in
+    measure_once(model, CALIBRATION_PROMPT, CALIBRATION_TOKENS)
+    return model, time.perf_counter() - start_time
+
+
+# Function to sweep thread counts at each prompt batch size. The batch size is fixed when the model
+# is loaded, so the model is loaded once per batch size and the thread count is changed in place;
+# a load is skipped when less of the budget remains than the last load took
+def calibrate(model_path, context_length, backend=None, budget=CALIBRATION_BUDGET, log=print):
+    topology = cpu_topology()
+    candidates = thread_candidates(topology)
+    start_time = time.time()
+    trials = []
+    best = None
+    load_seconds = 0.0
+    trial_seconds = 0.0
+
+    def remaining():
+        return budget - (time.time() - start_time)
+
+    def trial(model, threads, batch_size):
+        nonlocal best, trial_seconds
+        run = measure_once(model, CALIBRATION_PROMPT, CALIBRATION_TOKENS)
+        trial_seconds = run["latency_seconds"]
+        estimate = estimate_reply_seconds(run)
+        trials.append({"threads": threads, "batch_size": batch_size, "estimate_seconds": estimate,
+                       "ttft_seconds": run["ttft_seconds"], "decode_tokens_per_second": run["decode_tokens_per_second"]})
+        log(f"Autotune: threads={threads} batch_size={batch_size} -> TTFT {run['ttft_seconds']:.2f}s, "
+            f"{run['decode_tokens_per_second'] or 0:.1f} tok/s, estimated {estimate:.2f}s per reply")
+        if best is None or estimate < best["estimate_seconds"]:
+            best = dict(trials[-1], backend=model.name)
+
+    for batch_size in BATCH_SIZES:
+        if best is not None and remaining() < load_seconds + trial_seconds:
+            log(f"Autotune: skipping batch_size={batch_size} and larger ({remaining():.0f}s of the budget left, a load takes {load_seconds:.0f}s)")
+            break
+        # The best thread count so far goes first, so every batch size is compared at it
+        order = candidates if best is None else [best["threads"]] + [threads for threads in candidates if threads != best["threads"]]
+        model, load_seconds = load_for_calibration(model_path, context_length, backend, order[0], batch_size)
+        try:
+            for i, threads in enumerate(order):
+                if best is not None and remaining() < trial_seconds:
+                    break
+                if i:
+                    try:
+                        model.set_threads(threads)
+                    except RuntimeError:
+                        # Older llama-cpp-python: this thread count needs a load of its own
+                        if remaining() < load_seconds + trial_seconds:
+                            break
+                        model = None
+                        gc.collect()
+                        model, load_seconds = load_for_calibration(model_path, context_length, backend, threads, batch_size)
+                trial(model, threads, batch_size)
+        finally:
+            # Drop this model before the next batch size loads another
+            model = None
+            gc.collect()
+    return {
+        "threads": best["threads"],
+        "batch_size": best["batch_size"],
+        "backend": best["backend"],
+        "estimate_seconds": best["estimate_seconds"],
+        "topology": topology,
+        "trials": trials,
+        "calibration_seconds": time.time() - start_time,
+        "calibrated_at": time.strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+
+# Function to return (threads, batch_size) for this host and model, calibrating only on first launch
+def tuned_settings(model_path, context_length, backend=None, cache=None, recalibrate=False, log=print):
+    cache = cache if cache is not None else TuningCache()
+    key = tuning_key(model_path, backend)
+    entry = None if recalibrate else cache.get(key)
+    if entry is None:
+        log(f"Autotune: calibrating threads and batch size for {model_path} (first launch on this host)")
+        entry = calibrate(model_path, context_length, backend, log=log)
+        cache.put(key, entry)
+        log(f"Autotune: using threads={entry['threads']} batch_size={entry['batch_size']} (saved to {cache.path})")
+    return entry["threads"], entry["batch_size"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find and store the best inference thread count and prompt batch size for this host and model")
+    parser.add_argument("--model", default=None, help="Path to the GGUF model file (defaults to the daemon's model)")
+    parser.add_argument("--backend", choices=["llama_cpp", "ctransformers", "stand_in"], default=None)
+    parser.add_argument("--context-length", type=int, default=2048)
+    parser.add_argument("--recalibrate", action="store_true", help="Run the calibration again even if settings are stored")
+    parser.add_argument("--show", action="store_true", help="Print the stored settings for this host and exit")
+    parser.add_argument("--tuning-file", default=TUNING_PATH)
+    args = parser.parse_args()
+
+    cache = TuningCache(args.tuning_file)
+    if args.show:
+        print(json.dumps({"topology": cpu_topology(), "settings": {k: v for k, v in cache.entries.items() if k.startswith(platform.node() + "|")}}, indent=2))
+    else:
+        if args.model is None and args.backend != "stand_in":
+            from model_registry import find_model_path
+            args.model = find_model_path()
+        threads, batch_size = tuned_settings(args.model, args.context_length, args.backend, cache, args.recalibrate)
+        print(json.dumps({"threads": threads, "batch_size": batch_size}))
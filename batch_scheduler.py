@@ -0,0 +1,336 @@
+import codecs
+import collections
+import queue
+import time
+import numpy as np
+from generation import DEFAULT_PARAMS, split_stop_tail
+
+# Requests decoded together in one step
+MAX_BATCH_SIZE = 16
+# Tokens per llama_decode call (decode tokens plus prompt prefill chunks)
+BATCH_TOKENS = 512
+# Shared KV cache size across all in-flight sequences
+BATCH_CONTEXT_TOKENS = 8192
+# Window used for the repetition penalty
+LAST_N_TOKENS = 64
+
+
+# Function to call a llama.cpp KV-cache function under its current or older name
+def kv_call(llama_cpp, ctx, name, *args):
+    for prefix in ("llama_kv_self_", "llama_kv_cache_"):
+        function = getattr(llama_cpp, prefix + name, None)
+        if function is not None:
+            return function(ctx, *args)
+    raise AttributeError(f"llama_cpp has no KV function for '{name}'")
+
+
+# Function to sample one token from a logits row with per-request parameters
+def sample_token(logits, params, recent, rng):
+    logits = logits.astype(np.float64)
+    penalty = params["repetition_penalty"]
+    if penalty and penalty != 1.0 and recent:
+        ids = np.fromiter(set(recent), dtype=np.int64)
+        values = logits[ids]
+        logits[ids] = np.where(values > 0, values / penalty, values * penalty)
+    if params["temperature"] <= 0:
+        return int(np.argmax(logits))
+    top_k = params["top_k"] if params["top_k"] and params["top_k"] > 0 else len(logits)
+    top_k = min(top_k, len(logits))
+    candidates = np.argpartition(-logits, top_k - 1)[:top_k]
+    candidates = candidates[np.argsort(-logits[candidates])]
+    scaled = logits[candidates] / params["temperature"]
+    probs = np.exp(scaled - scaled.max())
+    probs /= probs.sum()
+    cutoff = int(np.searchsorted(np.cumsum(probs), params["top_p"])) + 1
+    probs = probs[:cutoff] / probs[:cutoff].sum()
+    return int(rng.choice(candidates[:cutoff], p=probs))
+
+
+# A llama.cpp context that decodes tokens from many sequences in one call
+class LlamaBatchDecoder:
+    def __init__(self, backend, n_seq_max, n_ctx=BATCH_CONTEXT_TOKENS, n_batch=BATCH_TOKENS):
+        import llama_cpp
+        self.llama_cpp = llama_cpp
+        self.backend = backend
+        self.n_ctx = max(n_ctx, backend.context_length)
+        self.n_batch = n_batch
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = self.n_ctx
+        params.n_batch = n_batch
+        params.n_seq_max = n_seq_max
+        self.batch = None
+        # Weights are shared with the serial context; only the KV cache is new
+        self.ctx = llama_cpp.llama_new_context_with_model(backend.model_pointer(), params)
+        if not self.ctx:
+            raise RuntimeError("Failed to create llama.cpp batch context")
+        self.n_vocab = backend.llm.n_vocab()
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, n_seq_max)
+
+    # Frees the batch buffer and the context with its KV cache; ctypes pointers are not garbage
+    # collected, so this must run before the model is dropped
+    def close(self):
+        if self.batch is not None:
+            self.llama_cpp.llama_batch_free(self.batch)
+            self.batch = None
+        if self.ctx:
+            self.llama_cpp.llama_free(self.ctx)
+            self.ctx = None
+
+    def clear(self, seq_id):
+        kv_call(self.llama_cpp, self.ctx, "seq_rm", seq_id, -1, -1)
+
+    def copy(self, src_seq_id, dst_seq_id, n_tokens):
+        kv_call(self.llama_cpp, self.ctx, "seq_cp", src_seq_id, dst_seq_id, 0, n_tokens)
+
+    # entries: (seq_id, tokens, start_pos, want_logits); returns {seq_id: logits}
+    def decode(self, entries):
+        batch = self.batch
+        rows = {}
+        n = 0
+        for seq_id, tokens, start_pos, want_logits in entries:
+            for i, token in enumerate(tokens):
+                last = i == len(tokens) - 1
+                batch.token[n] = token
+                batch.pos[n] = start_pos + i
+                batch.n_seq_id[n] = 1
+                batch.seq_id[n][0] = seq_id
+                batch.logits[n] = bool(last and want_logits)
+                if last and want_logits:
+                    rows[seq_id] = n
+                n += 1
+        batch.n_tokens = n
+        result = self.llama_cpp.llama_decode(self.ctx, batch)
+        if result != 0:
+            raise RuntimeError(f"llama_decode failed with code {result}")
+        logits = {}
+        for seq_id, row in rows.items():
+            pointer = self.llama_cpp.llama_get_logits_ith(self.ctx, row)
+            logits[seq_id] = np.ctypeslib.as_array(pointer, shape=(self.n_vocab,)).copy()
+        return logits
+
+
+# One in-flight request inside the shared decode batch
+class Sequence:
+    def __init__(self, job, seq_id, prompt_tokens, start_pos, params, reserved, template, cached):
+        self.job = job
+        self.seq_id = seq_id
+        self.pending = list(prompt_tokens)
+        self.pos = start_pos
+        self.params = params
+        self.reserved = reserved
+        self.template = template
+        self.cached = cached
+        # Never let a sequence run past the KV space reserved for it (at most its own context window)
+        self.max_new_tokens = min(params["max_new_tokens"], reserved - start_pos - len(prompt_tokens))
+        self.generated = 0
+        self.last_token = None
+        self.recent = collections.deque(prompt_tokens[-LAST_N_TOKENS:], maxlen=LAST_N_TOKENS)
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.text = ""
+        self.stop = [params["stop"]] if isinstance(params["stop"], str) else params["stop"]
+        self.rng = np.random.default_rng(params["seed"] if params["seed"] is not None and params["seed"] >= 0 else None)
+        self.started_at = time.time()
+        self.first_token_at = None
+        self.finished = False
+
+    # Adds a sampled token's text; returns False once a stop sequence is hit
+    def emit(self, piece):
+        self.text += piece
+        if self.stop:
+            ready, self.text = split_stop_tail(self.text, self.stop)
+            if ready:
+                self.job.emit(ready)
+            if self.text is None:
+                self.text = ""
+                return False
+        elif self.text:
+            self.job.emit(self.text)
+            self.text = ""
+        return True
+
+
+# Continuous batching: admits queued jobs between decode steps and retires finished ones
+class BatchScheduler:
+    def __init__(self, backend, jobs, on_finish, prefix_cache=None, max_batch=MAX_BATCH_SIZE, decoder=None):
+        self.backend = backend
+        self.jobs = jobs
+        self.on_finish = on_finish
+        self.prefix_cache = prefix_cache
+        self.max_batch = max_batch
+        templates = dict(prefix_cache.templates) if prefix_cache is not None else {}
+        # Template prefixes live in their own sequences and are copied into new requests
+        self.template_seq_ids = {name: max_batch + i for i, name in enumerate(templates)}
+        self.template_tokens = {}
+        self.decoder = decoder or LlamaBatchDecoder(backend, max_batch + len(templates))
+        self.free_seq_ids = list(range(max_batch))
+        self.active = []
+        self.reserved_tokens = 0
+        self.waiting = None
+        self.steps = 0
+        self.batch_size_total = 0
+
+    def kv_budget(self):
+        return self.max_kv_budget() - self.reserved_tokens
+
+    # KV space a single sequence can ever get: the whole cache minus the cached template prefixes
+    def max_kv_budget(self):
+        return self.decoder.n_ctx - sum(self.template_tokens.values())
+
+    # Lets a more urgent job that arrived after the parked one go first; returns True if it did
+    def overtake(self):
+        try:
+            head = self.jobs.get_nowait()
+        except queue.Empty:
+            return False
+        if head[:2] < self.waiting[:2]:
+            self.jobs.put_nowait(self.waiting)
+            self.waiting = head
+            return True
+        self.jobs.put_nowait(head)
+        return False
+
+    def prepare_prompt(self, job, seq_id):
+        prompt = job.prompt
+        template = self.prefix_cache.match(prompt) if self.prefix_cache is not None else None
+        if template is None:
+            return self.backend.tokenize(prompt), 0, None, False
+        prefix = self.prefix_cache.templates[template]
+        cached = template in self.template_tokens
+        if not cached:
+            prefix_tokens = self.backend.tokenize(prefix)
+            self.decoder.decode([(self.template_seq_ids[template], prefix_tokens, 0, False)])
+            self.template_tokens[template] = len(prefix_tokens)
+        n_prefix = self.template_tokens[template]
+        self.decoder.copy(self.template_seq_ids[template], seq_id, n_prefix)
+        return self.backend.tokenize(prompt[len(prefix):], add_bos=False), n_prefix, template, cached
+
+    def admit(self, block):
+        while len(self.active) < self.max_batch:
+            if self.waiting is None:
+                try:
+                    self.waiting = self.jobs.get(timeout=0.5) if block and not self.active else self.jobs.get_nowait()
+                except queue.Empty:
+                    return
+            job = self.waiting[2]
+            if job.cancelled.is_set():
+                self.waiting = None
+                self.on_finish(job, 0, time.time(), cancelled=True)
+                continue
+            params = {**DEFAULT_PARAMS, **{k: v for k, v in job.params.items() if v is not None or k == "stop"}}
+            prompt_estimate = len(self.backend.tokenize(job.prompt))
+            if prompt_estimate >= self.max_kv_budget():
+                # Could never be admitted, even with the batch empty
+                self.waiting = None
+                job.output.put(("error", f"Prompt is {prompt_estimate} tokens; the batch context has room for {self.max_kv_budget()} tokens"))
+                self.on_finish(job, 0, time.time(), failed=True)
+                continue
+            # Capped at what an empty batch can hold, so a parked job always fits once the others retire
+            reserved = min(prompt_estimate + params["max_new_tokens"], self.backend.context_length, self.max_kv_budget())
+            if reserved > self.kv_budget():
+                if self.overtake():
+                    continue
+                # Wait for running sequences to retire and free KV space
+                return
+            self.waiting = None
+            seq_id = self.free_seq_ids.pop()
+            tokens, start_pos, template, cached = self.prepare_prompt(job, seq_id)
+            sequence = Sequence(job, seq_id, tokens, start_pos, params, reserved, template, cached)
+            self.active.append(sequence)
+            self.reserved_tokens += reserved
+            if sequence.max_new_tokens <= 0:
+                self.retire(sequence)
+                self.active.remove(sequence)
+
+    def retire(self, sequence, cancelled=False):
+        sequence.finished = True
+        if sequence.text:
+            sequence.job.emit(sequence.text)
+        self.decoder.clear(sequence.seq_id)
+        self.free_seq_ids.append(sequence.seq_id)
+        self.reserved_tokens -= sequence.reserved
+        ttft = sequence.first_token_at - sequence.started_at if sequence.first_token_at else None
+        self.on_finish(sequence.job, sequence.generated, sequence.started_at, cancelled=cancelled, ttft=ttft)
+
+    def step(self):
+        entries = []
+        budget = self.decoder.n_batch
+        for sequence in self.active:
+            if not sequence.pending:
+                entries.append((sequence.seq_id, [sequence.last_token], sequence.pos, True))
+                budget -= 1
+        for sequence in self.active:
+            if sequence.pending and budget > 0:
+                chunk = sequence.pending[:budget]
+                entries.append((sequence.seq_id, chunk, sequence.pos, len(chunk) == len(sequence.pending)))
+                budget -= len(chunk)
+        if not entries:
+            return
+        logits = self.decoder.decode(entries)
+        self.steps += 1
+        self.batch_size_total += len(entries)
+        by_id = {sequence.seq_id: sequence for sequence in self.active}
+        for seq_id, tokens, _, _ in entries:
+            sequence = by_id[seq_id]
+            sequence.pos += len(tokens)
+            if sequence.pending:
+                sequence.pending = sequence.pending[len(tokens):]
+            if seq_id not in logits:
+                continue
+            token = sample_token(logits[seq_id], sequence.params, sequence.recent, sequence.rng)
+            if sequence.first_token_at is None:
+                sequence.first_token_at = time.time()
+                if self.prefix_cache is not None:
+                    self.prefix_cache.record_ttft(sequence.template, sequence.cached, sequence.first_token_at - sequence.started_at)
+            if self.backend.is_eos(token):
+                self.retire(sequence)
+                continue
+            sequence.generated += 1
+            sequence.last_token = token
+            sequence.recent.append(token)
+            keep_going = sequence.emit(sequence.decoder.decode(self.backend.detokenize([token])))
+            if not keep_going or sequence.generated >= sequence.max_new_tokens:
+                self.retire(sequence)
+        self.active = [sequence for sequence in self.active if not sequence.finished]
+
+    def run(self, stop_event=None):
+        while stop_event is None or not stop_event.is_set():
+            self.admit(block=True)
+            for sequence in self.active:
+                if sequence.job.cancelled.is_set():
+                    self.retire(sequence, cancelled=True)
+            self.active = [sequence for sequence in self.active if not sequence.finished]
+            if self.active:
+                try:
+                    self.step()
+                except Exception as e:
+                    # A failed decode poisons the whole batch; fail its requests and start clean
+                    for sequence in self.active:
+                        sequence.job.output.put(("error", f"Model inference failed: {str(e)}"))
+                        self.decoder.clear(sequence.seq_id)
+                        self.free_seq_ids.append(sequence.seq_id)
+                        self.on_finish(sequence.job, sequence.generated, sequence.started_at, failed=True)
+                    self.active = []
+                    self.reserved_tokens = 0
+
+    def close(self):
+        self.decoder.close()
+
+    def stats(self):
+        return {
+            "active_sequences": len(self.active),
+            "decode_steps": self.steps,
+            "avg_batch_size": self.batch_size_total / self.steps if self.steps else 0.0,
+            "kv_tokens_reserved": self.reserved_tokens,
+            "kv_tokens_total": self.decoder.n_ctx
+        }
+
+
+# Function to check whether a backend can run the batched scheduler
+def supports_batching(backend):
+    if backend.name != "llama_cpp":
+        return False
+    try:
+        import llama_cpp
+    except ImportError:
+        return False
+    return hasattr(llama_cpp, "llama_batch_init") and hasattr(llama_cpp, "llama_decode")
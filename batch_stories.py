@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from inference_client import InferenceClient, InferenceCancelled, InferenceError, PRIORITY_LOW
+from story_generation import build_story_prompt, write_story, count_words, DEFAULT_WORD_LIMIT, MIN_WORD_LIMIT, MAX_WORD_LIMIT
+from token_budget import TokenBudget, PromptTooLong
+from utils import percentile
+
+# Concurrent requests; the daemon batches them when continuous batching is available
+DEFAULT_WORKERS = 4
+
+
+# Function to read {"prompt": ..., "word_limit": ...} items; "id" defaults to the line number
+def load_items(path):
+    items = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            item.setdefault("id", str(line_number))
+            item["id"] = str(item["id"])
+            item["word_limit"] = int(item.get("word_limit", DEFAULT_WORD_LIMIT))
+            if not MIN_WORD_LIMIT <= item["word_limit"] <= MAX_WORD_LIMIT:
+                raise ValueError(f"{path}:{line_number}: word_limit must be between {MIN_WORD_LIMIT} and {MAX_WORD_LIMIT}")
+            items.append(item)
+    return items
+
+
+# Function to read the ids already written to the output file (the checkpoint)
+def load_done(path):
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # Torn last line from an interrupted run; the item is simply redone
+                continue
+            done[result["id"]] = result
+    return done
+
+
+# Appends finished items to the output JSONL, one durable line per item
+class Checkpoint:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+        # Start on a fresh line if the previous run was cut off mid-write
+        if self.file.tell() > 0:
+            with open(path, "rb") as existing:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    self.file.write("\n")
+
+    def write(self, result):
+        with self.lock:
+            self.file.write(json.dumps(result, ensure_ascii=False) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+# Function to generate one story with the same prompt building and post-processing as the chat UI
+def run_item(model, budget, item, cancel_event=None):
+    start_time = time.time()
+    full_prompt, is_sonnet, max_new_tokens = build_story_prompt(item["prompt"], item["word_limit"])
+    result = {"id": item["id"], "prompt": item["prompt"], "word_limit": item["word_limit"], "full_prompt": full_prompt, "sonnet": is_sonnet}
+    try:
+        max_new_tokens = budget.fit_max_new_tokens(full_prompt, max_new_tokens)
+        story, stats = write_story(model, full_prompt, item["word_limit"], is_sonnet, max_new_tokens, cancel_event=cancel_event)
+    except InferenceCancelled:
+        return None
+    except (PromptTooLong, InferenceError, OSError) as e:
+        # A failed item (daemon error, dropped connection, socket timeout) is recorded, not fatal to the run
+        result.update({"error": str(e), "tokens": 0, "latency": time.time() - start_time})
+        return result
+    result.update({
+        "story": story,
+        "words": count_words(story),
+        "tokens": stats["tokens"],
+        "latency": time.time() - start_time
+    })
+    if is_sonnet:
+        result.update({"restarts": stats["restarts"], "complete": stats["complete"]})
+    else:
+        result["stopped_early"] = stats["stopped_early"]
+    return result
+
+
+# Function to summarize throughput and latency for the items finished in this run
+def summarize(results, wall_time):
+    latencies = [result["latency"] for result in results]
+    tokens = sum(result["tokens"] for result in results)
+    return {
+        "stories": len(results),
+        "errors": sum(1 for result in results if "error" in result),
+        "tokens": tokens,
+        "wall_seconds": wall_time,
+        "tokens_per_second": tokens / wall_time if wall_time else 0.0,
+        "stories_per_hour": len(results) * 3600 / wall_time if wall_time else 0.0,
+        "latency_p50_seconds": percentile(latencies, 50) if latencies else None,
+        "latency_p95_seconds": percentile(latencies, 95) if latencies else None,
+        "latency_max_seconds": max(latencies) if latencies else None
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate stories in bulk from a JSONL file of prompts, resuming where an earlier run stopped")
+    parser.add_argument("input", help='JSONL file with {"prompt": ..., "word_limit": ...} per line (optional "id")')
+    parser.add_argument("output", help="JSONL file results are appended to; items already in it are skipped")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--report", default=None, help="Write the throughput summary as JSON to this file")
+    args = parser.parse_args()
+
+    items = load_items(args.input)
+    done = load_done(args.output)
+    # Items that failed (e.g. the daemon went away) are retried; the later line supersedes the earlier one
+    pending = [item for item in items if item["id"] not in done or "error" in done[item["id"]]]
+    print(f"{len(items)} items, {len(items) - len(pending)} already done, {len(pending)} to generate")
+    if not pending:
+        sys.exit(0)
+
+    model = InferenceClient(priority=PRIORITY_LOW)
+    budget = TokenBudget(model)
+    checkpoint = Checkpoint(args.output)
+    results = []
+    cancel_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    start_time = time.time()
+    try:
+        futures = [executor.submit(run_item, model, budget, item, cancel_event) for item in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            if result is None:
+                continue
+            checkpoint.write(result)
+            results.append(result)
+            elapsed = time.time() - start_time
+            status = result.get("error") or f"{result['words']} words, {result['tokens']} tokens"
+            print(f"[{len(results)}/{len(pending)}] {result['id']}: {status} in {result['latency']:.1f}s"
+                  f" | {sum(r['tokens'] for r in results) / elapsed:.1f} tok/s, {len(results) * 3600 / elapsed:.0f} stories/hour")
+    except KeyboardInterrupt:
+        print("Interrupted; finished items are saved and will be skipped when the run is resumed")
+    finally:
+        # Closing the in-flight streams stops their generation in the daemon right away
+        cancel_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        checkpoint.close()
+    summary = summarize(results, time.time() - start_time)
+    print(json.dumps(summary, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,98 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from batch_scheduler import BatchScheduler, supports_batching
+from generation import load_backend, stream_completion
+from inference_server import Job
+from prompt_templates import TEMPLATES, EXAMPLE_SUFFIXES
+from utils import percentile
+
+# Mix of short FAQ/RAG prompts and a story, as the daemon sees them in practice
+BENCH_PROMPTS = [TEMPLATES[name] + EXAMPLE_SUFFIXES[name] for name in TEMPLATES] + [
+    "Write a 150-word story about a lighthouse keeper who adopts a seagull"
+]
+
+CONCURRENCY_LEVELS = [1, 4, 16]
+
+
+# Function to summarize one benchmark run
+def summarize(latencies, tokens, wall_time):
+    return {
+        "requests": len(latencies),
+        "tokens": tokens,
+        "wall_seconds": wall_time,
+        "tokens_per_second": tokens / wall_time if wall_time else 0.0,
+        "latency_p50_seconds": percentile(latencies, 50),
+        "latency_p95_seconds": percentile(latencies, 95),
+        "latency_max_seconds": max(latencies)
+    }
+
+
+# Function to run requests that all arrive at once through the current serial path.
+# Counts sampled tokens, as the batched path does, rather than yielded text pieces
+def run_serial(backend, prompts, params):
+    start_time = time.time()
+    latencies = []
+    sampled = []
+    for prompt in prompts:
+        for _ in stream_completion(backend, prompt, on_token=sampled.append, **params):
+            pass
+        latencies.append(time.time() - start_time)
+    return summarize(latencies, len(sampled), time.time() - start_time)
+
+
+# Function to run the same requests through the continuous batching scheduler
+def run_batched(backend, prompts, params, max_batch):
+    jobs = queue.PriorityQueue()
+    finished = []
+    all_done = threading.Event()
+
+    def on_finish(job, tokens, start_time, cancelled=False, failed=False, ttft=None):
+        finished.append((tokens, time.time()))
+        if len(finished) == len(prompts):
+            all_done.set()
+
+    scheduler = BatchScheduler(backend, jobs, on_finish, max_batch=max_batch)
+    stop_event = threading.Event()
+    start_time = time.time()
+    for i, prompt in enumerate(prompts):
+        jobs.put((0, i, Job(str(i), "generate", prompt, params, 0)))
+    worker = threading.Thread(target=scheduler.run, args=(stop_event,), daemon=True)
+    worker.start()
+    try:
+        all_done.wait()
+    finally:
+        stop_event.set()
+        worker.join()
+        # Each concurrency level builds its own 8192-token context; free it before the next one
+        scheduler.close()
+    result = summarize([end - start_time for _, end in finished], sum(tokens for tokens, _ in finished), time.time() - start_time)
+    result["avg_batch_size"] = scheduler.stats()["avg_batch_size"]
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare serial generation with continuous batching at several concurrency levels")
+    parser.add_argument("--model", required=True, help="Path to the GGUF model file")
+    parser.add_argument("--context-length", type=int, default=2048)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    backend = load_backend(args.model, args.context_length, "llama_cpp")
+    if not supports_batching(backend):
+        raise SystemExit("Continuous batching needs llama-cpp-python with the batch API")
+    params = {"max_new_tokens": args.max_new_tokens, "temperature": 0.8, "top_p": 0.9, "seed": 42}
+    results = {}
+    for users in CONCURRENCY_LEVELS:
+        prompts = [BENCH_PROMPTS[i % len(BENCH_PROMPTS)] for i in range(users)]
+        serial = run_serial(backend, prompts, params)
+        batched = run_batched(backend, prompts, params, max_batch=users)
+        results[users] = {"serial": serial, "batched": batched}
+        print(f"{users:2d} users | serial {serial['tokens_per_second']:6.1f} tok/s p50 {serial['latency_p50_seconds']:6.2f}s p95 {serial['latency_p95_seconds']:6.2f}s"
+              f" | batched {batched['tokens_per_second']:6.1f} tok/s p50 {batched['latency_p50_seconds']:6.2f}s p95 {batched['latency_p95_seconds']:6.2f}s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,55 @@
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+from chat_store import ChatStore
+from utils import percentile
+
+TOPICS = ["lighthouse", "seagull", "dragon", "ocean", "forest", "robot", "castle", "desert", "comet", "garden",
+          "pirate", "violin", "glacier", "market", "train", "owl", "volcano", "library", "harbor", "meadow"]
+FILLER = ["the", "waves", "quietly", "under", "golden", "light", "a", "keeper", "found", "old", "map", "and",
+          "sang", "to", "stars", "while", "wind", "carried", "memories", "home"]
+
+# What people type in the search box, including half-typed words
+SEARCH_TERMS = ["", "l", "light", "lighthouse", "sea", "dragon castle", "stars wind", "volc", "zebra", "old map"]
+
+
+# Function to build a chat display dump that looks like a saved conversation
+def make_chat(rng):
+    topic = rng.choice(TOPICS)
+    story = " ".join(rng.choice(FILLER + [topic]) for _ in range(rng.randint(60, 160)))
+    return f"[10:15 AM] You: {topic} {rng.choice(TOPICS)}\n\n[10:16 AM] Mistral 7B: {story}\n\n"
+
+
+# Function to fill a store with synthetic chats, one per minute going back in time
+def populate(store, chats, seed=0):
+    rng = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1)
+    for i in range(chats):
+        store.save_chat(make_chat(rng), start + datetime.timedelta(minutes=i))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure chat history search latency with a large synthetic history")
+    parser.add_argument("--chats", type=int, default=100000)
+    parser.add_argument("--repetitions", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ChatStore(os.path.join(tmp, "chats.db"))
+        start_time = time.time()
+        populate(store, args.chats)
+        print(f"Built {store.count()} chats in {time.time() - start_time:.1f}s")
+        worst = 0.0
+        for term in SEARCH_TERMS:
+            samples = []
+            for _ in range(args.repetitions):
+                start_time = time.perf_counter()
+                results = store.search(term)
+                samples.append((time.perf_counter() - start_time) * 1000)
+            worst = max(worst, percentile(samples, 95))
+            print(f"{term!r:16s} {len(results):4d} results  p50 {percentile(samples, 50):6.2f} ms  p95 {percentile(samples, 95):6.2f} ms")
+        print(f"Worst p95 search latency: {worst:.2f} ms")
+        store.close()
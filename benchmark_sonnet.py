@@ -0,0 +1,71 @@
+import argparse
+import json
+import time
+from inference_client import InferenceClient, PRIORITY_LOW
+from story_generation import count_lines, generate_sonnet, SONNET_MIN_LINES, SONNET_MAX_LINES
+
+SONNET_TOPICS = ["the ocean at dawn", "a forgotten lighthouse", "autumn leaves", "a city in the rain", "an old friendship"]
+WORD_LIMIT = 150
+
+
+# Function to build the prompt mistral_chat_ui sends for a sonnet
+def sonnet_prompt(topic, word_limit=WORD_LIMIT):
+    return f"Write a 14-line sonnet with an ABAB CDCD EFEF GG rhyme scheme, approximately {word_limit} words, describing {topic}"
+
+
+# Function to run the previous approach: generate everything, count lines, regenerate up to three times
+def generate_sonnet_with_retries(model, full_prompt, max_new_tokens, **params):
+    start_time = time.time()
+    stats = {"tokens": 0, "restarts": 0}
+    for attempt in range(3):
+        pieces = list(model(full_prompt, stream=True, max_new_tokens=max_new_tokens, **params))
+        stats["tokens"] += len(pieces)
+        response = "".join(pieces)
+        if SONNET_MIN_LINES <= count_lines(response) <= SONNET_MAX_LINES:
+            stats["wall_time"] = time.time() - start_time
+            return response, stats
+        stats["restarts"] += 1
+    stats["wall_time"] = time.time() - start_time
+    return None, stats
+
+
+# Function to summarize runs of one method
+def summarize(runs):
+    accepted = [stats for text, stats in runs if text is not None]
+    total_tokens = sum(stats["tokens"] for _, stats in runs)
+    total_time = sum(stats["wall_time"] for _, stats in runs)
+    return {
+        "runs": len(runs),
+        "accepted": len(accepted),
+        "tokens_per_accepted_sonnet": total_tokens / len(accepted) if accepted else None,
+        "seconds_per_accepted_sonnet": total_time / len(accepted) if accepted else None,
+        "avg_restarts": sum(stats["restarts"] for _, stats in runs) / len(runs)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare streaming, structure-aware sonnet generation with the old regenerate loop")
+    parser.add_argument("--runs", type=int, default=2, help="Runs per topic and method")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    model = InferenceClient(priority=PRIORITY_LOW)
+    max_new_tokens = int(WORD_LIMIT * 1.2) + 30
+    params = {"temperature": 0.8, "top_p": 0.9, "stop": None}
+    runs = {"retry_loop": [], "streaming": []}
+    for topic in SONNET_TOPICS:
+        prompt = sonnet_prompt(topic)
+        for _ in range(args.runs):
+            runs["retry_loop"].append(generate_sonnet_with_retries(model, prompt, max_new_tokens, **params))
+            runs["streaming"].append(generate_sonnet(model, prompt, max_new_tokens, **params))
+    results = {method: summarize(method_runs) for method, method_runs in runs.items()}
+    for method, summary in results.items():
+        tokens = summary["tokens_per_accepted_sonnet"]
+        seconds = summary["seconds_per_accepted_sonnet"]
+        print(f"{method:10s} accepted {summary['accepted']}/{summary['runs']}"
+              f"  tokens/sonnet {tokens if tokens is None else round(tokens, 1)}"
+              f"  seconds/sonnet {seconds if seconds is None else round(seconds, 2)}"
+              f"  avg restarts {summary['avg_restarts']:.2f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,194 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from generation import load_backend, measure_once, PrefixCache, BENCH_PARAMS
+from prompt_templates import TEMPLATES, EXAMPLE_SUFFIXES
+
+# Fixed prompts, one per entry point, with the reply lengths those entry points ask for
+WORKLOADS = {
+    "story": {
+        "prompt": "Write a joyful and uplifting 150-word story about a lighthouse keeper who adopts a seagull",
+        "max_new_tokens": 250
+    },
+    "sonnet": {
+        "prompt": "Write a 14-line sonnet with an ABAB CDCD EFEF GG rhyme scheme, approximately 150 words, describing the sea at night",
+        "max_new_tokens": 210
+    },
+    "faq_rephrase": {
+        "prompt": TEMPLATES["faq_rephrase"] + EXAMPLE_SUFFIXES["faq_rephrase"],
+        "max_new_tokens": 50
+    },
+    "rag_answer": {
+        "prompt": TEMPLATES["rag_answer"] + EXAMPLE_SUFFIXES["rag_answer"],
+        "max_new_tokens": 500
+    }
+}
+
+REPORT_DIR = "benchmark_reports"
+
+
+# Function to summarize repeated measurements
+def describe(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "mean": sum(ordered) / len(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "min": ordered[0],
+        "max": ordered[-1]
+    }
+
+
+# Function to get this process's peak resident memory in MB
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# Function to benchmark every workload with one model configuration (runs in its own process)
+def run_configuration(model_path, backend_name, context_length, threads, batch_size, warmup, repetitions, workloads, max_new_tokens=None):
+    load_start = time.perf_counter()
+    backend = load_backend(model_path, context_length, backend_name, threads=threads, batch_size=batch_size)
+    result = {
+        "threads": threads,
+        "batch_size": batch_size,
+        "backend": backend.name,
+        "load_seconds": time.perf_counter() - load_start,
+        "workloads": {}
+    }
+    # Same prefix caching as the daemon, so template prompts are measured the way they are served
+    prefix_cache = PrefixCache(TEMPLATES)
+    for name in workloads:
+        workload = WORKLOADS[name]
+        limit = max_new_tokens or workload["max_new_tokens"]
+        for _ in range(warmup):
+            measure_once(backend, workload["prompt"], limit, prefix_cache)
+        runs = [measure_once(backend, workload["prompt"], limit, prefix_cache) for _ in range(repetitions)]
+        result["workloads"][name] = {
+            metric: describe([run[metric] for run in runs if run[metric] is not None])
+            for metric in ("ttft_seconds", "decode_tokens_per_second", "latency_seconds", "tokens")
+        }
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+# Function to describe the machine a report was made on
+def host_info():
+    info = {"hostname": platform.node(), "platform": platform.platform(), "python": platform.python_version(), "logical_cpus": os.cpu_count()}
+    try:
+        import psutil
+        info["physical_cpus"] = psutil.cpu_count(logical=False)
+        info["memory_gb"] = psutil.virtual_memory().total / 1024 ** 3
+    except ImportError:
+        pass
+    return info
+
+
+# Function to run each configuration in a fresh process so load settings and peak RSS do not leak between them
+def run_suite(args):
+    configurations = [(threads, batch_size) for threads in args.threads for batch_size in args.batch_sizes]
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": host_info(),
+        "model": args.model,
+        "backend": args.backend,
+        "context_length": args.context_length,
+        "warmup": args.warmup,
+        "repetitions": args.repetitions,
+        "params": BENCH_PARAMS,
+        "configurations": []
+    }
+    for threads, batch_size in configurations:
+        command = [sys.executable, os.path.abspath(__file__), "--worker",
+                   "--model", args.model or "", "--context-length", str(args.context_length),
+                   "--warmup", str(args.warmup), "--repetitions", str(args.repetitions),
+                   "--workloads", *args.workloads]
+        if args.backend:
+            command += ["--backend", args.backend]
+        if threads is not None:
+            command += ["--threads", str(threads)]
+        if batch_size is not None:
+            command += ["--batch-sizes", str(batch_size)]
+        if args.max_new_tokens:
+            command += ["--max-new-tokens", str(args.max_new_tokens)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        report["configurations"].append(result)
+        print_configuration(result)
+    return report
+
+
+def print_configuration(result):
+    print(f"threads={result['threads']} batch_size={result['batch_size']} load {result['load_seconds']:.1f}s peak RSS {result['peak_rss_mb']:.0f} MB")
+    for name, metrics in result["workloads"].items():
+        decode = metrics["decode_tokens_per_second"]
+        print(f"  {name:13s} TTFT {metrics['ttft_seconds']['p50']:7.3f}s  decode {decode['p50'] if decode else 0:7.1f} tok/s"
+              f"  latency {metrics['latency_seconds']['p50']:7.2f}s  tokens {metrics['tokens']['p50']:.0f}")
+
+
+# Function to compare two reports configuration by configuration (positive speed change = faster)
+def compare_reports(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_configs = {(c["threads"], c["batch_size"]): c for c in old["configurations"]}
+    for config in new["configurations"]:
+        key = (config["threads"], config["batch_size"])
+        if key not in old_configs:
+            continue
+        print(f"threads={key[0]} batch_size={key[1]}  peak RSS {old_configs[key]['peak_rss_mb']:.0f} -> {config['peak_rss_mb']:.0f} MB")
+        for name, metrics in config["workloads"].items():
+            before = old_configs[key]["workloads"].get(name)
+            if before is None:
+                continue
+            changes = []
+            for metric, higher_is_better in (("ttft_seconds", False), ("decode_tokens_per_second", True), ("latency_seconds", False)):
+                if before[metric] and metrics[metric] and before[metric]["p50"]:
+                    change = (metrics[metric]["p50"] - before[metric]["p50"]) / before[metric]["p50"] * 100
+                    changes.append(f"{metric} {change if higher_is_better else -change:+6.1f}%")
+            print(f"  {name:13s} " + "  ".join(changes))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark TTFT, decode tokens/sec, latency and peak RSS per entry-point prompt across thread counts and batch sizes")
+    parser.add_argument("--model", default=None, help="Path to the GGUF model file (not needed with --backend stand_in)")
+    parser.add_argument("--backend", choices=["llama_cpp", "ctransformers", "stand_in"], default=None)
+    parser.add_argument("--context-length", type=int, default=2048)
+    parser.add_argument("--threads", type=int, nargs="+", default=[None], help="Thread counts to sweep (default: library default)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[None], help="Prompt batch sizes to sweep (default: library default)")
+    parser.add_argument("--workloads", nargs="+", choices=list(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repetitions", type=int, default=3)
+    parser.add_argument("--max-new-tokens", type=int, default=None, help="Cap every workload's reply length (for quick runs)")
+    parser.add_argument("--output", default=None, help=f"JSON report path (default: {REPORT_DIR}/benchmark_<time>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two JSON reports instead of running")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_reports(*args.compare)
+        sys.exit(0)
+    if args.worker:
+        result = run_configuration(args.model, args.backend, args.context_length, args.threads[0], args.batch_sizes[0],
+                                   args.warmup, args.repetitions, args.workloads, args.max_new_tokens)
+        print(json.dumps(result))
+        sys.exit(0)
+    if args.model is None and args.backend != "stand_in":
+        parser.error("--model is required unless --backend stand_in is used")
+
+    report = run_suite(args)
+    output = args.output or os.path.join(REPORT_DIR, f"benchmark_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {output}")
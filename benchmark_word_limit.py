@@ -0,0 +1,55 @@
+import argparse
+import json
+import time
+from inference_client import InferenceClient, PRIORITY_LOW
+from story_generation import WordLimitTracker, truncate_to_word_count
+
+WORD_LIMIT_PRESETS = [100, 150, 200, 300]
+STORY_TOPICS = ["a lighthouse keeper who adopts a seagull", "a robot learning to paint", "a lost key in an old library"]
+
+
+# Function to generate a full story the old way and find where the streaming stop would have cut it
+def measure_story(model, topic, word_limit):
+    full_prompt = f"Write a {word_limit}-word story about {topic}"
+    max_new_tokens = int(word_limit * 1.33) + 50
+    start_time = time.time()
+    pieces = []
+    times = []
+    for piece in model(full_prompt, stream=True, max_new_tokens=max_new_tokens, temperature=0.8, top_p=0.9, stop=None):
+        pieces.append(piece)
+        times.append(time.time() - start_time)
+    tracker = WordLimitTracker(word_limit)
+    stop_index = len(pieces)
+    for i, piece in enumerate(pieces):
+        if tracker.feed(piece):
+            stop_index = i + 1
+            break
+    full_text = "".join(pieces)
+    # The early stop must not change what the user sees
+    assert truncate_to_word_count(tracker.text(), word_limit) == truncate_to_word_count(full_text, word_limit)
+    return {
+        "tokens_generated": len(pieces),
+        "tokens_needed": stop_index,
+        "tokens_saved": len(pieces) - stop_index,
+        "seconds_full": times[-1] if times else 0.0,
+        "seconds_streaming": times[stop_index - 1] if stop_index else 0.0
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure tokens saved per story by stopping at the word limit")
+    parser.add_argument("--runs", type=int, default=1, help="Runs per topic and preset")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    model = InferenceClient(priority=PRIORITY_LOW)
+    results = {}
+    for word_limit in WORD_LIMIT_PRESETS:
+        samples = [measure_story(model, topic, word_limit) for topic in STORY_TOPICS for _ in range(args.runs)]
+        summary = {key: sum(sample[key] for sample in samples) / len(samples) for key in samples[0]}
+        results[word_limit] = summary
+        print(f"{word_limit:3d} words | generated {summary['tokens_generated']:6.1f} | needed {summary['tokens_needed']:6.1f}"
+              f" | saved {summary['tokens_saved']:6.1f} tokens/story | {summary['seconds_full']:6.2f}s -> {summary['seconds_streaming']:6.2f}s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
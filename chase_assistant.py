@@ -8,13 +8,28 @@ import logging
 import time
 import random
 import psutil
+from metrics import REGISTRY, STAGE_SECONDS, timed, start_from_env
+from profiling import profiled, traced, span, annotate
+from log_pipeline import setup_logging, get_logger
+from faq_matcher import load_semantic_index, record_stage
 
-logging.basicConfig(filename='chase_assistant.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# Rotating log written by a background thread; per-comparison traces are sampled and rate limited
+setup_logging('chase_assistant.log')
+COMPARE_LOG = get_logger("faq.compare")
+MATCH_LOG = get_logger("faq.match")
+DUMP_LOG = get_logger("faq.dump")
 
 faq_pairs = []
+# Embedded FAQ questions for paraphrases word overlap misses (None: word overlap only)
+semantic_index = None
 model_queue = queue.Queue()
 response_queue = queue.Queue()
 
+FAQ_RESULTS = REGISTRY.counter("faq_queries_total", "FAQ questions by how they were handled", ("result",))
+UI_RESPONSE_SECONDS = STAGE_SECONDS.labels("ui_response")
+# Word overlap at or above this answers without the semantic stage
+CONFIDENCE_THRESHOLD = 0.5
+
 def check_system_resources():
     cpu_percent = psutil.cpu_percent(interval=1)
     if cpu_percent > 80:
@@ -22,21 +37,23 @@ def check_system_resources():
     return ""
 
 def initialize_models():
-    global faq_pairs
+    global faq_pairs, semantic_index
     try:
         faq_path = "./Chase_FAQ/Chase Banking FAQ.txt"
         if os.path.exists(faq_path):
             with open(faq_path, "r", encoding="utf-8") as f:
                 faq_text = f.read()
             faq_pairs.extend(parse_faq(faq_text))
-            logging.info(f"Loaded and parsed FAQ: {len(faq_pairs)} question-answer pairs")
-            logging.debug(f"FAQ pairs: {faq_pairs}")
+            logging.info("Loaded and parsed FAQ: %d question-answer pairs", len(faq_pairs))
+            DUMP_LOG.debug("FAQ pairs: %s", faq_pairs)
         else:
             raise FileNotFoundError(f"FAQ file not found at {faq_path}")
 
         model_queue.put(("success", None))
+        # Loading the embedding model must not hold up the chat; until it is ready, word overlap decides alone
+        semantic_index = load_semantic_index(faq_pairs, clean_faq_question)
     except Exception as e:
-        logging.error(f"Error loading models: {str(e)}")
+        logging.error("Error loading models: %s", e)
         model_queue.put(("error", str(e)))
 
 def parse_faq(text):
@@ -58,22 +75,49 @@ def normalize_text(text):
     text = re.sub(r'\s+', ' ', text)  # Normalize spaces
     return text
 
+# FAQ question without its number, normalized for matching
+def clean_faq_question(faq_question):
+    return normalize_text(faq_question.split('. ', 1)[-1])
+
+@timed(STAGE_SECONDS.labels("query_faq"))
+@traced("query_faq")
 def query_faq(question):
-    question = normalize_text(question)
+    with span("normalize_question"):
+        question = normalize_text(question)
     best_match = None
     best_score = 0
-    for faq_question, faq_answer in faq_pairs:
-        faq_question_clean = normalize_text(faq_question.split('. ', 1)[-1])
-        question_words = set(question.split())
-        faq_words = set(faq_question_clean.split())
-        common_words = len(question_words & faq_words)
-        score = common_words / max(len(question_words), len(faq_words))
-        logging.debug(f"Comparing '{question}' with '{faq_question_clean}': Score = {score}")
-        if score > best_score:
-            best_score = score
-            best_match = faq_answer
+    with span("score_faqs", faqs=len(faq_pairs)):
+        for faq_question, faq_answer in faq_pairs:
+            faq_question_clean = clean_faq_question(faq_question)
+            question_words = set(question.split())
+            faq_words = set(faq_question_clean.split())
+            common_words = len(question_words & faq_words)
+            score = common_words / max(len(question_words), len(faq_words))
+            COMPARE_LOG.debug("Comparing '%s' with '%s': Score = %s", question, faq_question_clean, score)
+            if score > best_score:
+                best_score = score
+                best_match = faq_answer
     return best_match, best_score
 
+# Function to answer from the FAQ: clear word-overlap hits right away, ambiguous questions re-scored
+# by embedding similarity against the FAQ questions. Returns (answer or None, score, stage)
+@timed(STAGE_SECONDS.labels("match_faq"))
+@traced("match_faq")
+def match_faq(question):
+    answer, score = query_faq(question)
+    if score >= CONFIDENCE_THRESHOLD and answer:
+        record_stage("lexical")
+        return answer, score, "lexical"
+    if semantic_index is not None:
+        with span("semantic_faq"):
+            best, similarity, gap = semantic_index.match(question)
+        MATCH_LOG.debug("Semantic FAQ match for '%s': %s, similarity %s, gap %s", question, best, similarity, gap)
+        if best is not None:
+            record_stage("semantic")
+            return faq_pairs[best][1], similarity, "semantic"
+    record_stage("none")
+    return None, score, "none"
+
 def generate_summary(question, rating):
     closing_phrases = ["Have a great day!", "See you next time!", "Take care!"]
     closing_phrase = random.choice(closing_phrases)
@@ -87,7 +131,10 @@ def get_random_agent_name():
     agents = ["Jeff", "Andrea", "Sarah", "Michael", "Emily"]
     return random.choice(agents)
 
+@timed(STAGE_SECONDS.labels("process_query"))
+@profiled("process_query")
 def process_query(app, user_input):
+    annotate(question=user_input)
     try:
         app.chat_display.config(state='normal')
         app.chat_display.insert(tk.END, "ChaseBot: Thinking...\n")
@@ -99,27 +146,31 @@ def process_query(app, user_input):
         is_critical = any(keyword in user_input.lower() for keyword in critical_keywords)
         is_escalation = any(keyword in user_input.lower() for keyword in escalation_keywords)
 
-        retrieved_answer, score = query_faq(user_input)
-        logging.debug(f"Retrieved answer for '{user_input}': {retrieved_answer}, Score: {score}")
-        confidence_threshold = 0.5
+        retrieved_answer, score, stage = match_faq(user_input)
+        MATCH_LOG.debug("Retrieved answer for '%s': %s, Score: %s, Stage: %s", user_input, retrieved_answer, score, stage)
+        annotate(stage=stage)
 
-        if score >= confidence_threshold and retrieved_answer:
+        if retrieved_answer:
             response = retrieved_answer
             response = f"{response}\n\nIs your question answered? (Yes/No)"
             app.current_state = "help_check"
+            FAQ_RESULTS.labels("answered").inc()
             response_queue.put((response, "answered"))
             return
 
         if is_critical or is_escalation:
             response = "I see this might need human assistance. Is this urgent or not urgent?"
             app.current_state = "urgency_check"
+            FAQ_RESULTS.labels("escalated").inc()
         else:
             response = "Apologies, can’t help with that and would recommend human involvement."
             response = f"{response}\n\nIs your question answered? (Yes/No)"
             app.current_state = "help_check"
+            FAQ_RESULTS.labels("unanswered").inc()
         response_queue.put((response, "answered"))
     except Exception as e:
-        logging.error(f"Error in process_query: {str(e)}")
+        logging.error("Error in process_query: %s", e)
+        FAQ_RESULTS.labels("error").inc()
         response_queue.put(("Error occurred while processing your request.", "answered"))
 
 class ChatApp:
@@ -272,6 +323,7 @@ class ChatApp:
     def check_response(self):
         try:
             response, action = response_queue.get_nowait()
+            UI_RESPONSE_SECONDS.observe(time.time() - self.response_start_time)
             self.chat_display.config(state='normal')
             self.chat_display.delete("end-2l", tk.END)
             self.chat_display.insert(tk.END, f"ChaseBot: {response}\n\n")
@@ -293,6 +345,7 @@ class ChatApp:
         self.root.quit()
 
 if __name__ == "__main__":
+    start_from_env()
     root = tk.Tk()
     app = ChatApp(root)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,136 @@
+import datetime
+import json
+import os
+import sys
+import threading
+
+# One append-only JSONL file per chat
+JOURNAL_DIR = os.path.join("chat_history", "journal")
+
+# Appended records reach the OS immediately; they are fsynced at most this often,
+# so a crash of the app loses nothing and a power cut loses at most this window
+FSYNC_INTERVAL = 1.0
+
+DISPLAY_NAMES = {"user": "You", "assistant": "Mistral 7B"}
+
+
+# Append-only journal of chat turns with batched fsync
+class ChatJournal:
+    def __init__(self, path, fsync_interval=FSYNC_INTERVAL):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+        self.drop_torn_tail()
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.records = 0
+        self.syncs = 0
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.run_flusher, args=(fsync_interval,), daemon=True)
+        self.flusher.start()
+
+    # A crash mid-write can leave half a line; cut it so the next record starts clean
+    def drop_torn_tail(self):
+        size = os.lseek(self.fd, 0, os.SEEK_END)
+        if size == 0 or os.pread(self.fd, 1, size - 1) == b"\n":
+            return
+        start = max(size - 65536, 0)
+        while True:
+            chunk = os.pread(self.fd, size - start, start)
+            index = chunk.rfind(b"\n")
+            if index != -1:
+                os.ftruncate(self.fd, start + index + 1)
+                return
+            if start == 0:
+                os.ftruncate(self.fd, 0)
+                return
+            start = max(start - 65536, 0)
+
+    # Writes one record; cost is proportional to the record, not the chat
+    def append(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.lock:
+            os.write(self.fd, line)
+            self.dirty = True
+            self.records += 1
+
+    def sync(self):
+        with self.lock:
+            if self.dirty and not self.closed.is_set():
+                os.fsync(self.fd)
+                self.dirty = False
+                self.syncs += 1
+
+    def run_flusher(self, fsync_interval):
+        while not self.closed.wait(fsync_interval):
+            self.sync()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.sync()
+        with self.lock:
+            self.closed.set()
+            os.close(self.fd)
+        self.flusher.join()
+
+
+# Function to read a journal, skipping a torn last line left by a crash
+def read_journal(path):
+    records = []
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+    except FileNotFoundError:
+        pass
+    return records
+
+
+# Function to build a journal record for one turn
+def make_record(role, text, tokens=None, latency=None, status="ok", timestamp=None):
+    timestamp = timestamp or datetime.datetime.now()
+    return {
+        "ts": timestamp.isoformat(timespec="seconds"),
+        "role": role,
+        "text": text,
+        "tokens": tokens,
+        "latency": latency,
+        "status": status
+    }
+
+
+# Function to get the "03:15 PM" time the chat display shows for a record
+def record_time(record):
+    try:
+        return datetime.datetime.fromisoformat(record["ts"]).strftime("%I:%M %p")
+    except (KeyError, ValueError):
+        return ""
+
+
+# Function to render journal records the way the chat display shows them
+def render_records(records):
+    return "".join(f"[{record_time(record)}] {DISPLAY_NAMES.get(record['role'], record['role'])}: {record['text']}\n\n" for record in records)
+
+
+# Function to add journal records the history index has not seen yet (after a crash)
+def index_missing_records(store, chat_id, records):
+    indexed = store.message_count(chat_id)
+    for record in records[indexed:]:
+        store.add_message(chat_id, record["role"], record_time(record), record["text"])
+    return max(len(records) - indexed, 0)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python chat_journal.py <journal.jsonl>")
+        sys.exit(1)
+    for record in read_journal(sys.argv[1]):
+        latency = f" {record['latency']:.2f}s" if record.get("latency") is not None else ""
+        tokens = f" {record['tokens']} tokens" if record.get("tokens") is not None else ""
+        print(f"{record['ts']} {record['role']:9s} [{record.get('status', 'ok')}{tokens}{latency}] {record['text'][:60]!r}")
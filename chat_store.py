@@ -0,0 +1,233 @@
+import datetime
+import os
+import re
+import sqlite3
+import sys
+
+# SQLite database holding every saved chat, next to the old text files
+DB_PATH = os.path.join("chat_history", "chats.db")
+
+# Most chats a search returns; the sidebar never needs more
+SEARCH_LIMIT = 200
+
+# Sidebar preview length (same as the old file-based preview)
+PREVIEW_LENGTH = 30
+
+# "[03:15 PM] You: ..." / "[03:15 PM] Mistral 7B: ..." lines in the chat display
+MESSAGE_PATTERN = re.compile(r"^\[(\d{1,2}:\d{2} [AP]M)\] (You|Mistral 7B): ?(.*)$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    started_at TEXT NOT NULL,
+    preview TEXT NOT NULL,
+    content TEXT NOT NULL,
+    journal TEXT
+);
+CREATE INDEX IF NOT EXISTS chats_started_at ON chats (started_at);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL REFERENCES chats (id) ON DELETE CASCADE,
+    role TEXT NOT NULL,
+    time TEXT,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_chat_id ON messages (chat_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (text, content='messages', content_rowid='id', prefix='1 2 3 4 5 6');
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+# Function to split a chat display dump into (role, time, text) messages
+def parse_messages(content):
+    messages = []
+    for line in content.splitlines():
+        match = MESSAGE_PATTERN.match(line)
+        if match:
+            role = "user" if match.group(2) == "You" else "assistant"
+            messages.append([role, match.group(1), match.group(3)])
+        elif messages:
+            # Stories and sonnets span several lines
+            messages[-1][2] += "\n" + line
+    return [(role, time, text.strip()) for role, time, text in messages]
+
+
+# Function to build the sidebar preview from the first user prompt
+def make_preview(messages):
+    for role, _, text in messages:
+        if role == "user" and text:
+            prompt = text.splitlines()[0].strip()
+            if len(prompt) > PREVIEW_LENGTH:
+                prompt = prompt[:PREVIEW_LENGTH - 3] + "..."
+            return prompt
+    return "No prompt found"
+
+
+# Function to turn search box text into an FTS5 query; only the word still being typed is a prefix
+# ("old ma" matches "old map"), since expanding every word against the whole index is what gets slow
+def build_match_query(search_term):
+    words = re.findall(r"\w+", search_term.lower())
+    if not words:
+        return ""
+    return " ".join([f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*'])
+
+
+# Chat history in SQLite with a full-text index over every message
+class ChatStore:
+    def __init__(self, db_path=DB_PATH):
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # The chat journals are the durable copy; the index can be rebuilt from them
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(chats)")]
+        if "journal" not in columns:
+            self.conn.execute("ALTER TABLE chats ADD COLUMN journal TEXT")
+
+    def close(self):
+        self.conn.close()
+
+    # Saves a whole chat; started_at is a datetime, name defaults to the old file naming
+    def save_chat(self, content, started_at=None, name=None):
+        started_at = started_at or datetime.datetime.now()
+        name = name or f"chat_{started_at.strftime('%Y%m%d_%H%M%S')}"
+        messages = parse_messages(content)
+        with self.conn:
+            self.conn.execute("DELETE FROM chats WHERE name = ?", (name,))
+            cursor = self.conn.execute(
+                "INSERT INTO chats (name, started_at, preview, content) VALUES (?, ?, ?, ?)",
+                (name, started_at.strftime("%Y-%m-%d %H:%M:%S"), make_preview(messages), content)
+            )
+            chat_id = cursor.lastrowid
+            self.conn.executemany(
+                "INSERT INTO messages (chat_id, role, time, text) VALUES (?, ?, ?, ?)",
+                [(chat_id, role, time, text) for role, time, text in messages]
+            )
+        return chat_id
+
+    # Starts a chat whose messages live in a journal file and are indexed one by one
+    def create_chat(self, started_at, name, first_prompt, journal):
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO chats (name, started_at, preview, content, journal) VALUES (?, ?, ?, '', ?)",
+                (name, started_at.strftime("%Y-%m-%d %H:%M:%S"), make_preview([("user", None, first_prompt)]), journal)
+            )
+        return cursor.lastrowid
+
+    def add_message(self, chat_id, role, time, text):
+        with self.conn:
+            self.conn.execute("INSERT INTO messages (chat_id, role, time, text) VALUES (?, ?, ?, ?)", (chat_id, role, time, text))
+
+    def message_count(self, chat_id):
+        return self.conn.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+
+    # Returns (content, journal): imported chats have content, newer chats a journal path
+    def load_chat(self, chat_id):
+        return self.conn.execute("SELECT content, journal FROM chats WHERE id = ?", (chat_id,)).fetchone()
+
+    # Returns (id, started_at, preview) rows, newest first, whose messages match every search word
+    def search(self, search_term="", limit=SEARCH_LIMIT):
+        query = build_match_query(search_term)
+        if not query:
+            return self.conn.execute(
+                "SELECT id, started_at, preview FROM chats ORDER BY started_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        # Message ids grow with time, so walking the index newest-first stops after `limit` chats
+        chat_ids = []
+        seen = set()
+        cursor = self.conn.execute(
+            "SELECT m.chat_id FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+            " WHERE messages_fts MATCH ? ORDER BY messages_fts.rowid DESC", (query,)
+        )
+        for (chat_id,) in cursor:
+            if chat_id not in seen:
+                seen.add(chat_id)
+                chat_ids.append(chat_id)
+                if len(chat_ids) >= limit:
+                    break
+        cursor.close()
+        if not chat_ids:
+            return []
+        placeholders = ",".join("?" * len(chat_ids))
+        return self.conn.execute(
+            f"SELECT id, started_at, preview FROM chats WHERE id IN ({placeholders}) ORDER BY started_at DESC", chat_ids
+        ).fetchall()
+
+    # Days with at least one chat, newest first ("YYYY-MM-DD")
+    def list_days(self):
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT substr(started_at, 1, 10) FROM chats ORDER BY 1 DESC")]
+
+    # Returns (id, started_at, preview) rows for one day, newest first
+    def chats_on_day(self, day):
+        return self.conn.execute(
+            "SELECT id, started_at, preview FROM chats WHERE started_at >= ? AND started_at < ? ORDER BY started_at DESC",
+            (day, day + " ~")
+        ).fetchall()
+
+    def chat_summary(self, chat_id):
+        return self.conn.execute("SELECT id, started_at, preview FROM chats WHERE id = ?", (chat_id,)).fetchone()
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def delete_meta(self, key):
+        with self.conn:
+            self.conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+
+    # One-time import of the old chat_history/chat_*.txt files, oldest first so ids follow time
+    def import_text_chats(self, chat_dir, force=False):
+        if self.get_meta("text_import_done") and not force:
+            return 0
+        imported = 0
+        for filename in sorted(f for f in os.listdir(chat_dir) if f.startswith("chat_") and f.endswith(".txt")):
+            try:
+                started_at = datetime.datetime.strptime(filename[len("chat_"):-len(".txt")], "%Y%m%d_%H%M%S")
+            except ValueError:
+                continue
+            with open(os.path.join(chat_dir, filename), "r") as file:
+                self.save_chat(file.read().strip(), started_at, name=filename[:-len(".txt")])
+            imported += 1
+        self.set_meta("text_import_done", datetime.datetime.now().isoformat())
+        self.optimize()
+        return imported
+
+    # Merges the full-text index into one segment after bulk loads
+    def optimize(self):
+        with self.conn:
+            self.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "import":
+        chat_dir = sys.argv[2] if len(sys.argv) > 2 else "chat_history"
+        store = ChatStore(os.path.join(chat_dir, "chats.db"))
+        print(f"Imported {store.import_text_chats(chat_dir, force=True)} chats from {chat_dir}")
+    elif len(sys.argv) >= 2 and sys.argv[1] == "search":
+        store = ChatStore()
+        for chat_id, started_at, preview in store.search(" ".join(sys.argv[2:])):
+            print(f"{chat_id:6d}  {started_at}  {preview}")
+    else:
+        print("Usage: python chat_store.py import [chat_dir] | search <words>")
+        sys.exit(1)
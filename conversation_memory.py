@@ -0,0 +1,261 @@
+import logging
+import math
+import queue
+import sys
+import threading
+from inference_client import PRIORITY_BACKGROUND, InferenceCancelled
+from prompt_templates import CONVERSATION_SUMMARY_PREFIX
+from token_budget import PromptTooLong
+
+# Turns kept word for word (the last two exchanges)
+RECENT_TURNS = 4
+# Most tokens the conversation memory may add to a prompt
+MEMORY_TOKENS = 512
+# Length of the running summary of older turns
+SUMMARY_TOKENS = 120
+# Older turns quoted next to the summary when they fit
+MAX_EXCERPTS = 2
+# Older turns folded into the summary per background call
+SUMMARY_BATCH_TURNS = 2
+
+ROLE_NAMES = {"user": "User", "assistant": "Assistant"}
+
+
+# Function to render turns as "User: ..." / "Assistant: ..." lines
+def render_turns(turns):
+    return "\n".join(f"{ROLE_NAMES.get(role, role)}: {text}" for role, text in turns)
+
+
+# Function to compare two embedding vectors
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+# Function to build a summarizer that folds turns into the running summary with the shared daemon
+def make_summarizer(client, budget, max_new_tokens=SUMMARY_TOKENS):
+    def summarize(summary, turns, cancel_event=None):
+        suffix = f"Summary so far: {summary}\n\n" if summary else ""
+        prompt = f"{CONVERSATION_SUMMARY_PREFIX}{suffix}{render_turns(turns)}\n\nSummary:"
+        # Below every user-facing band (stories included): summaries run between turns and must not delay
+        # anyone's reply, and cancel_event drops one still in flight when the user sends the next turn
+        return client(prompt, max_new_tokens=budget.fit_max_new_tokens(prompt, max_new_tokens), temperature=0.2, top_p=0.9,
+                      priority=PRIORITY_BACKGROUND, cancel_event=cancel_event).strip()
+    return summarize
+
+
+# Keeps recent turns verbatim and older ones as a background-computed summary
+# plus excerpts, and fits them into a token budget when a prompt is built
+class ConversationMemory:
+    def __init__(self, budget, summarize=None, embed=None, recent_turns=RECENT_TURNS, memory_tokens=MEMORY_TOKENS, max_excerpts=MAX_EXCERPTS):
+        self.budget = budget
+        self.summarize = summarize
+        self.embed = embed
+        self.recent_turns = recent_turns
+        self.memory_tokens = memory_tokens
+        self.max_excerpts = max_excerpts
+        self.lock = threading.Lock()
+        self.turns = []
+        self.embeddings = []
+        self.summary = ""
+        self.summarized = 0
+        # Bumped by reset() so background work for an old conversation is thrown away
+        self.epoch = 0
+        self.last_stats = {}
+        # Set while a user turn is being answered: no summary starts, and one in flight is cancelled
+        self.user_turn = threading.Event()
+        self.pending = queue.Queue()
+        threading.Thread(target=self.run_worker, daemon=True).start()
+
+    # Returns a handle for replace_turn()
+    def add_turn(self, role, text):
+        with self.lock:
+            self.turns.append((role, text))
+            handle = (self.epoch, len(self.turns) - 1)
+        self.resume()
+        return handle
+
+    # Replaces the text of an earlier turn (e.g. a quick answer superseded by a fuller one);
+    # ignored if the conversation was reset since. The turn is embedded again in the background
+    def replace_turn(self, handle, text):
+        epoch, index = handle
+        with self.lock:
+            if epoch != self.epoch:
+                return
+            self.turns[index] = (self.turns[index][0], text)
+            del self.embeddings[index:]
+        self.pending.put(True)
+
+    # Called when a prompt for the user's next turn is built
+    def interrupt(self):
+        self.user_turn.set()
+
+    # Called when the user's turn is over, answered or not (error, timeout, cancel); background
+    # summaries (including a cancelled one) may run again
+    def resume(self):
+        self.user_turn.clear()
+        self.pending.put(True)
+
+    # Starts a new conversation, optionally seeded with turns from a saved chat
+    def reset(self, turns=None):
+        with self.lock:
+            self.epoch += 1
+            self.turns = list(turns or [])
+            self.embeddings = []
+            self.summary = ""
+            self.summarized = 0
+        self.user_turn.clear()
+        self.pending.put(True)
+
+    # Summaries and embeddings are computed here, between turns, never while a prompt is built
+    def run_worker(self):
+        while True:
+            self.pending.get()
+            try:
+                while self.catch_up():
+                    pass
+            except Exception as e:
+                logging.warning("Conversation memory: background update failed: %s", e)
+
+    # Does one step of background work; returns False once everything is up to date
+    def catch_up(self):
+        with self.lock:
+            epoch = self.epoch
+            if self.embed is not None and len(self.embeddings) < len(self.turns):
+                index = len(self.embeddings)
+                turn = self.turns[index]
+                job = "embed"
+            elif self.summarize is not None and self.summarized < len(self.turns) - self.recent_turns and not self.user_turn.is_set():
+                end = min(self.summarized + SUMMARY_BATCH_TURNS, len(self.turns) - self.recent_turns)
+                summary = self.summary
+                turns = self.turns[self.summarized:end]
+                job = "summarize"
+            else:
+                return False
+        if job == "embed":
+            vector = list(self.embed(turn[1]))
+            with self.lock:
+                # The turn may have been replaced while it was being embedded
+                if self.epoch == epoch and len(self.embeddings) == index and self.turns[index] == turn:
+                    self.embeddings.append(vector)
+            return True
+        try:
+            new_summary = self.summarize(summary, turns, cancel_event=self.user_turn)
+        except InferenceCancelled:
+            # Retried once the user's turn has been answered
+            return False
+        except PromptTooLong:
+            # A turn too long to summarize stays available as an excerpt
+            new_summary = summary
+        with self.lock:
+            if self.epoch == epoch and self.summary == summary:
+                self.summary = new_summary
+                self.summarized = end
+        return True
+
+    # Picks older turns worth quoting: most similar to the query if embeddings exist,
+    # otherwise the newest turns the summary does not cover yet
+    def pick_excerpts(self, query, older, embeddings, summarized):
+        if self.embed is not None and embeddings and query:
+            query_vector = list(self.embed(query))
+            ranked = sorted(range(min(len(older), len(embeddings))), key=lambda i: cosine_similarity(query_vector, embeddings[i]), reverse=True)
+        else:
+            ranked = list(range(len(older) - 1, summarized - 1, -1))
+        return ranked[:self.max_excerpts]
+
+    # Returns the memory text to put in a prompt, never longer than limit_tokens
+    def context(self, query="", limit_tokens=None):
+        # A user turn is being built; an in-flight summary would compete with its reply
+        self.interrupt()
+        limit = self.memory_tokens if limit_tokens is None else min(limit_tokens, self.memory_tokens)
+        with self.lock:
+            turns = list(self.turns)
+            embeddings = list(self.embeddings)
+            summary = self.summary
+            summarized = self.summarized
+        recent_start = max(len(turns) - self.recent_turns, 0)
+        older = turns[:recent_start]
+        # Candidates in priority order: recent turns newest first, then the summary, then excerpts
+        pieces = [("turn", i) for i in range(len(turns) - 1, recent_start - 1, -1)]
+        if summary:
+            pieces.append(("summary", None))
+        pieces += [("turn", i) for i in self.pick_excerpts(query, older, embeddings, summarized)]
+        chosen = []
+        used = 0
+        recent_gap = False
+        for kind, index in pieces:
+            if kind == "turn" and index >= recent_start and recent_gap:
+                continue
+            text = f"Summary of the earlier conversation: {summary}" if kind == "summary" else render_turns([turns[index]])
+            cost = self.budget.count(text) + 1
+            if used + cost > limit:
+                # Recent turns are kept contiguous; an older one is not quoted past a gap
+                recent_gap = recent_gap or (kind == "turn" and index >= recent_start)
+                continue
+            chosen.append((kind, index))
+            used += cost
+        text = self.render(chosen, turns, summary)
+        # Token counts of joined pieces can differ slightly from their sum; drop pieces until it fits
+        while chosen and self.budget.count(text) > limit:
+            chosen.pop()
+            text = self.render(chosen, turns, summary)
+        self.last_stats = {
+            "turns": len(turns),
+            "summarized": summarized,
+            "pieces": len(chosen),
+            "tokens": self.budget.count(text) if text else 0,
+            "limit": limit
+        }
+        return text
+
+    def render(self, chosen, turns, summary):
+        if not chosen:
+            return ""
+        lines = ["Conversation so far:"]
+        if any(kind == "summary" for kind, _ in chosen):
+            lines.append(f"Summary of the earlier conversation: {summary}")
+        lines += [render_turns([turns[index]]) for index in sorted(index for kind, index in chosen if kind == "turn")]
+        return "\n".join(lines)
+
+    # Builds the prompt with as much memory as fits next to max_new_tokens of reply
+    def assemble(self, build_prompt, query, max_new_tokens):
+        bare_prompt = build_prompt("")
+        room = self.budget.context_length - max_new_tokens - self.budget.count(bare_prompt)
+        if room <= 0:
+            return bare_prompt
+        memory = self.context(query, room)
+        if not memory:
+            return bare_prompt
+        prompt = build_prompt(memory)
+        if self.budget.count(prompt) + max_new_tokens > self.budget.context_length:
+            return bare_prompt
+        return prompt
+
+
+# Function to check the budget guarantee with a stand-in tokenizer and summarizer
+def self_check(conversations=200):
+    import random
+    from token_budget import TokenBudget
+    rng = random.Random(0)
+    budget = TokenBudget(context_length=1024, count_fn=lambda text: len(text.split()) + 1)
+    words = ["owl", "sea", "ship", "keeper", "storm", "light", "gull", "harbor"]
+    for n in range(conversations):
+        summarize = lambda summary, turns, cancel_event=None: " ".join((summary + " " + render_turns(turns)).split()[:40])
+        embed = (lambda text: [text.count(word) for word in words]) if n % 2 else None
+        limit = rng.randint(20, 300)
+        memory = ConversationMemory(budget, summarize=summarize, embed=embed, memory_tokens=limit)
+        for _ in range(rng.randint(1, 12)):
+            memory.add_turn(rng.choice(["user", "assistant"]), " ".join(rng.choice(words) for _ in range(rng.randint(1, 150))))
+            text = memory.context(rng.choice(words), rng.randint(10, 400))
+            assert memory.last_stats["tokens"] <= memory.last_stats["limit"]
+            assert not text or budget.count(text) <= limit
+    print(f"Conversation memory self-check passed ({conversations} conversations)")
+
+
+if __name__ == "__main__":
+    if "--self-check" in sys.argv:
+        self_check()
+    else:
+        print("Usage: python conversation_memory.py --self-check")
+        sys.exit(1)
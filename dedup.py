@@ -0,0 +1,176 @@
+import os
+import re
+import sys
+import zlib
+import numpy as np
+
+# Chunks whose estimated Jaccard similarity (character shingles) reaches this are near-duplicates
+SIMILARITY_THRESHOLD = float(os.environ.get("MISTRAL_DEDUP_THRESHOLD", "0.8"))
+# Set MISTRAL_DEDUP=0 to embed and store every chunk
+DEDUP_ENABLED = os.environ.get("MISTRAL_DEDUP", "1") != "0"
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+# LSH banding: 32 bands of 4 rows make pairs at 0.5 similarity candidates ~87% of the time and pairs
+# at 0.8 practically always; candidates are then checked against the threshold
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+# Universal hashing (a * x + b) mod P over 31-bit values, so products fit in 64 bits
+PRIME = (1 << 31) - 1
+
+
+# Function to reduce a chunk to the text that decides whether it repeats another
+def normalize_chunk(text):
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return re.sub(r"\s+", " ", text).strip()
+
+
+# Function to cut normalized text into overlapping character shingles, hashed to 31-bit integers
+def shingle_hashes(text, size=SHINGLE_SIZE):
+    text = normalize_chunk(text)
+    if len(text) <= size:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + size] for i in range(len(text) - size + 1)}
+    return np.array([zlib.crc32(shingle.encode("utf-8")) % PRIME for shingle in shingles], dtype=np.uint64)
+
+
+# Finds near-duplicate chunks with MinHash signatures and LSH banding. Chunks are added in order and
+# the first of each group is kept; later copies are merged into it (their sources are recorded)
+class ChunkDeduplicator:
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, num_perm=NUM_PERM, bands=BANDS, seed=1):
+        rng = np.random.RandomState(seed)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.a = rng.randint(1, PRIME, size=(num_perm, 1)).astype(np.uint64)
+        self.b = rng.randint(0, PRIME, size=(num_perm, 1)).astype(np.uint64)
+        self.buckets = {}
+        self.signatures = {}
+        self.numbers = {}
+        self.kept = {}
+        self.removed = []
+
+    def signature(self, text):
+        hashes = shingle_hashes(text)
+        return ((self.a * hashes[None, :] + self.b) % PRIME).min(axis=1)
+
+    # Function to add one chunk; returns the kept chunk it duplicates, or None if it is kept itself
+    def add(self, chunk):
+        signature = self.signature(chunk["text"])
+        # Chunks that differ only in a fee, limit or date are not duplicates
+        numbers = tuple(re.findall(r"\d+", chunk["text"]))
+        keys = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+        best_id, best_similarity = None, 0.0
+        checked = set()
+        for key in keys:
+            for candidate in self.buckets.get(key, ()):
+                if candidate in checked:
+                    continue
+                checked.add(candidate)
+                if self.numbers[candidate] != numbers:
+                    continue
+                similarity = float(np.mean(self.signatures[candidate] == signature))
+                if similarity > best_similarity:
+                    best_id, best_similarity = candidate, similarity
+        if best_id is not None and best_similarity >= self.threshold:
+            kept = self.kept[best_id]
+            kept["duplicates"] += 1
+            if chunk["source"] not in kept["sources"]:
+                kept["sources"].append(chunk["source"])
+            self.removed.append((chunk, best_id, best_similarity))
+            return best_id
+        self.signatures[chunk["id"]] = signature
+        self.numbers[chunk["id"]] = numbers
+        self.kept[chunk["id"]] = dict(chunk, duplicates=0, sources=[chunk["source"]])
+        for key in keys:
+            self.buckets.setdefault(key, []).append(chunk["id"])
+        return None
+
+    def report(self):
+        removed_bytes = sum(len(chunk["text"].encode("utf-8")) for chunk, _, _ in self.removed)
+        total = len(self.kept) + len(self.removed)
+        return {
+            "chunks": total,
+            "kept": len(self.kept),
+            "removed": len(self.removed),
+            "removed_share": len(self.removed) / total if total else 0.0,
+            "cross_source": sum(1 for chunk, kept_id, _ in self.removed if chunk["source"] != self.kept[kept_id]["source"]),
+            "removed_text_bytes": removed_bytes
+        }
+
+
+# Function to drop near-duplicates from chunks ({"id", "text", "source"}) across the whole corpus.
+# Returns the kept chunks (with "duplicates" and "sources") and a report
+def deduplicate(chunks, threshold=SIMILARITY_THRESHOLD, enabled=DEDUP_ENABLED):
+    if not enabled:
+        kept = [dict(chunk, duplicates=0, sources=[chunk["source"]]) for chunk in chunks]
+        return kept, {"chunks": len(kept), "kept": len(kept), "removed": 0, "removed_share": 0.0, "cross_source": 0, "removed_text_bytes": 0}
+    deduplicator = ChunkDeduplicator(threshold)
+    for chunk in chunks:
+        deduplicator.add(chunk)
+    return list(deduplicator.kept.values()), deduplicator.report()
+
+
+# Function to build Chroma metadata for a kept chunk (values must be plain strings and numbers)
+def chunk_metadata(chunk):
+    return {"source": chunk["source"], "sources": ",".join(chunk["sources"]), "duplicates": chunk["duplicates"]}
+
+
+# Function to describe what deduplication saved, given the time spent embedding the kept chunks
+def describe_savings(report, embed_seconds, dimension):
+    per_chunk = embed_seconds / report["kept"] if report["kept"] else 0.0
+    saved_seconds = per_chunk * report["removed"]
+    # Each stored chunk costs its float32 vector plus its text
+    saved_bytes = report["removed"] * dimension * 4 + report["removed_text_bytes"]
+    return (f"Deduplication: {report['removed']} of {report['chunks']} chunks were near-duplicates ({report['removed_share']:.1%}, "
+            f"{report['cross_source']} across documents); saved ~{saved_seconds:.1f}s of embedding and ~{saved_bytes / 1024:.0f} KB of index")
+
+
+# Function to check that exact and near copies are merged and different chunks are kept
+def self_check():
+    base = "To reset your password, open Settings, choose Security and follow the prompts on screen."
+    chunks = [
+        {"id": "a_0", "text": base, "source": "a.txt"},
+        {"id": "a_1", "text": "Sandboxes copy metadata from production every night.", "source": "a.txt"},
+        {"id": "b_0", "text": base, "source": "b.txt"},
+        {"id": "b_1", "text": base.replace("Security", "Security tab").upper(), "source": "b.txt"},
+        {"id": "b_2", "text": "Data Cloud ingests records from connected sources in near real time.", "source": "b.txt"},
+        {"id": "b_3", "text": "A domestic wire transfer costs $25 and arrives within 1 business day.", "source": "b.txt"},
+        {"id": "b_4", "text": "A domestic wire transfer costs $35 and arrives within 1 business day.", "source": "b.txt"}
+    ]
+    kept, report = deduplicate(chunks, enabled=True)
+    assert [chunk["id"] for chunk in kept] == ["a_0", "a_1", "b_2", "b_3", "b_4"], [chunk["id"] for chunk in kept]
+    assert kept[0]["duplicates"] == 2 and kept[0]["sources"] == ["a.txt", "b.txt"], kept[0]
+    assert report["removed"] == 2 and report["cross_source"] == 2, report
+    kept, report = deduplicate(chunks, enabled=False)
+    assert len(kept) == 7 and report["removed"] == 0
+    # Estimated similarity follows the true Jaccard similarity of the shingle sets
+    deduplicator = ChunkDeduplicator()
+    one, two = base, base.replace("follow the prompts on screen", "call us")
+    first, second = set(shingle_hashes(one).tolist()), set(shingle_hashes(two).tolist())
+    exact = len(first & second) / len(first | second)
+    estimate = float(np.mean(deduplicator.signature(one) == deduplicator.signature(two)))
+    assert abs(estimate - exact) < 0.15, (estimate, exact)
+    print("Deduplication self-check passed")
+
+
+if __name__ == "__main__":
+    if "--self-check" in sys.argv:
+        self_check()
+        sys.exit(0)
+    paths = [path for path in sys.argv[1:] if not path.startswith("--")]
+    if not paths:
+        print("Usage: python dedup.py --self-check | <document> [<document> ...]")
+        sys.exit(1)
+    from utils import split_text
+    chunks = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            text = re.sub(r"\s+", " ", f.read()).strip()
+        chunks.extend({"id": f"{os.path.basename(path)}_chunk_{i}", "text": chunk, "source": os.path.basename(path)} for i, chunk in enumerate(split_text(text)))
+    deduplicator = ChunkDeduplicator()
+    for chunk in chunks:
+        deduplicator.add(chunk)
+    for chunk, kept_id, similarity in deduplicator.removed:
+        print(f"{chunk['id']} ~ {kept_id} ({similarity:.2f}): {chunk['text'][:80]}")
+    print(deduplicator.report())
@@ -0,0 +1,287 @@
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import time
+import numpy as np
+from utils import split_text, percentile
+
+# "torch" (default): sentence-transformers as before; "onnx_int8": the same model exported to ONNX
+# with dynamically quantized int8 weights, run by onnxruntime on the CPU
+EMBEDDING_BACKEND = os.environ.get("MISTRAL_EMBEDDING_BACKEND", "torch")
+# Exported models are kept here, one folder per model, so the export runs once per host
+ONNX_CACHE_DIR = os.environ.get("MISTRAL_ONNX_DIR", os.path.expanduser("~/.cache/mistral_onnx"))
+# Threads onnxruntime may use (0 = its default)
+ONNX_THREADS = int(os.environ.get("MISTRAL_ONNX_THREADS", "0"))
+ONNX_OPSET = 14
+# After export the int8 model must agree with the original this closely (lowest cosine similarity
+# on the probe sentences); otherwise it is not used and sentence-transformers is loaded instead
+MIN_PROBE_COSINE = 0.97
+# Largest allowed drop in recall@k against the original model (checked by --benchmark)
+RECALL_TOLERANCE = 0.02
+
+PROBE_SENTENCES = [
+    "How do I reset my online banking password?",
+    "What is the daily limit for mobile check deposits?",
+    "Salesforce Agentforce Service Assistant answers customer questions from your knowledge base.",
+    "Overdraft protection links your savings account to your checking account.",
+    "Write a joyful story about a lighthouse keeper who adopts a seagull.",
+    "The quarterly statement lists every transaction, fee and interest payment."
+]
+
+
+# Function to get the cache folder for one model's export
+def onnx_model_dir(model_name):
+    return os.path.join(ONNX_CACHE_DIR, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name) + "-int8")
+
+
+# Runs an exported model: same tokenizer, pooling and normalization as the sentence-transformers model
+class OnnxEmbedder:
+    def __init__(self, directory):
+        import onnxruntime
+        from transformers import AutoTokenizer
+        with open(os.path.join(directory, "settings.json"), "r") as f:
+            self.settings = json.load(f)
+        self.tokenizer = AutoTokenizer.from_pretrained(directory)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if ONNX_THREADS:
+            options.intra_op_num_threads = ONNX_THREADS
+        self.session = onnxruntime.InferenceSession(os.path.join(directory, "model.int8.onnx"), options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.max_seq_length = self.settings["max_seq_length"]
+
+    def pool(self, hidden, attention_mask):
+        if self.settings["pooling"] == "cls":
+            pooled = hidden[:, 0]
+        elif self.settings["pooling"] == "max":
+            pooled = np.where(attention_mask[..., None] > 0, hidden, -1e9).max(axis=1)
+        else:
+            mask = attention_mask[..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.settings["normalize"]:
+            pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+    # Same call as SentenceTransformer.encode: one string gives one vector, a list gives a matrix
+    def encode(self, sentences, convert_to_numpy=True, batch_size=32, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if not texts:
+            return np.zeros((0, self.settings["dimension"]), dtype=np.float32)
+        # Texts of similar length share a batch, so little of each batch is padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        embeddings = np.zeros((len(texts), self.settings["dimension"]), dtype=np.float32)
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            encoded = self.tokenizer([texts[i] for i in indices], padding=True, truncation=True, max_length=self.max_seq_length, return_tensors="np")
+            feeds = {name: encoded[name].astype(np.int64) for name in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            embeddings[indices] = self.pool(hidden, encoded["attention_mask"])
+        return embeddings[0] if single else embeddings
+
+
+# Function to export a sentence-transformers model to ONNX, quantize its weights to int8 and check
+# the result against the original on the probe sentences
+def export_onnx(model_name, directory):
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    export_start = time.time()
+    reference = SentenceTransformer(model_name, device="cpu")
+    transformer = reference[0]
+    pooling = reference[1].get_config_dict() if len(reference) > 1 else {}
+    tokenizer = transformer.tokenizer
+    encoded = tokenizer(PROBE_SENTENCES[:2], padding=True, truncation=True, max_length=transformer.max_seq_length, return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in encoded]
+
+    # Only the token embeddings are exported; pooling and normalization run in numpy
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs)))[0]
+
+    # Build in a scratch folder and move it into place, so an interrupted export is never used
+    temporary_dir = directory + ".tmp"
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    os.makedirs(temporary_dir)
+    fp32_path = os.path.join(temporary_dir, "model.onnx")
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+    with torch.no_grad():
+        torch.onnx.export(LastHiddenState(transformer.auto_model.eval()), tuple(encoded[name] for name in input_names), fp32_path,
+                          input_names=input_names, output_names=["last_hidden_state"], dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET)
+    # Per-channel scales with 7-bit weights keep the int8 model close to the original on CPUs without VNNI
+    quantize_dynamic(fp32_path, os.path.join(temporary_dir, "model.int8.onnx"), weight_type=QuantType.QInt8, per_channel=True, reduce_range=True)
+    os.remove(fp32_path)
+    tokenizer.save_pretrained(temporary_dir)
+    if pooling.get("pooling_mode_cls_token"):
+        pooling_mode = "cls"
+    elif pooling.get("pooling_mode_max_tokens"):
+        pooling_mode = "max"
+    else:
+        pooling_mode = "mean"
+    settings = {
+        "model": model_name,
+        "max_seq_length": transformer.max_seq_length,
+        "pooling": pooling_mode,
+        "normalize": any(type(module).__name__ == "Normalize" for module in reference),
+        "dimension": reference.get_sentence_embedding_dimension()
+    }
+    with open(os.path.join(temporary_dir, "settings.json"), "w") as f:
+        json.dump(settings, f, indent=2)
+    expected = reference.encode(PROBE_SENTENCES, convert_to_numpy=True)
+    actual = OnnxEmbedder(temporary_dir).encode(PROBE_SENTENCES)
+    settings["probe_cosine"] = float(min(cosine_rows(expected, actual)))
+    settings["export_seconds"] = time.time() - export_start
+    with open(os.path.join(temporary_dir, "settings.json"), "w") as f:
+        json.dump(settings, f, indent=2)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temporary_dir, directory)
+    logging.info(f"Exported {model_name} to {directory} in {settings['export_seconds']:.1f}s (probe cosine {settings['probe_cosine']:.4f})")
+    return settings
+
+
+# Function to compare two sets of embeddings row by row
+def cosine_rows(a, b):
+    a = a / np.clip(np.linalg.norm(a, axis=1, keepdims=True), 1e-12, None)
+    b = b / np.clip(np.linalg.norm(b, axis=1, keepdims=True), 1e-12, None)
+    return (a * b).sum(axis=1)
+
+
+# Function to load the embedding model for the configured backend. The ONNX path exports on first use
+# and falls back to sentence-transformers if it fails in any way (missing packages, a failed export or
+# quantization, a corrupt cache, a session that will not load) or the int8 model disagrees
+def load_embedder(model_name, backend=None):
+    backend = backend or EMBEDDING_BACKEND
+    if backend == "onnx_int8":
+        try:
+            directory = onnx_model_dir(model_name)
+            settings_path = os.path.join(directory, "settings.json")
+            if os.path.exists(settings_path):
+                with open(settings_path, "r") as f:
+                    settings = json.load(f)
+            else:
+                settings = export_onnx(model_name, directory)
+            if settings["probe_cosine"] >= MIN_PROBE_COSINE:
+                return OnnxEmbedder(directory)
+            logging.warning(f"int8 ONNX export of {model_name} agrees too little with the original (cosine {settings['probe_cosine']:.4f}); using sentence-transformers")
+        except Exception as e:
+            logging.warning(f"ONNX embedding backend unavailable ({type(e).__name__}: {str(e)}); using sentence-transformers")
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+
+# Function to build the benchmark corpus: document chunks, and the questions found in the documents,
+# each relevant to the chunks that contain it
+def benchmark_corpus(paths):
+    chunks = []
+    questions = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            text = re.sub(r'\s+', ' ', f.read())
+        chunks.extend(split_text(text))
+        questions.extend(sentence.strip() for sentence in re.split(r'(?<=[.!?])\s+', text) if sentence.strip().endswith("?") and len(sentence) > 15)
+    if len(questions) < 10:
+        # Documents without questions: each chunk's first sentence asks for that chunk
+        questions = [re.split(r'(?<=[.!?])\s+', chunk)[0] for chunk in chunks]
+    relevant = [{i for i, chunk in enumerate(chunks) if question in chunk} for question in questions]
+    pairs = [(question, ids) for question, ids in zip(questions, relevant) if ids]
+    return chunks, [question for question, _ in pairs], [ids for _, ids in pairs]
+
+
+# Function to score retrieval: recall@k against the relevant chunks, and overlap with a reference top-k
+def retrieval_scores(query_embeddings, chunk_embeddings, relevant, k, reference_top=None):
+    similarities = cosine_matrix(query_embeddings, chunk_embeddings)
+    top = np.argsort(-similarities, axis=1)[:, :k]
+    recall = float(np.mean([len(set(row) & ids) / min(len(ids), k) for row, ids in zip(top.tolist(), relevant)]))
+    overlap = None
+    if reference_top is not None:
+        overlap = float(np.mean([len(set(row) & set(other)) / k for row, other in zip(top.tolist(), reference_top.tolist())]))
+    return recall, overlap, top
+
+
+def cosine_matrix(a, b):
+    a = a / np.clip(np.linalg.norm(a, axis=1, keepdims=True), 1e-12, None)
+    b = b / np.clip(np.linalg.norm(b, axis=1, keepdims=True), 1e-12, None)
+    return a @ b.T
+
+
+# Function to time one embedder: per-question latency (as get_hf_embedding is called) and batch ingestion
+def time_embedder(embedder, chunks, questions, repetitions):
+    embedder.encode(questions[:4])
+    latencies = []
+    for _ in range(repetitions):
+        for question in questions:
+            start_time = time.perf_counter()
+            embedder.encode(question, convert_to_numpy=True)
+            latencies.append(time.perf_counter() - start_time)
+    start_time = time.perf_counter()
+    chunk_embeddings = embedder.encode(chunks, convert_to_numpy=True)
+    ingest_seconds = time.perf_counter() - start_time
+    return {
+        "query_p50_ms": percentile(latencies, 50) * 1000,
+        "query_p95_ms": percentile(latencies, 95) * 1000,
+        "ingest_chunks_per_second": len(chunks) / ingest_seconds
+    }, chunk_embeddings
+
+
+# Function to compare the int8 ONNX path with sentence-transformers on speed and recall@k
+def benchmark(model_name, paths, k, tolerance, repetitions):
+    from sentence_transformers import SentenceTransformer
+    chunks, questions, relevant = benchmark_corpus(paths)
+    print(f"{model_name}: {len(chunks)} chunks, {len(questions)} questions, recall@{k}")
+    reference = SentenceTransformer(model_name, device="cpu")
+    quantized = load_embedder(model_name, "onnx_int8")
+    if not isinstance(quantized, OnnxEmbedder):
+        print("The int8 ONNX model could not be used (see the log); nothing to compare")
+        return None
+    results = {}
+    reference_top = None
+    for name, embedder in (("sentence_transformers", reference), ("onnx_int8", quantized)):
+        timing, chunk_embeddings = time_embedder(embedder, chunks, questions, repetitions)
+        query_embeddings = np.asarray(embedder.encode(questions, convert_to_numpy=True))
+        recall, overlap, top = retrieval_scores(query_embeddings, np.asarray(chunk_embeddings), relevant, k, reference_top)
+        reference_top = top if reference_top is None else reference_top
+        results[name] = dict(timing, recall=recall, overlap_with_original=overlap, query_embeddings=query_embeddings)
+    original, int8 = results["sentence_transformers"], results["onnx_int8"]
+    agreement = cosine_rows(original.pop("query_embeddings"), int8.pop("query_embeddings"))
+    drop = original["recall"] - int8["recall"]
+    for name, result in results.items():
+        print(f"  {name:22s} query p50 {result['query_p50_ms']:7.2f} ms  p95 {result['query_p95_ms']:7.2f} ms"
+              f"  ingest {result['ingest_chunks_per_second']:8.1f} chunks/s  recall@{k} {result['recall']:.4f}")
+    print(f"  speed-up: queries x{original['query_p50_ms'] / int8['query_p50_ms']:.2f}, ingestion x{int8['ingest_chunks_per_second'] / original['ingest_chunks_per_second']:.2f}")
+    print(f"  top-{k} overlap with the original {int8['overlap_with_original']:.4f}, embedding cosine mean {agreement.mean():.4f} min {agreement.min():.4f}")
+    print(f"  recall@{k} drop {drop:+.4f} (tolerance {tolerance}): {'OK' if drop <= tolerance else 'TOO LARGE'}")
+    results["recall_drop"] = drop
+    results["within_tolerance"] = drop <= tolerance
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export an embedding model to int8 ONNX and compare its speed and recall@k with sentence-transformers")
+    parser.add_argument("--model", default="all-mpnet-base-v2")
+    parser.add_argument("--export", action="store_true", help="Only export (or re-export) the model to the cache")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--docs", nargs="+", default=["./test_data/Salesforce ASA FAQ.txt", "./Chase_FAQ/Chase Banking FAQ.txt"])
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=RECALL_TOLERANCE, help="Largest acceptable drop in recall@k")
+    parser.add_argument("--repetitions", type=int, default=3)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.export:
+        print(json.dumps(export_onnx(args.model, onnx_model_dir(args.model)), indent=2))
+    elif args.benchmark:
+        paths = [path for path in args.docs if os.path.exists(path)]
+        if not paths:
+            parser.error("none of the --docs files exist")
+        results = benchmark(args.model, paths, args.k, args.tolerance, args.repetitions)
+        sys.exit(0 if results and results["within_tolerance"] else 1)
+    else:
+        parser.print_help()
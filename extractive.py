@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+import numpy as np
+from metrics import REGISTRY, STAGE_SECONDS
+
+# Set MISTRAL_FAST_PATH=0 to always generate with the LLM
+FAST_PATH_ENABLED = os.environ.get("MISTRAL_FAST_PATH", "1") != "0"
+# Set MISTRAL_FAST_PATH_POLISH=1 to also have the LLM rephrase a fast answer in the background
+POLISH_IN_BACKGROUND = os.environ.get("MISTRAL_FAST_PATH_POLISH") == "1"
+# Calibrated thresholds per embedding model, written by "python extractive.py"
+THRESHOLDS_PATH = os.environ.get("MISTRAL_FAST_PATH_FILE", os.path.expanduser("~/.mistral_fast_path.json"))
+# Used until a model has been calibrated: conservative, so the fast path only takes near-verbatim matches
+DEFAULT_THRESHOLDS = {"min_similarity": 0.8, "min_gap": 0.08}
+# Calibration picks the loosest thresholds whose top chunk is still the right one this often
+TARGET_PRECISION = 0.95
+MIN_CALIBRATION_HITS = 5
+
+ANSWERS = REGISTRY.counter("rag_answers_total", "RAG answers by how they were produced", ("path",))
+ANSWER_COUNTS = {path: ANSWERS.labels(path) for path in ("extractive", "llm")}
+ANSWER_SECONDS = {
+    "extractive": STAGE_SECONDS.labels("rag_answer_extractive"),
+    "llm": STAGE_SECONDS.labels("rag_answer_llm")
+}
+
+
+# Function to convert a Chroma distance to cosine similarity. Collections use the default squared L2
+# space and the sentence-transformers models emit unit-length vectors, so cosine = 1 - distance / 2
+def distance_to_similarity(distance):
+    return 1.0 - distance / 2.0
+
+
+# Function to get the stored thresholds for an embedding model
+def load_thresholds(model_name, path=THRESHOLDS_PATH):
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f).get(model_name)
+            if entry:
+                return {"min_similarity": entry["min_similarity"], "min_gap": entry["min_gap"]}
+        except (OSError, ValueError):
+            pass
+    return dict(DEFAULT_THRESHOLDS)
+
+
+def save_thresholds(model_name, entry, path=THRESHOLDS_PATH):
+    entries = {}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            entries = json.load(f)
+    entries[model_name] = entry
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(entries, f, indent=2)
+    os.replace(temporary_path, path)
+
+
+# Function to decide whether the top hit is clearly the answer: similar enough, and clearly ahead of the next
+def confident(similarities, thresholds):
+    if not similarities or similarities[0] < thresholds["min_similarity"]:
+        return False
+    return len(similarities) == 1 or similarities[0] - similarities[1] >= thresholds["min_gap"]
+
+
+# Function to split a chunk into sentences, dropping the "Q:"/"A:" labels FAQ documents use
+def split_sentences(text):
+    sentences = (re.sub(r"^[QA]:\s*", "", sentence.strip()) for sentence in re.split(r"(?<=[.!?])\s+", text))
+    return [sentence for sentence in sentences if sentence]
+
+
+# Function to pick the answer span in a chunk: the sentence closest to the question, or, when that is
+# the FAQ's own question, the sentences that follow it up to the next question
+def extract_span(question_embedding, chunk, embed_many):
+    sentences = split_sentences(chunk)
+    if not sentences:
+        return None
+    if len(sentences) == 1:
+        best = 0
+    else:
+        vectors = np.asarray(embed_many(sentences), dtype=np.float64)
+        vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        question_vector = np.asarray(question_embedding, dtype=np.float64)
+        best = int(np.argmax(vectors @ (question_vector / max(np.linalg.norm(question_vector), 1e-12))))
+    if not sentences[best].endswith("?"):
+        return sentences[best]
+    span = []
+    for sentence in sentences[best + 1:]:
+        if sentence.endswith("?"):
+            break
+        span.append(sentence)
+    return " ".join(span) or None
+
+
+# Function to answer straight from retrieval when it is confident; returns None to fall back to the LLM.
+# `results` is a Chroma query result for one question
+def fast_answer(question_embedding, results, embed_many, thresholds):
+    if not FAST_PATH_ENABLED or not results["documents"] or not results["documents"][0]:
+        return None
+    similarities = [distance_to_similarity(distance) for distance in results["distances"][0]]
+    if not confident(similarities, thresholds):
+        return None
+    return extract_span(question_embedding, results["documents"][0][0], embed_many)
+
+
+# Function to count an answer and its latency under the path that produced it ("extractive" or "llm")
+def record_answer(path, seconds):
+    ANSWER_COUNTS[path].inc()
+    ANSWER_SECONDS[path].observe(seconds)
+
+
+# Function to report the share of answers served by the fast path and the time it saved
+def fast_path_report():
+    counts = {path: counter.value for path, counter in ANSWER_COUNTS.items()}
+    total = sum(counts.values())
+    means = {}
+    for path, histogram in ANSWER_SECONDS.items():
+        histogram.fold()
+        means[path] = histogram.sum / histogram.count if histogram.count else None
+    report = {"answers": total, "fast_path_share": counts["extractive"] / total if total else 0.0,
+              "mean_seconds": means, "saved_seconds": None}
+    if means["extractive"] is not None and means["llm"] is not None:
+        report["saved_seconds"] = counts["extractive"] * (means["llm"] - means["extractive"])
+    return report
+
+
+def describe_fast_path():
+    report = fast_path_report()
+    if not report["answers"]:
+        return "Fast path: no answers yet"
+    text = f"Fast path: {report['fast_path_share']:.0%} of {report['answers']} answers served without the LLM"
+    if report["saved_seconds"] is not None:
+        text += (f" ({report['mean_seconds']['extractive'] * 1000:.0f} ms vs {report['mean_seconds']['llm']:.1f}s with the LLM,"
+                 f" ~{report['saved_seconds']:.0f}s saved)")
+    return text
+
+
+# Function to run the LLM rephrasing of a fast answer in a thread; on_done gets the polished text,
+# or the exception when generation fails, so whoever waits for it always hears back
+def polish_in_background(generate, on_done):
+    def run():
+        try:
+            result = generate()
+        except Exception as e:
+            result = e
+        on_done(result)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+# Function to find the loosest thresholds that keep top-1 precision at the target, from
+# (top similarity, gap to the second hit, whether the top hit was right) per question
+def calibrate(samples, target_precision=TARGET_PRECISION):
+    best = None
+    for min_similarity in np.arange(0.40, 0.96, 0.01):
+        for min_gap in np.arange(0.0, 0.21, 0.01):
+            accepted = [correct for similarity, gap, correct in samples if similarity >= min_similarity and gap >= min_gap]
+            if len(accepted) < MIN_CALIBRATION_HITS:
+                continue
+            precision = sum(accepted) / len(accepted)
+            coverage = len(accepted) / len(samples)
+            if precision >= target_precision and (best is None or coverage > best["coverage"]):
+                best = {"min_similarity": round(float(min_similarity), 2), "min_gap": round(float(min_gap), 2),
+                        "precision": precision, "coverage": coverage}
+    return best
+
+
+# Function to load calibration questions: JSONL with "question" and "expected" (text the right chunk
+# contains). Without a file, the documents' own questions are used, which overstates confidence
+def calibration_questions(path, chunks, document_questions, document_relevant):
+    if not path:
+        return document_questions, document_relevant
+    questions, relevant = [], []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                questions.append(item["question"])
+                relevant.append({chunk["id"] for chunk in chunks if item["expected"] in chunk["text"]})
+    return questions, relevant
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the extractive fast path's confidence thresholds for an embedding model")
+    parser.add_argument("docs", nargs="*", default=["./test_data/Salesforce ASA FAQ.txt", "./test_data/Salesforce Data Cloud Sandbox FAQ.txt"])
+    parser.add_argument("--model", default="all-mpnet-base-v2")
+    parser.add_argument("--questions", default=None, help='JSONL with {"question": ..., "expected": text the right chunk contains}')
+    parser.add_argument("--target-precision", type=float, default=TARGET_PRECISION)
+    parser.add_argument("--show", action="store_true", help="Print the thresholds in use for --model and exit")
+    args = parser.parse_args()
+    if args.show:
+        print(json.dumps(load_thresholds(args.model)))
+        sys.exit(0)
+
+    import chromadb
+    from embeddings import load_embedder
+    from retrieval import benchmark_questions
+    paths = [path for path in args.docs if os.path.exists(path)]
+    if not paths:
+        parser.error("none of the documents exist")
+    embedder = load_embedder(args.model)
+    chunks, document_questions, document_relevant = benchmark_questions(paths)
+    questions, relevant = calibration_questions(args.questions, chunks, document_questions, document_relevant)
+    collection = chromadb.Client().get_or_create_collection(name="fast_path_calibration")
+    collection.upsert(ids=[chunk["id"] for chunk in chunks], documents=[chunk["text"] for chunk in chunks],
+                      embeddings=np.asarray(embedder.encode([chunk["text"] for chunk in chunks], convert_to_numpy=True)).tolist(),
+                      metadatas=[{"source": chunk["source"]} for chunk in chunks])
+    question_embeddings = np.asarray(embedder.encode(questions, convert_to_numpy=True)).tolist()
+    results = collection.query(query_embeddings=question_embeddings, n_results=2)
+    samples = []
+    for ids, distances, expected in zip(results["ids"], results["distances"], relevant):
+        similarities = [distance_to_similarity(distance) for distance in distances]
+        gap = similarities[0] - similarities[1] if len(similarities) > 1 else 1.0
+        samples.append((similarities[0], gap, bool(ids) and ids[0] in expected))
+    thresholds = calibrate(samples, args.target_precision)
+    if thresholds is None:
+        print(f"No thresholds reach {args.target_precision:.0%} precision on {len(samples)} questions; keeping {json.dumps(load_thresholds(args.model))}")
+        sys.exit(1)
+    # Time the fast path itself (span extraction included) on the accepted questions
+    timings = []
+    for question_embedding, ids, distances, documents in zip(question_embeddings, results["ids"], results["distances"], results["documents"]):
+        start_time = time.perf_counter()
+        if fast_answer(question_embedding, {"documents": [documents], "distances": [distances]}, lambda texts: embedder.encode(texts, convert_to_numpy=True), thresholds) is not None:
+            timings.append(time.perf_counter() - start_time)
+    thresholds.update({"questions": len(samples), "calibrated_at": time.strftime("%Y-%m-%d %H:%M:%S")})
+    save_thresholds(args.model, thresholds)
+    print(f"{args.model}: min_similarity {thresholds['min_similarity']}, min_gap {thresholds['min_gap']} -> "
+          f"{thresholds['coverage']:.0%} of {len(samples)} questions answered without the LLM at {thresholds['precision']:.0%} precision"
+          f" (span extraction {np.mean(timings) * 1000 if timings else 0:.1f} ms); saved to {THRESHOLDS_PATH}")
+    if not args.questions:
+        print("Calibrated on the documents' own questions; pass --questions with real user phrasings for realistic thresholds")
@@ -0,0 +1,148 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import numpy as np
+from metrics import REGISTRY, STAGE_SECONDS
+from utils import percentile
+
+# Set MISTRAL_FAQ_SEMANTIC=0 to match FAQ questions by word overlap only
+SEMANTIC_ENABLED = os.environ.get("MISTRAL_FAQ_SEMANTIC", "1") != "0"
+# Small model: FAQ questions are short, and the whole semantic stage has to stay in the low milliseconds
+SEMANTIC_MODEL = os.environ.get("MISTRAL_FAQ_EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+# A paraphrase is accepted when its cosine similarity to an FAQ question reaches this and it is
+# SEMANTIC_MARGIN ahead of the next FAQ (two FAQs about the same thing are not a confident match)
+SEMANTIC_THRESHOLD = float(os.environ.get("MISTRAL_FAQ_SEMANTIC_THRESHOLD", "0.6"))
+SEMANTIC_MARGIN = float(os.environ.get("MISTRAL_FAQ_SEMANTIC_MARGIN", "0.03"))
+
+FAQ_STAGES = REGISTRY.counter("faq_match_stage_total", "FAQ questions by the matcher stage that decided them", ("stage",))
+STAGE_COUNTS = {stage: FAQ_STAGES.labels(stage) for stage in ("lexical", "semantic", "none")}
+SEMANTIC_SECONDS = STAGE_SECONDS.labels("faq_semantic")
+
+
+# FAQ questions embedded once at startup, normalized and stacked in one float32 matrix, so scoring a
+# question against every FAQ is one embedding call and one matrix-vector product
+class SemanticFaqIndex:
+    def __init__(self, questions, embedder, threshold=SEMANTIC_THRESHOLD, margin=SEMANTIC_MARGIN):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.margin = margin
+        matrix = np.asarray(embedder.encode(questions, convert_to_numpy=True), dtype=np.float32)
+        self.matrix = matrix / np.clip(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12, None)
+
+    def similarities(self, question):
+        vector = np.asarray(self.embedder.encode(question, convert_to_numpy=True), dtype=np.float32)
+        return self.matrix @ (vector / max(float(np.linalg.norm(vector)), 1e-12))
+
+    # Function to find the FAQ a question paraphrases; returns (index or None, similarity, gap to the runner-up)
+    def match(self, question):
+        start_time = time.perf_counter()
+        similarities = self.similarities(question)
+        if len(similarities) > 1:
+            second, best = np.argpartition(similarities, -2)[-2:]
+            gap = float(similarities[best] - similarities[second])
+        else:
+            best, gap = 0, 1.0
+        similarity = float(similarities[best])
+        SEMANTIC_SECONDS.observe(time.perf_counter() - start_time)
+        if similarity >= self.threshold and gap >= self.margin:
+            return int(best), similarity, gap
+        return None, similarity, gap
+
+
+# Function to build the semantic stage for parsed FAQ pairs; None (word overlap only) when it is
+# turned off or the embedding model cannot be loaded
+def load_semantic_index(faq_pairs, clean_question, model_name=SEMANTIC_MODEL):
+    if not SEMANTIC_ENABLED or not faq_pairs:
+        return None
+    try:
+        from embeddings import load_embedder
+        start_time = time.perf_counter()
+        index = SemanticFaqIndex([clean_question(question) for question, _ in faq_pairs], load_embedder(model_name))
+        logging.info("Embedded %d FAQ questions with %s in %.1fs", len(faq_pairs), model_name, time.perf_counter() - start_time)
+        return index
+    except Exception as e:
+        logging.warning("Semantic FAQ matching unavailable (%s); using word overlap only", e)
+        return None
+
+
+# Function to count which stage decided a question ("lexical", "semantic" or "none")
+def record_stage(stage):
+    STAGE_COUNTS[stage].inc()
+
+
+# Function to load benchmark questions: JSONL with "question" and "expected" (the FAQ's number, or
+# null when it should be escalated). Without a file, the FAQ questions themselves are used
+def load_labelled_questions(path, faq_pairs):
+    if not path:
+        return [(question.split('. ', 1)[-1], question.split('.', 1)[0]) for question, _ in faq_pairs]
+    labelled = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                expected = item.get("expected")
+                labelled.append((item["question"], str(expected) if expected is not None else None))
+    return labelled
+
+
+# Function to compare word overlap alone with the lexical-then-semantic cascade on one assistant:
+# how many questions each answers, how many of those answers are right, and what the semantic stage costs
+def benchmark(module_name, faq_file, questions_path):
+    module = __import__(module_name)
+    if faq_file and os.path.exists(faq_file):
+        with open(faq_file, "r", encoding="utf-8") as f:
+            faq_text = f.read()
+    else:
+        from log_pipeline import synthetic_faq
+        faq_text = synthetic_faq(80)
+    module.faq_pairs[:] = module.parse_faq(faq_text)
+    numbers = [question.split('.', 1)[0] for question, _ in module.faq_pairs]
+    index = load_semantic_index(module.faq_pairs, module.clean_faq_question)
+    if index is None:
+        print("Semantic stage unavailable; nothing to compare")
+        return None
+    labelled = load_labelled_questions(questions_path, module.faq_pairs)
+    threshold = module.CONFIDENCE_THRESHOLD
+    results = {"lexical": {"answered": 0, "correct": 0}, "cascade": {"answered": 0, "correct": 0}}
+    lexical_times, semantic_times = [], []
+    for question, expected in labelled:
+        start_time = time.perf_counter()
+        answer, score = module.query_faq(question)
+        lexical_times.append(time.perf_counter() - start_time)
+        if score >= threshold and answer:
+            chosen = numbers[[pair[1] for pair in module.faq_pairs].index(answer)]
+            for name in results:
+                results[name]["answered"] += 1
+                results[name]["correct"] += chosen == expected
+            continue
+        start_time = time.perf_counter()
+        best, similarity, gap = index.match(question)
+        semantic_times.append(time.perf_counter() - start_time)
+        if best is not None:
+            results["cascade"]["answered"] += 1
+            results["cascade"]["correct"] += numbers[best] == expected
+    print(f"{module_name}: {len(module.faq_pairs)} FAQs, {len(labelled)} questions, word-overlap threshold {threshold}")
+    for name, result in results.items():
+        precision = result["correct"] / result["answered"] if result["answered"] else 0.0
+        print(f"  {name:8s} answered {result['answered'] / len(labelled):6.1%}  escalated {1 - result['answered'] / len(labelled):6.1%}  correct when answered {precision:6.1%}")
+    print(f"  lexical stage p50 {percentile(lexical_times, 50) * 1000:.3f} ms; semantic stage ran for {len(semantic_times)} questions"
+          + (f", p50 {percentile(semantic_times, 50) * 1000:.2f} ms  p95 {percentile(semantic_times, 95) * 1000:.2f} ms" if semantic_times else ""))
+    if not questions_path:
+        print("Benchmarked on the FAQ's own questions; pass --questions with real phrasings to measure escalations")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare word-overlap FAQ matching with the lexical-then-semantic cascade")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--module", choices=["chase_assistant", "mistral_chase_assistant"], default="chase_assistant")
+    parser.add_argument("--faq-file", default="./Chase_FAQ/Chase Banking FAQ.txt", help="FAQ to match against (a synthetic one is used if missing)")
+    parser.add_argument("--questions", default=None, help='JSONL with {"question": ..., "expected": FAQ number or null}')
+    args = parser.parse_args()
+    if not args.benchmark:
+        parser.print_help()
+        sys.exit(0)
+    benchmark(args.module, args.faq_file, args.questions)
@@ -0,0 +1,379 @@
+import argparse
+import codecs
+import os
+import threading
+import time
+import zlib
+from prompt_templates import TEMPLATES, EXAMPLE_SUFFIXES
+
+# Sampling defaults (same as ctransformers' own defaults)
+DEFAULT_PARAMS = {
+    "max_new_tokens": 256,
+    "temperature": 0.8,
+    "top_p": 0.95,
+    "top_k": 40,
+    "repetition_penalty": 1.1,
+    "seed": -1,
+    "stop": None
+}
+
+# Fixed sampling for timing runs, so they are comparable
+BENCH_PARAMS = {"temperature": 0.8, "top_p": 0.9, "seed": 42}
+
+
+# ctransformers model wrapper; it cannot snapshot its KV cache
+class CTransformersBackend:
+    name = "ctransformers"
+    supports_state = False
+
+    def __init__(self, llm, context_length):
+        self.llm = llm
+        self.context_length = context_length
+
+    def tokenize(self, text, add_bos=True):
+        return self.llm.tokenize(text)
+
+    def detokenize(self, tokens):
+        return self.llm.detokenize(tokens, decode=False)
+
+    def reset(self):
+        self.llm.reset()
+
+    def eval(self, tokens):
+        self.llm.eval(tokens)
+
+    def sample(self, temperature, top_p, top_k, repetition_penalty, seed):
+        return self.llm.sample(top_k=top_k, top_p=top_p, temperature=temperature, repetition_penalty=repetition_penalty, seed=seed)
+
+    def is_eos(self, token):
+        return self.llm.is_eos_token(token)
+
+    # Thread count for the next evals; ctransformers reads it from the config on every eval
+    def set_threads(self, threads):
+        self.llm.config.threads = threads
+
+
+# llama-cpp-python model wrapper; supports saving and restoring the KV cache
+class LlamaCppBackend:
+    name = "llama_cpp"
+    supports_state = True
+
+    def __init__(self, llm, context_length):
+        self.llm = llm
+        self.context_length = context_length
+
+    def tokenize(self, text, add_bos=True):
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=add_bos)
+
+    def detokenize(self, tokens):
+        return self.llm.detokenize(tokens)
+
+    def reset(self):
+        self.llm.reset()
+
+    def eval(self, tokens):
+        self.llm.eval(tokens)
+
+    def sample(self, temperature, top_p, top_k, repetition_penalty, seed):
+        if seed is not None and seed >= 0:
+            self.llm.set_seed(seed)
+        return self.llm.sample(top_k=top_k, top_p=top_p, min_p=0.0, temp=temperature, repeat_penalty=repetition_penalty)
+
+    def is_eos(self, token):
+        return token == self.llm.token_eos()
+
+    def save_state(self):
+        return self.llm.save_state()
+
+    def load_state(self, state):
+        self.llm.load_state(state)
+
+    # Thread count for the next evals, changed on the live context (prompt batches keep their own count)
+    def set_threads(self, threads):
+        import llama_cpp
+        wrapper = getattr(self.llm, "_ctx", None)
+        pointer = getattr(wrapper, "ctx", None) if wrapper is not None else getattr(self.llm, "ctx", None)
+        if not pointer or not hasattr(llama_cpp, "llama_set_n_threads"):
+            raise RuntimeError("This llama-cpp-python release cannot change the thread count of a loaded model")
+        llama_cpp.llama_set_n_threads(pointer, threads, getattr(self.llm, "n_threads_batch", threads))
+        self.llm.n_threads = threads
+
+    # Raw llama_model pointer, for extra contexts that share the loaded weights (batch decoding).
+    # llama-cpp-python keeps it on a private wrapper whose layout has changed between releases
+    def model_pointer(self):
+        wrapper = getattr(self.llm, "_model", None)
+        pointer = getattr(wrapper, "model", None) if wrapper is not None else getattr(self.llm, "model", None)
+        if not pointer:
+            raise RuntimeError("This llama-cpp-python release does not expose the loaded model to other contexts")
+        return pointer
+
+
+# Deterministic stand-in model for benchmark plumbing and CI runs without a model file;
+# each evaluated token costs a fixed amount of CPU work instead of a forward pass
+class StandInBackend:
+    name = "stand_in"
+    supports_state = True
+    vocabulary = ("the sea keeper light ship storm gull harbor night wave quiet old map star wind home "
+                  "answer account sandbox feature enable setup question friendly thank you").split()
+    eos_token = 2
+
+    def __init__(self, context_length, work_per_token=20000):
+        self.context_length = context_length
+        self.work_per_token = work_per_token
+        self.threads = None
+        self.tokens = []
+
+    def tokenize(self, text, add_bos=True):
+        tokens = [zlib.crc32(word.encode("utf-8")) % len(self.vocabulary) + 3 for word in text.split()]
+        return [1] + tokens if add_bos else tokens
+
+    def detokenize(self, tokens):
+        return "".join(" " + self.vocabulary[token - 3] for token in tokens if token >= 3).encode("utf-8")
+
+    def reset(self):
+        self.tokens = []
+
+    def eval(self, tokens):
+        state = len(self.tokens)
+        for _ in range(self.work_per_token * len(tokens)):
+            state = (state * 1103515245 + 12345) & 0x7fffffff
+        self.tokens.extend(tokens)
+
+    def sample(self, temperature, top_p, top_k, repetition_penalty, seed):
+        return (sum(self.tokens[-4:]) * 31 + len(self.tokens)) % len(self.vocabulary) + 3
+
+    def is_eos(self, token):
+        return token == self.eos_token
+
+    def save_state(self):
+        return list(self.tokens)
+
+    def load_state(self, state):
+        self.tokens = list(state)
+
+    def set_threads(self, threads):
+        self.threads = threads
+
+
+# Function to load the model, preferring llama-cpp-python (KV snapshots) over ctransformers;
+# threads and batch_size of None keep the library defaults
+def load_backend(model_path, context_length, backend=None, threads=None, batch_size=None):
+    backend = backend or os.environ.get("MISTRAL_BACKEND")
+    if backend == "stand_in":
+        return StandInBackend(context_length)
+    if backend in (None, "llama_cpp"):
+        try:
+            from llama_cpp import Llama
+        except ImportError:
+            if backend == "llama_cpp":
+                raise
+        else:
+            settings = {"n_threads": threads, "n_batch": batch_size}
+            # Memory-mapped weights stay in the page cache after an unload, so reloading is cheap
+            llm = Llama(model_path=model_path, n_ctx=context_length, n_gpu_layers=0, verbose=False, use_mmap=True,
+                        **{key: value for key, value in settings.items() if value is not None})
+            return LlamaCppBackend(llm, context_length)
+    from ctransformers import AutoModelForCausalLM
+    settings = {"threads": threads, "batch_size": batch_size}
+    llm = AutoModelForCausalLM.from_pretrained(model_path, model_type="mistral", gpu_layers=0, context_length=context_length, mmap=True,
+                                               **{key: value for key, value in settings.items() if value is not None})
+    return CTransformersBackend(llm, context_length)
+
+
+# Caches the evaluated KV state of registered prompt prefixes
+class PrefixCache:
+    def __init__(self, templates=None, enabled=True):
+        self.templates = dict(templates or {})
+        self.enabled = enabled
+        self.states = {}
+        self.lock = threading.Lock()
+        self.ttft = {}
+
+    def register(self, name, prefix):
+        with self.lock:
+            self.templates[name] = prefix
+            self.states.pop(name, None)
+
+    # Drops the cached states, which belong to the model context they were taken from
+    def clear(self):
+        with self.lock:
+            self.states.clear()
+
+    def match(self, prompt):
+        best = None
+        for name, prefix in self.templates.items():
+            if prompt.startswith(prefix) and (best is None or len(prefix) > len(self.templates[best])):
+                best = name
+        return best
+
+    # Loads the model context with the prompt, evaluating only what the cache does not cover
+    def prepare(self, backend, prompt):
+        name = self.match(prompt)
+        if name is None or not self.enabled or not backend.supports_state:
+            backend.reset()
+            tokens = backend.tokenize(prompt)
+            backend.eval(tokens)
+            return name, False, len(tokens)
+        prefix = self.templates[name]
+        state = self.states.get(name)
+        if state is None:
+            backend.reset()
+            prefix_tokens = backend.tokenize(prefix)
+            backend.eval(prefix_tokens)
+            state = (backend.save_state(), len(prefix_tokens))
+            with self.lock:
+                self.states[name] = state
+            cached = False
+        else:
+            backend.load_state(state[0])
+            cached = True
+        suffix_tokens = backend.tokenize(prompt[len(prefix):], add_bos=False)
+        if suffix_tokens:
+            backend.eval(suffix_tokens)
+        return name, cached, state[1] + len(suffix_tokens)
+
+    def record_ttft(self, name, cached, seconds):
+        if name is None:
+            return
+        with self.lock:
+            entry = self.ttft.setdefault(name, {"cached": [0.0, 0], "uncached": [0.0, 0]})
+            bucket = entry["cached" if cached else "uncached"]
+            bucket[0] += seconds
+            bucket[1] += 1
+
+    def report(self):
+        report = {}
+        with self.lock:
+            for name in self.templates:
+                entry = self.ttft.get(name, {"cached": [0.0, 0], "uncached": [0.0, 0]})
+                cached = entry["cached"][0] / entry["cached"][1] if entry["cached"][1] else None
+                uncached = entry["uncached"][0] / entry["uncached"][1] if entry["uncached"][1] else None
+                report[name] = {
+                    "state_cached": name in self.states,
+                    "hits": entry["cached"][1],
+                    "misses": entry["uncached"][1],
+                    "ttft_cached_seconds": cached,
+                    "ttft_uncached_seconds": uncached,
+                    "speedup": uncached / cached if cached and uncached else None
+                }
+        return report
+
+
+# Function to split off text that might be the start of a stop sequence
+def split_stop_tail(text, stop):
+    for stop_text in stop:
+        index = text.find(stop_text)
+        if index != -1:
+            return text[:index], None
+    hold = 0
+    for stop_text in stop:
+        for size in range(min(len(stop_text) - 1, len(text)), 0, -1):
+            if text.endswith(stop_text[:size]):
+                hold = max(hold, size)
+                break
+    return text[:len(text) - hold], text[len(text) - hold:]
+
+
+# Function to stream completion text token by token; stops early when should_stop() is true
+def stream_completion(backend, prompt, prefix_cache=None, should_stop=None, on_first_token=None, on_token=None, **params):
+    params = {**DEFAULT_PARAMS, **{k: v for k, v in params.items() if v is not None or k == "stop"}}
+    stop = params["stop"]
+    if isinstance(stop, str):
+        stop = [stop]
+    start_time = time.time()
+    if prefix_cache is not None:
+        template, cached, n_prompt = prefix_cache.prepare(backend, prompt)
+    else:
+        template, cached = None, False
+        backend.reset()
+        prompt_tokens = backend.tokenize(prompt)
+        backend.eval(prompt_tokens)
+        n_prompt = len(prompt_tokens)
+    max_new_tokens = min(params["max_new_tokens"], max(backend.context_length - n_prompt, 0))
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    pending = ""
+    for i in range(max_new_tokens):
+        if should_stop is not None and should_stop():
+            return
+        token = backend.sample(params["temperature"], params["top_p"], params["top_k"], params["repetition_penalty"], params["seed"])
+        if i == 0:
+            ttft = time.time() - start_time
+            if prefix_cache is not None:
+                prefix_cache.record_ttft(template, cached, ttft)
+            if on_first_token is not None:
+                on_first_token(ttft)
+        if backend.is_eos(token):
+            break
+        # Yielded pieces can hold several tokens (UTF-8 and stop-sequence buffering); this sees every one
+        if on_token is not None:
+            on_token(token)
+        pending += decoder.decode(backend.detokenize([token]))
+        if stop:
+            ready, pending = split_stop_tail(pending, stop)
+            if ready:
+                yield ready
+            if pending is None:
+                return
+            pending = pending or ""
+        elif pending:
+            yield pending
+            pending = ""
+        # Re-check before paying for the next forward pass
+        if should_stop is not None and should_stop():
+            return
+        backend.eval([token])
+    if pending:
+        yield pending
+
+
+# Function to time one generation: time-to-first-token, decode speed and total latency
+def measure_once(backend, prompt, max_new_tokens, prefix_cache=None):
+    first_token = []
+    start_time = time.perf_counter()
+    tokens = 0
+    for _ in stream_completion(backend, prompt, prefix_cache=prefix_cache, on_first_token=first_token.append, max_new_tokens=max_new_tokens, **BENCH_PARAMS):
+        tokens += 1
+    latency = time.perf_counter() - start_time
+    ttft = first_token[0] if first_token else latency
+    decode_time = latency - ttft
+    return {
+        "ttft_seconds": ttft,
+        "decode_tokens_per_second": (tokens - 1) / decode_time if tokens > 1 and decode_time > 0 else None,
+        "latency_seconds": latency,
+        "tokens": tokens
+    }
+
+
+# Function to measure time-to-first-token for each template with and without the prefix cache
+def measure_template_ttft(backend, repetitions=3):
+    results = {}
+    for name, prefix in TEMPLATES.items():
+        prompt = prefix + EXAMPLE_SUFFIXES[name]
+        timings = {}
+        for label, cache in (("uncached", PrefixCache(TEMPLATES, enabled=False)), ("cached", PrefixCache(TEMPLATES))):
+            if label == "cached":
+                # Warm the cache once; the measured runs restore the saved state
+                for _ in stream_completion(backend, prompt, prefix_cache=cache, max_new_tokens=1):
+                    pass
+            samples = []
+            for _ in range(repetitions):
+                for _ in stream_completion(backend, prompt, prefix_cache=cache, max_new_tokens=1, on_first_token=samples.append):
+                    pass
+            timings[label] = sum(samples) / len(samples) if samples else None
+        results[name] = timings
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report time-to-first-token per prompt template with and without prefix caching")
+    parser.add_argument("--model", required=True, help="Path to the GGUF model file")
+    parser.add_argument("--context-length", type=int, default=2048)
+    parser.add_argument("--backend", choices=["llama_cpp", "ctransformers", "stand_in"], default=None)
+    parser.add_argument("--repetitions", type=int, default=3)
+    args = parser.parse_args()
+    backend = load_backend(args.model, args.context_length, args.backend)
+    print(f"Backend: {backend.name} (KV snapshots {'supported' if backend.supports_state else 'not supported'})")
+    for name, timings in measure_template_ttft(backend, args.repetitions).items():
+        uncached, cached = timings["uncached"], timings["cached"]
+        speedup = f"{uncached / cached:.2f}x" if uncached and cached else "n/a"
+        print(f"{name:16s} TTFT without cache: {uncached:.3f}s  with cache: {cached:.3f}s  speedup: {speedup}")
@@ -0,0 +1,246 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from metrics import REGISTRY, STAGE_SECONDS
+from profiling import span, instant
+
+# Unix socket the shared inference daemon listens on
+SOCKET_PATH = os.environ.get("MISTRAL_SOCKET", os.path.join(os.path.expanduser("~"), ".mistral_inference.sock"))
+
+# Request priorities (lower numbers are served first)
+PRIORITY_HIGH = 0     # Short FAQ rephrases and escalation messages
+PRIORITY_NORMAL = 5   # RAG answers
+PRIORITY_LOW = 10     # Long-form stories and sonnets
+PRIORITY_BACKGROUND = 20  # Conversation summaries written between turns
+
+# Loading a 7B model on CPU can take a while on first start
+STARTUP_TIMEOUT = 300
+
+# How often a blocked read wakes up to check for cancellation
+POLL_INTERVAL = 0.05
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inference_server.py")
+SERVER_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inference_server.log")
+
+# Client-side view of every LLM call this process makes
+LLM_REQUESTS = REGISTRY.counter("llm_requests_total", "LLM requests by call type and outcome", ("op", "outcome"))
+LLM_TOKENS = REGISTRY.counter("llm_stream_tokens_total", "Tokens received over streaming LLM requests").labels()
+LLM_IN_FLIGHT = REGISTRY.gauge("llm_requests_in_flight", "LLM requests waiting for or receiving a reply").labels()
+LLM_GENERATE_SECONDS = STAGE_SECONDS.labels("llm_generate")
+LLM_FIRST_TOKEN_SECONDS = STAGE_SECONDS.labels("llm_first_token")
+LLM_STREAM_SECONDS = STAGE_SECONDS.labels("llm_stream")
+LLM_TOKENIZE_SECONDS = STAGE_SECONDS.labels("llm_tokenize")
+
+
+class InferenceError(Exception):
+    pass
+
+
+class InferenceCancelled(InferenceError):
+    pass
+
+
+# Function to open a connection to the daemon socket
+def connect(socket_path=SOCKET_PATH):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+# Function to check whether a daemon is answering on the socket
+def daemon_alive(socket_path=SOCKET_PATH):
+    try:
+        sock = connect(socket_path)
+    except OSError:
+        return False
+    sock.close()
+    return True
+
+
+# Function to launch the daemon in the background and wait until it answers
+def start_daemon(socket_path=SOCKET_PATH, timeout=STARTUP_TIMEOUT):
+    with open(SERVER_LOG, "a") as log_file:
+        process = subprocess.Popen(
+            [sys.executable, SERVER_SCRIPT, "--socket", socket_path],
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            start_new_session=True
+        )
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if daemon_alive(socket_path):
+            return
+        # Another tool may have won the race; its daemon will answer shortly
+        if process.poll() not in (None, 0):
+            raise InferenceError(f"Inference daemon exited with code {process.returncode} (see {SERVER_LOG})")
+        time.sleep(0.5)
+    raise InferenceError(f"Inference daemon did not start within {timeout} seconds (see {SERVER_LOG})")
+
+
+# Function to read newline-delimited JSON messages until the server closes the stream
+def read_messages(sock, deadline=None, cancel_event=None):
+    buffer = b""
+    while True:
+        if cancel_event is not None and cancel_event.is_set():
+            raise InferenceCancelled("Inference request cancelled")
+        wait = POLL_INTERVAL if cancel_event is not None else None
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("Inference request timed out")
+            wait = min(wait, remaining) if wait is not None else remaining
+        sock.settimeout(wait)
+        try:
+            chunk = sock.recv(65536)
+        except socket.timeout:
+            continue
+        if not chunk:
+            return
+        buffer += chunk
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            if line.strip():
+                yield json.loads(line.decode("utf-8"))
+
+
+# Client for the shared inference daemon; calling it mirrors ctransformers' llm(prompt, ...)
+class InferenceClient:
+    def __init__(self, priority=PRIORITY_NORMAL, socket_path=SOCKET_PATH, autostart=True):
+        self.priority = priority
+        self.socket_path = socket_path
+        self.autostart = autostart
+
+    def __call__(self, prompt, stream=False, timeout=None, priority=None, cancel_event=None, **params):
+        if stream:
+            return self.stream(prompt, timeout=timeout, priority=priority, cancel_event=cancel_event, **params)
+        return self.generate(prompt, timeout=timeout, priority=priority, cancel_event=cancel_event, **params)
+
+    def _connect(self):
+        try:
+            return connect(self.socket_path)
+        except OSError:
+            if not self.autostart:
+                raise InferenceError(f"No inference daemon listening on {self.socket_path}")
+        start_daemon(self.socket_path)
+        return connect(self.socket_path)
+
+    # Timing out or setting cancel_event closes the socket, which stops generation in the daemon
+    def request(self, payload, timeout=None, cancel_event=None):
+        deadline = time.time() + timeout if timeout else None
+        sock = self._connect()
+        try:
+            sock.sendall((json.dumps(payload) + "\n").encode("utf-8"))
+            for message in read_messages(sock, deadline, cancel_event):
+                if "error" in message:
+                    raise InferenceError(message["error"])
+                yield message
+        finally:
+            # Closing the socket early tells the daemon to drop the request
+            sock.close()
+
+    def _job(self, op, prompt, priority, params):
+        return {
+            "op": op,
+            "id": uuid.uuid4().hex,
+            "prompt": prompt,
+            "priority": self.priority if priority is None else priority,
+            "params": params
+        }
+
+    def generate(self, prompt, timeout=None, priority=None, cancel_event=None, **params):
+        outcome = "error"
+        LLM_IN_FLIGHT.inc()
+        start_time = time.perf_counter()
+        try:
+            with span("llm_generate", prompt_chars=len(prompt), max_new_tokens=params.get("max_new_tokens")) as current:
+                for message in self.request(self._job("generate", prompt, priority, params), timeout=timeout, cancel_event=cancel_event):
+                    if "text" in message:
+                        outcome = "ok"
+                        current.set(**message.get("stats", {}))
+                        return message["text"]
+                raise InferenceError("Inference daemon closed the connection without a response")
+        except InferenceCancelled:
+            outcome = "cancelled"
+            raise
+        finally:
+            LLM_IN_FLIGHT.dec()
+            LLM_GENERATE_SECONDS.observe(time.perf_counter() - start_time)
+            LLM_REQUESTS.labels("generate", outcome).inc()
+
+    def stream(self, prompt, timeout=None, priority=None, cancel_event=None, **params):
+        # A caller that stops reading early (word limit reached) counts as "stopped"
+        outcome = "stopped"
+        tokens = 0
+        LLM_IN_FLIGHT.inc()
+        start_time = time.perf_counter()
+        try:
+            with span("llm_stream", prompt_chars=len(prompt), max_new_tokens=params.get("max_new_tokens")) as current:
+                for message in self.request(self._job("stream", prompt, priority, params), timeout=timeout, cancel_event=cancel_event):
+                    if "token" in message:
+                        if not tokens:
+                            LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start_time)
+                            instant("first_token")
+                        tokens += 1
+                        yield message["token"]
+                    elif message.get("done"):
+                        outcome = "ok"
+                        current.set(**message.get("stats", {}))
+                        return
+        except InferenceCancelled:
+            outcome = "cancelled"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            LLM_IN_FLIGHT.dec()
+            LLM_TOKENS.inc(tokens)
+            LLM_STREAM_SECONDS.observe(time.perf_counter() - start_time)
+            LLM_REQUESTS.labels("stream", outcome).inc()
+
+    def health(self, timeout=10):
+        for message in self.request({"op": "health"}, timeout=timeout):
+            return message
+        raise InferenceError("Inference daemon returned no health report")
+
+    # Loads the model if the daemon unloaded it while idle; returns as soon as it is resident
+    def load(self, timeout=STARTUP_TIMEOUT):
+        for message in self.request({"op": "load"}, timeout=timeout):
+            return message
+        raise InferenceError("Inference daemon returned no health report")
+
+    def metrics(self, timeout=10):
+        for message in self.request({"op": "metrics"}, timeout=timeout):
+            return message
+        raise InferenceError("Inference daemon returned no metrics")
+
+    # Counts tokens with the served model's own tokenizer
+    def count_tokens(self, text, timeout=30):
+        with LLM_TOKENIZE_SECONDS.time(), span("llm_tokenize", chars=len(text)):
+            for message in self.request({"op": "tokenize", "text": text}, timeout=timeout):
+                return message["count"]
+        raise InferenceError("Inference daemon returned no token count")
+
+    @property
+    def context_length(self):
+        return self.health(timeout=STARTUP_TIMEOUT)["context_length"]
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "health"
+    client = InferenceClient(autostart=False)
+    if command == "health":
+        print(json.dumps(client.health(), indent=2))
+    elif command == "metrics":
+        print(json.dumps(client.metrics(), indent=2))
+    else:
+        print("Usage: python inference_client.py [health|metrics]")
+        sys.exit(1)
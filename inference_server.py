@@ -0,0 +1,429 @@
+import argparse
+import fcntl
+import gc
+import itertools
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import socketserver
+import threading
+import time
+import psutil
+from autotune import tuned_settings
+from batch_scheduler import BatchScheduler, supports_batching, BATCH_CONTEXT_TOKENS
+from generation import load_backend, stream_completion, PrefixCache
+from inference_client import SOCKET_PATH, PRIORITY_NORMAL
+from model_registry import ModelRegistry, memory_budget_from_env, GB
+from prompt_templates import TEMPLATES
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# One context window large enough for every entry point
+CONTEXT_LENGTH = 2048
+MAX_QUEUED_JOBS = 64
+
+# The model is unloaded after this long without requests and reloaded on the next one (0 keeps it loaded)
+IDLE_UNLOAD_SECONDS = int(os.environ.get("MISTRAL_IDLE_UNLOAD_SECONDS", "900"))
+
+# Generation parameters a client may set
+ALLOWED_PARAMS = {"max_new_tokens", "temperature", "top_p", "top_k", "repetition_penalty", "seed", "stop"}
+
+
+# A queued generation request
+class Job:
+    def __init__(self, job_id, op, prompt, params, priority):
+        self.id = job_id
+        self.op = op
+        self.prompt = prompt
+        self.params = {k: v for k, v in params.items() if k in ALLOWED_PARAMS}
+        self.priority = priority
+        self.output = queue.Queue()
+        self.cancelled = threading.Event()
+        self.cancelled_at = None
+        self.tokens_after_cancel = 0
+        self.enqueued_at = time.time()
+
+    def cancel(self):
+        if not self.cancelled.is_set():
+            self.cancelled_at = time.time()
+            self.cancelled.set()
+
+    # Hands a piece of text to the connection; counts compute wasted after a cancel
+    def emit(self, text):
+        if self.cancelled.is_set():
+            self.tokens_after_cancel += 1
+        self.output.put(("token", text))
+
+
+# Owns the single model instance and serves queued jobs in priority order
+class InferenceDaemon:
+    def __init__(self, registry, context_length=CONTEXT_LENGTH, batching=True, threads=None, batch_size=None, autotune=True, idle_unload=IDLE_UNLOAD_SECONDS):
+        self.registry = registry
+        self.model_path = None
+        self.context_length = context_length
+        self.batching = batching
+        self.threads = threads
+        self.batch_size = batch_size
+        self.autotune = autotune
+        self.idle_unload = idle_unload
+        self.model = None
+        # Held while the model is loaded or unloaded
+        self.load_lock = threading.Lock()
+        # Wakes the worker when a model is loaded or a job arrives
+        self.wake = threading.Event()
+        # Asks the worker to leave its serving loop so the idle model can be unloaded
+        self.idle_stop = threading.Event()
+        self.last_activity = time.time()
+        self.loaded_at = None
+        self.scheduler = None
+        self.prefix_cache = PrefixCache(TEMPLATES)
+        self.jobs = queue.PriorityQueue(maxsize=MAX_QUEUED_JOBS)
+        self.sequence = itertools.count()
+        self.current_job = None
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests_total": 0,
+            "requests_completed": 0,
+            "requests_cancelled": 0,
+            "requests_rejected": 0,
+            "requests_failed": 0,
+            "tokens_generated": 0,
+            "tokens_after_cancel": 0,
+            "cancel_to_stop_seconds_max": 0.0,
+            "queue_wait_seconds_total": 0.0,
+            "generation_seconds_total": 0.0,
+            "model_load_seconds": 0.0,
+            "model_loads": 0,
+            "model_unloads": 0,
+            "model_resident_seconds": 0.0
+        }
+
+    # Returns the loaded model, loading it first if it was never loaded or was unloaded while idle
+    def load(self):
+        with self.load_lock:
+            self.last_activity = time.time()
+            if self.model is not None:
+                return self.model
+            if self.model_path is None:
+                # The variant is chosen once; reloads after an idle unload use the same file
+                self.model_path = self.registry.select()["path"]
+                logging.info(f"Selected {self.model_path}: {self.registry.reason}")
+            # Settings given on the command line win; otherwise use the ones calibrated for this host
+            if self.autotune and self.threads is None and self.batch_size is None:
+                self.threads, self.batch_size = tuned_settings(self.model_path, self.context_length, log=logging.info)
+            start_time = time.time()
+            model = load_backend(self.model_path, self.context_length, threads=self.threads, batch_size=self.batch_size)
+            if self.batching and supports_batching(model):
+                self.scheduler = BatchScheduler(model, self.jobs, self.finish_job, prefix_cache=self.prefix_cache)
+            self.model = model
+            self.loaded_at = time.time()
+            self.stats["model_load_seconds"] = self.loaded_at - start_time
+            self.stats["model_loads"] += 1
+            logging.info(f"Loaded {self.model_path} with {model.name} in {self.stats['model_load_seconds']:.1f}s (context length {self.context_length}, threads {self.threads or 'default'}, batch size {self.batch_size or 'default'})")
+        self.wake.set()
+        return model
+
+    def is_idle(self):
+        busy = self.current_job is not None or bool(self.scheduler and (self.scheduler.active or self.scheduler.waiting))
+        return self.idle_unload > 0 and not busy and self.jobs.empty() and time.time() - self.last_activity > self.idle_unload
+
+    # Frees the model's memory; the file stays memory-mapped in the page cache, so reloading is cheap
+    def unload(self):
+        with self.load_lock:
+            if self.model is None or not self.is_idle():
+                return False
+            # The batch context is a raw llama.cpp allocation (its own KV cache) that garbage
+            # collection never frees, and it points at the model's weights: free it first
+            if self.scheduler is not None:
+                self.scheduler.close()
+                self.scheduler = None
+            self.model = None
+            # Cached prefix KV states belong to the unloaded context
+            self.prefix_cache.clear()
+            gc.collect()
+            self.stats["model_unloads"] += 1
+            self.stats["model_resident_seconds"] += time.time() - self.loaded_at
+            self.loaded_at = None
+        logging.info(f"Unloaded the model after {self.idle_unload}s without requests")
+        return True
+
+    # Watches for idle periods and stops the serving loop so the worker can unload the model
+    def run_idle_watch(self):
+        while True:
+            time.sleep(min(max(self.idle_unload / 10, 1), 30))
+            if self.model is not None and self.is_idle():
+                self.idle_stop.set()
+
+    def submit(self, job):
+        with self.lock:
+            self.stats["requests_total"] += 1
+        try:
+            self.jobs.put_nowait((job.priority, next(self.sequence), job))
+        except queue.Full:
+            with self.lock:
+                self.stats["requests_rejected"] += 1
+            raise
+        self.last_activity = time.time()
+        self.wake.set()
+
+    def run_worker(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            if self.model is None:
+                if self.jobs.empty():
+                    continue
+                self.load()
+            self.idle_stop.clear()
+            if self.scheduler is not None:
+                self.scheduler.run(stop_event=self.idle_stop)
+            else:
+                self.run_serial()
+            # A request that slipped in after the idle check keeps the model loaded
+            if not self.unload():
+                self.wake.set()
+
+    def run_serial(self):
+        while not self.idle_stop.is_set():
+            try:
+                _, _, job = self.jobs.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if job.cancelled.is_set():
+                self.finish_job(job, 0, time.time(), cancelled=True)
+                continue
+            self.current_job = job
+            try:
+                self.run_job(job)
+            finally:
+                self.current_job = None
+
+    # Serial path: one request at a time through the single model context
+    def run_job(self, job):
+        start_time = time.time()
+        tokens = 0
+        try:
+            for token in stream_completion(self.model, job.prompt, prefix_cache=self.prefix_cache, should_stop=job.cancelled.is_set, **job.params):
+                tokens += 1
+                job.emit(token)
+        except Exception as e:
+            logging.error(f"Job {job.id} failed: {str(e)}")
+            job.output.put(("error", f"Model inference failed: {str(e)}"))
+            self.finish_job(job, tokens, start_time, failed=True)
+            return
+        self.finish_job(job, tokens, start_time, cancelled=job.cancelled.is_set())
+
+    def finish_job(self, job, tokens, start_time, cancelled=False, failed=False, ttft=None):
+        elapsed = time.time() - start_time
+        self.last_activity = time.time()
+        with self.lock:
+            self.stats["tokens_generated"] += tokens
+            self.stats["queue_wait_seconds_total"] += max(start_time - job.enqueued_at, 0.0)
+            self.stats["generation_seconds_total"] += elapsed
+            if failed:
+                self.stats["requests_failed"] += 1
+            elif cancelled:
+                self.stats["requests_cancelled"] += 1
+            else:
+                self.stats["requests_completed"] += 1
+            if job.cancelled_at is not None:
+                self.stats["tokens_after_cancel"] += job.tokens_after_cancel
+                self.stats["cancel_to_stop_seconds_max"] = max(self.stats["cancel_to_stop_seconds_max"], time.time() - job.cancelled_at)
+        if not failed:
+            job.output.put(("done", {
+                "tokens": tokens,
+                "queue_wait": max(start_time - job.enqueued_at, 0.0),
+                "generation_time": elapsed,
+                "ttft": ttft
+            }))
+
+    def health(self):
+        return {
+            "status": "ok" if self.model is not None else ("idle" if self.model_path else "loading"),
+            "model_loaded": self.model is not None,
+            "model_path": self.model_path,
+            "model": self.registry.report(),
+            "idle_unload_seconds": self.idle_unload,
+            "backend": self.model.name if self.model is not None else None,
+            "context_length": self.context_length,
+            "threads": self.threads,
+            "batch_size": self.batch_size,
+            "queue_depth": self.jobs.qsize(),
+            "busy": self.current_job is not None or bool(self.scheduler and self.scheduler.active),
+            "scheduler": "continuous_batching" if self.scheduler is not None else "serial",
+            "uptime_seconds": time.time() - self.started_at,
+            "pid": os.getpid()
+        }
+
+    def metrics(self):
+        with self.lock:
+            metrics = dict(self.stats)
+        completed = metrics["requests_completed"] + metrics["requests_cancelled"]
+        metrics["queue_depth"] = self.jobs.qsize()
+        if self.scheduler is not None:
+            metrics["in_flight"] = len(self.scheduler.active)
+            metrics["batching"] = self.scheduler.stats()
+        else:
+            metrics["in_flight"] = 1 if self.current_job is not None else 0
+        metrics["tokens_per_second"] = metrics["tokens_generated"] / metrics["generation_seconds_total"] if metrics["generation_seconds_total"] else 0.0
+        metrics["avg_queue_wait_seconds"] = metrics["queue_wait_seconds_total"] / completed if completed else 0.0
+        metrics["rss_bytes"] = psutil.Process().memory_info().rss
+        if self.loaded_at is not None:
+            metrics["model_resident_seconds"] += time.time() - self.loaded_at
+        metrics["model_resident_share"] = metrics["model_resident_seconds"] / (time.time() - self.started_at)
+        metrics["prefix_cache"] = self.prefix_cache.report()
+        return metrics
+
+
+# Handles one request per connection: newline-delimited JSON in, JSON lines out
+class RequestHandler(socketserver.StreamRequestHandler):
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        daemon = self.server.inference
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line.decode("utf-8"))
+        except ValueError:
+            self.send({"error": "Malformed request"})
+            return
+        op = request.get("op")
+        if op == "health":
+            self.send(daemon.health())
+        elif op == "metrics":
+            self.send(daemon.metrics())
+        elif op == "load":
+            # Lets clients with tight generation timeouts wait out a reload first
+            daemon.load()
+            self.send(daemon.health())
+        elif op == "tokenize":
+            self.send({"count": len(daemon.load().tokenize(request.get("text", "")))})
+        elif op in ("generate", "stream"):
+            self.handle_generation(daemon, request)
+        else:
+            self.send({"error": f"Unknown op: {op}"})
+
+    def handle_generation(self, daemon, request):
+        # Reloads the model if it was unloaded while idle
+        model = daemon.load()
+        # Reject prompts that leave no room to generate; nothing may run past the context window
+        n_prompt = len(model.tokenize(request.get("prompt", "")))
+        if n_prompt >= daemon.context_length:
+            self.send({"error": f"Prompt is {n_prompt} tokens; the context window is {daemon.context_length} tokens"})
+            return
+        job = Job(
+            request.get("id", ""),
+            request["op"],
+            request.get("prompt", ""),
+            request.get("params", {}),
+            request.get("priority", PRIORITY_NORMAL)
+        )
+        try:
+            daemon.submit(job)
+        except queue.Full:
+            self.send({"error": "Inference queue is full, try again later"})
+            return
+        pieces = []
+        try:
+            while True:
+                try:
+                    kind, value = job.output.get(timeout=0.05)
+                except queue.Empty:
+                    kind, value = None, None
+                if kind != "token" or job.op == "generate":
+                    # Nothing is written back until the end of a generate call, so poll for hang-ups
+                    if self.client_closed():
+                        job.cancel()
+                        return
+                if kind is None:
+                    continue
+                if kind == "token":
+                    if job.op == "stream":
+                        self.send({"token": value})
+                    else:
+                        pieces.append(value)
+                elif kind == "error":
+                    self.send({"error": value})
+                    return
+                else:
+                    if job.op == "generate":
+                        self.send({"text": "".join(pieces), "stats": value})
+                    self.send({"done": True, "stats": value})
+                    return
+        except OSError:
+            # Client went away; stop spending CPU on its tokens
+            job.cancel()
+
+    # A readable socket with no data means the client hung up (cancel or timeout)
+    def client_closed(self):
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self.connection.recv(1, socket.MSG_PEEK) == b""
+        except OSError:
+            return True
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+# Function to run the daemon until interrupted
+def serve(socket_path=SOCKET_PATH, model_path=None, context_length=CONTEXT_LENGTH, batching=True, threads=None, batch_size=None, autotune=True,
+          memory_budget=None, idle_unload=IDLE_UNLOAD_SECONDS):
+    # Only one daemon per socket; a second launch exits quietly
+    lock_file = open(socket_path + ".lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        logging.info(f"Another inference daemon already owns {socket_path}")
+        return
+    # With batching on, the batch decoder's KV cache counts against the memory budget too
+    batch_context_length = max(BATCH_CONTEXT_TOKENS, context_length) if batching else 0
+    registry = ModelRegistry(context_length, memory_budget, pinned_path=model_path or os.environ.get("MISTRAL_MODEL_PATH"),
+                             batch_context_length=batch_context_length)
+    daemon = InferenceDaemon(registry, context_length, batching, threads, batch_size, autotune, idle_unload)
+    daemon.load()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = UnixServer(socket_path, RequestHandler)
+    server.inference = daemon
+    os.chmod(socket_path, 0o600)
+    threading.Thread(target=daemon.run_worker, daemon=True).start()
+    if idle_unload > 0:
+        threading.Thread(target=daemon.run_idle_watch, daemon=True).start()
+    logging.info(f"Inference daemon listening on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared local Mistral 7B inference daemon")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="Unix socket path to listen on")
+    parser.add_argument("--model", default=None, help="Path to the GGUF model file (default: best variant that fits in memory)")
+    parser.add_argument("--memory-budget-gb", type=float, default=None, help="Most memory the model may use (default: MISTRAL_MEMORY_BUDGET_GB)")
+    parser.add_argument("--idle-unload", type=int, default=IDLE_UNLOAD_SECONDS, help="Unload the model after this many idle seconds (0 keeps it loaded)")
+    parser.add_argument("--context-length", type=int, default=CONTEXT_LENGTH)
+    parser.add_argument("--no-batching", action="store_true", help="Serve one request at a time instead of continuous batching")
+    parser.add_argument("--threads", type=int, default=None, help="Inference threads (default: autotuned for this host)")
+    parser.add_argument("--batch-size", type=int, default=None, help="Prompt batch size (default: autotuned for this host)")
+    parser.add_argument("--no-autotune", action="store_true", help="Use the library defaults instead of calibrated settings")
+    args = parser.parse_args()
+    memory_budget = args.memory_budget_gb * GB if args.memory_budget_gb else memory_budget_from_env()
+    serve(args.socket, args.model, args.context_length, not args.no_batching, args.threads, args.batch_size, not args.no_autotune,
+          memory_budget, args.idle_unload)
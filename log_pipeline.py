@@ -0,0 +1,291 @@
+import argparse
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from metrics import REGISTRY
+from utils import percentile
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+# "async" (default): records are queued and written by a background thread;
+# "sync": written on the calling thread; "off": warnings and errors only
+LOG_MODE = os.environ.get("MISTRAL_LOG_MODE", "async")
+LOG_LEVEL = os.environ.get("MISTRAL_LOG_LEVEL", "DEBUG")
+# Size-based rotation: chase_assistant.log, chase_assistant.log.1, ... chase_assistant.log.N
+LOG_MAX_BYTES = int(float(os.environ.get("MISTRAL_LOG_MAX_MB", "10")) * 1024 * 1024)
+LOG_BACKUPS = int(os.environ.get("MISTRAL_LOG_BACKUPS", "5"))
+# Records waiting for the writer; when it falls this far behind, new records are dropped (and counted)
+# instead of making a query wait for the disk
+LOG_QUEUE_SIZE = 10000
+
+# Per-category sampling: (share of records kept, most records kept per second, 0 = no limit).
+# Override with e.g. MISTRAL_LOG_SAMPLING="faq.compare=1:0,faq.dump=1"
+CATEGORY_POLICIES = {
+    "faq.compare": (0.05, 100),
+    "faq.match": (1.0, 50),
+    "faq.dump": (0.0, 0),
+    "llm.response": (1.0, 20)
+}
+DEFAULT_POLICY = (1.0, 0)
+# How often a category reports the records its rate limit dropped
+SUPPRESSED_REPORT_SECONDS = 60
+
+QUEUE_DROPS = REGISTRY.counter("log_records_dropped_total", "Log records dropped because the background writer's queue was full").labels()
+
+categories = {}
+categories_lock = threading.Lock()
+listener = None
+queue_handler = None
+file_handler = None
+
+
+# Function to read "category=share[:per_second],..." overrides
+def parse_sampling(text):
+    policies = {}
+    for item in (text or "").split(","):
+        if "=" not in item:
+            continue
+        category, policy = item.split("=", 1)
+        share, _, per_second = policy.partition(":")
+        policies[category.strip()] = (float(share), float(per_second) if per_second else 0)
+    return policies
+
+
+SAMPLING_OVERRIDES = parse_sampling(os.environ.get("MISTRAL_LOG_SAMPLING"))
+
+
+# A logger for one category of records that keeps only a sample of them, at most so many per second.
+# The decision is made before the record (or its message) is built, so dropped records cost almost nothing
+class SampledLogger:
+    def __init__(self, category, sample_rate, per_second):
+        self.category = category
+        self.logger = logging.getLogger(category)
+        self.sample_rate = sample_rate
+        self.per_second = per_second
+        self.tokens = per_second
+        self.refilled = time.monotonic()
+        self.reported = self.refilled
+        self.sampled_out = 0
+        self.rate_limited = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def keep(self):
+        if self.sample_rate < 1.0 and (self.sample_rate <= 0.0 or random.random() >= self.sample_rate):
+            # Not locked: an occasional lost increment only makes the count approximate
+            self.sampled_out += 1
+            return False
+        if not self.per_second:
+            return True
+        report = 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.per_second, self.tokens + (now - self.refilled) * self.per_second)
+            self.refilled = now
+            if self.tokens < 1:
+                self.rate_limited += 1
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+            if self.suppressed and now - self.reported >= SUPPRESSED_REPORT_SECONDS:
+                report, self.suppressed, self.reported = self.suppressed, 0, now
+        if report:
+            self.logger.warning("%s: %d records dropped by the %g/s rate limit", self.category, report, self.per_second)
+        return True
+
+    def debug(self, msg, *args):
+        if self.logger.isEnabledFor(logging.DEBUG) and self.keep():
+            self.logger.debug(msg, *args)
+
+    def info(self, msg, *args):
+        if self.logger.isEnabledFor(logging.INFO) and self.keep():
+            self.logger.info(msg, *args)
+
+    def stats(self):
+        return {"sample_rate": self.sample_rate, "per_second": self.per_second,
+                "sampled_out": self.sampled_out, "rate_limited": self.rate_limited}
+
+
+# Function to get the sampled logger for a category ("faq.compare", "llm.response", ...)
+def get_logger(category):
+    with categories_lock:
+        if category not in categories:
+            sample_rate, per_second = SAMPLING_OVERRIDES.get(category, CATEGORY_POLICIES.get(category, DEFAULT_POLICY))
+            categories[category] = SampledLogger(category, sample_rate, per_second)
+        return categories[category]
+
+
+# Hands records to the writer thread without blocking; a full queue drops the record
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # The message is formatted by the writer thread, not the caller (only tracebacks are rendered here).
+    # Arguments are therefore read later, so callers must not mutate what they log
+    def prepare(self, record):
+        if record.exc_info:
+            return super().prepare(record)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            QUEUE_DROPS.inc()
+
+
+# Background writer; its stop marker waits for room instead of failing when the queue is full
+class DrainingQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+# Function to replace logging.basicConfig: rotating log file, written in the background by default
+def setup_logging(filename, mode=None, level=None):
+    global listener, queue_handler, file_handler
+    mode = mode or LOG_MODE
+    root = logging.getLogger()
+    root.setLevel("WARNING" if mode == "off" else (level or LOG_LEVEL))
+    file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if mode == "sync":
+        root.addHandler(file_handler)
+        return
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    listener = DrainingQueueListener(queue_handler.queue, file_handler)
+    listener.start()
+    root.addHandler(queue_handler)
+    atexit.register(stop_logging)
+
+
+# Function to write out everything still queued and report what sampling and overflow dropped;
+# anything logged afterwards (e.g. during interpreter shutdown) is written directly
+def stop_logging():
+    global listener
+    if listener is None:
+        return
+    listener.stop()
+    listener = None
+    root = logging.getLogger()
+    root.removeHandler(queue_handler)
+    root.addHandler(file_handler)
+    summary = {category: logger.stats() for category, logger in categories.items()}
+    record = logging.LogRecord("log_pipeline", logging.INFO, __file__, 0, "Log pipeline stopped: %d records dropped by a full queue, sampling %s",
+                               (queue_handler.dropped, json.dumps(summary)), None)
+    file_handler.handle(record)
+
+
+# Function to make a stand-in FAQ (same "N. Question? Answer" layout) when the real one is not present
+def synthetic_faq(count, seed=42):
+    rng = random.Random(seed)
+    verbs = ["open", "close", "update", "report", "transfer", "deposit", "freeze", "replace", "link", "dispute"]
+    things = ["checking account", "savings account", "debit card", "credit card", "mobile check", "wire transfer",
+              "direct deposit", "overdraft protection", "online banking password", "Zelle payment", "statement", "PIN"]
+    entries = []
+    for number in range(1, count + 1):
+        question = f"How do I {rng.choice(verbs)} my {rng.choice(things)} with Chase?"
+        answer = f"You can do this in the Chase app or online banking; see step {number} of the help center. Fees may apply."
+        entries.append(f"{number}. {question} {answer}")
+    return "\n".join(entries)
+
+
+# Function to time query_faq in one logging configuration (runs in its own process)
+def run_worker(module_name, faq_file, faq_count, queries):
+    module = __import__(module_name)
+    # The assistant set up logging through the imported module, not this script's __main__ copy
+    import log_pipeline
+    if faq_file and os.path.exists(faq_file):
+        with open(faq_file, "r", encoding="utf-8") as f:
+            faq_text = f.read()
+    else:
+        faq_text = synthetic_faq(faq_count)
+    module.faq_pairs[:] = module.parse_faq(faq_text)
+    rng = random.Random(7)
+    questions = [question.split(". ", 1)[-1] for question, _ in module.faq_pairs]
+    questions += ["Can I teleport money to the moon?", "What is the weather today?", "how do i reset my pin"]
+    for question in questions[:20]:
+        module.query_faq(question)
+    latencies = []
+    for _ in range(queries):
+        question = rng.choice(questions)
+        start_time = time.perf_counter()
+        module.query_faq(question)
+        latencies.append(time.perf_counter() - start_time)
+    flush_start = time.perf_counter()
+    log_pipeline.stop_logging()
+    flush_seconds = time.perf_counter() - flush_start
+    log_bytes = sum(os.path.getsize(name) for name in os.listdir(".") if name.startswith("chase_assistant.log"))
+    return {
+        "faqs": len(module.faq_pairs),
+        "queries": queries,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "flush_seconds": flush_seconds,
+        "log_bytes": log_bytes,
+        "dropped": log_pipeline.queue_handler.dropped if log_pipeline.queue_handler else 0
+    }
+
+
+# Logging configurations compared by the benchmark: (MISTRAL_LOG_MODE, MISTRAL_LOG_SAMPLING)
+BENCHMARK_MODES = {
+    "off": ("off", ""),
+    "sync_every_comparison": ("sync", "faq.compare=1:0,faq.match=1:0"),
+    "async_every_comparison": ("async", "faq.compare=1:0,faq.match=1:0"),
+    "async_sampled": ("async", "")
+}
+
+
+# Function to compare query latency with logging off, synchronous, asynchronous and sampled
+def benchmark(module_name, faq_file, faq_count, queries):
+    results = {}
+    for name, (mode, sampling) in BENCHMARK_MODES.items():
+        env = dict(os.environ, MISTRAL_LOG_MODE=mode, MISTRAL_LOG_SAMPLING=sampling, MISTRAL_LOG_LEVEL="DEBUG")
+        command = [sys.executable, os.path.abspath(__file__), "--worker", "--module", module_name,
+                   "--faq-count", str(faq_count), "--queries", str(queries)]
+        if faq_file:
+            command += ["--faq-file", os.path.abspath(faq_file)]
+        # Each configuration logs into its own scratch directory
+        with tempfile.TemporaryDirectory() as directory:
+            output = subprocess.run(command, check=True, capture_output=True, text=True, env=env, cwd=directory).stdout
+        results[name] = json.loads(output.strip().splitlines()[-1])
+    baseline = results["off"]["mean_ms"]
+    print(f"query_faq latency in {module_name} ({results['off']['faqs']} FAQs, {queries} queries)")
+    for name, result in results.items():
+        overhead = (result["mean_ms"] - baseline) / baseline * 100 if baseline else 0.0
+        print(f"  {name:24s} mean {result['mean_ms']:7.3f} ms  p50 {result['p50_ms']:7.3f}  p95 {result['p95_ms']:7.3f}  p99 {result['p99_ms']:7.3f}"
+              f"  ({overhead:+6.1f}% vs off)  log {result['log_bytes'] / 1024:8.1f} KB  flush {result['flush_seconds']:.2f}s  dropped {result['dropped']}")
+    # A mode that overflowed the queue did less logging than it was asked to, so it looks cheaper than it is
+    for name, result in results.items():
+        if result["dropped"]:
+            print(f"  note: {name} dropped {result['dropped']} records on a full queue; its latency does not include writing them")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark FAQ query latency with the log pipeline off, synchronous, asynchronous and sampled")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--module", choices=["chase_assistant", "mistral_chase_assistant"], default="chase_assistant")
+    parser.add_argument("--faq-file", default="./Chase_FAQ/Chase Banking FAQ.txt", help="FAQ to match against (a synthetic one is used if missing)")
+    parser.add_argument("--faq-count", type=int, default=80, help="Size of the synthetic FAQ")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.module, args.faq_file, args.faq_count, args.queries)))
+    elif args.benchmark:
+        benchmark(args.module, args.faq_file, args.faq_count, args.queries)
+    else:
+        parser.print_help()
@@ -0,0 +1,375 @@
+import atexit
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Serve /metrics on this local port when set (e.g. MISTRAL_METRICS_PORT=9464)
+METRICS_PORT = os.environ.get("MISTRAL_METRICS_PORT")
+# Write all metrics to this file when the process exits (.prom for Prometheus text, otherwise JSON)
+METRICS_FILE = os.environ.get("MISTRAL_METRICS_FILE")
+
+# HDR-style histogram buckets: 64 linear sub-buckets per power of two of microseconds,
+# so any recorded latency is known to within about 1.6%
+SUB_BUCKET_BITS = 6
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+# Bucket bounds (seconds) in the Prometheus export; the HDR counts are folded into these
+EXPORT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+# Observations buffered before they are sorted into buckets
+FOLD_BATCH = 1024
+
+
+# Function to map a latency in whole microseconds to its histogram bucket (inlined in Histogram.fold)
+def bucket_index(value):
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+# Function to get the (exclusive) upper bound of a bucket in microseconds
+def bucket_upper(index):
+    if index < 2 * SUB_BUCKETS:
+        return index + 1
+    shift = index // SUB_BUCKETS - 1
+    return (index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+
+# Latency histogram in seconds; buckets are kept sparse, so only latencies that occurred cost memory.
+# Recording only appends to a buffer (atomic under the GIL); the buffer is folded into the
+# buckets in batches, which keeps the per-event cost at a list append
+class Histogram:
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        self.pending.append(seconds)
+        if len(self.pending) >= FOLD_BATCH:
+            self.fold()
+
+    def fold(self):
+        with self.lock:
+            # Deleting the taken slice keeps values other threads append meanwhile
+            taken = len(self.pending)
+            batch = self.pending[:taken]
+            del self.pending[:taken]
+            counts = self.counts
+            for seconds in batch:
+                value = int(seconds * 1000000) if seconds > 0 else 0
+                if value < 2 * SUB_BUCKETS:
+                    index = value
+                else:
+                    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+                    index = (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+                counts[index] = counts.get(index, 0) + 1
+            self.count += taken
+            self.sum += sum(batch)
+
+    def time(self):
+        return Timer(self)
+
+    def quantile(self, q):
+        self.fold()
+        with self.lock:
+            counts = sorted(self.counts.items())
+            total = self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in counts:
+            seen += count
+            if seen >= rank:
+                return bucket_upper(index) / 1000000
+        return bucket_upper(counts[-1][0]) / 1000000
+
+    # Counts at or below each bound, as Prometheus "le" buckets expect
+    def cumulative(self, bounds):
+        self.fold()
+        with self.lock:
+            counts = sorted(self.counts.items())
+        result = []
+        seen = 0
+        position = 0
+        for bound in bounds:
+            limit = bound * 1000000
+            while position < len(counts) and bucket_upper(counts[position][0]) <= limit:
+                seen += counts[position][1]
+                position += 1
+            result.append(seen)
+        return result
+
+
+# Times a block with a histogram: "with STAGE.time(): ..."
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+# Decorator recording each call's duration in a histogram
+def timed(histogram):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+KINDS = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+
+
+# One named metric with a child per label combination
+class MetricFamily:
+    def __init__(self, kind, name, help_text, labelnames=()):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    # Look the child up once and keep it; the lookup costs more than recording an event
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, KINDS[self.kind]())
+        return child
+
+    def label_text(self, values, extra=""):
+        pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def register(self, kind, name, help_text, labelnames=()):
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = MetricFamily(kind, name, help_text, labelnames)
+            elif family.kind != kind or family.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered as a {family.kind} with labels {family.labelnames}")
+        return family
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register("counter", name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register("gauge", name, help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=()):
+        return self.register("histogram", name, help_text, labelnames)
+
+    # Prometheus text exposition format (version 0.0.4)
+    def render_prometheus(self):
+        lines = []
+        for family in sorted(self.families.values(), key=lambda family: family.name):
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for values, child in sorted(family.children.items()):
+                if family.kind != "histogram":
+                    lines.append(f"{family.name}{family.label_text(values)} {child.value}")
+                    continue
+                bounds = [str(bound) for bound in EXPORT_BUCKETS] + ["+Inf"]
+                counts = child.cumulative(EXPORT_BUCKETS) + [child.count]
+                for bound, count in zip(bounds, counts):
+                    le = 'le="' + bound + '"'
+                    lines.append(f"{family.name}_bucket{family.label_text(values, le)} {count}")
+                lines.append(f"{family.name}_sum{family.label_text(values)} {child.sum}")
+                lines.append(f"{family.name}_count{family.label_text(values)} {child.count}")
+        return "\n".join(lines) + "\n"
+
+    # Plain values with histogram percentiles, for reports and the JSON dump
+    def snapshot(self):
+        result = {}
+        for family in self.families.values():
+            entries = []
+            for values, child in family.children.items():
+                entry = {"labels": dict(zip(family.labelnames, values))}
+                if family.kind == "histogram":
+                    child.fold()
+                    entry.update({"count": child.count, "sum": child.sum})
+                    entry.update({f"p{round(q * 100)}": child.quantile(q) for q in QUANTILES})
+                else:
+                    entry["value"] = child.value
+                entries.append(entry)
+            result[family.name] = {"type": family.kind, "help": family.help, "values": entries}
+        return result
+
+    def dump(self, path):
+        text = self.render_prometheus() if path.endswith(".prom") else json.dumps(self.snapshot(), indent=2)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as file:
+            file.write(text)
+        os.replace(temporary_path, path)
+
+    # Serves /metrics (Prometheus text) and /metrics.json on localhost from a background thread
+    def serve(self, port, host="127.0.0.1"):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = registry.render_prometheus(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(registry.snapshot()), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, int(port)), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+
+# Process-wide registry shared by every module
+REGISTRY = MetricsRegistry()
+
+# Time spent in each named step of a request (query_faq, get_hf_embedding, query_documents, ...)
+STAGE_SECONDS = REGISTRY.histogram("pipeline_stage_seconds", "Time spent in each pipeline stage", ("stage",))
+
+
+# Function to turn on the endpoint and exit dump configured in the environment
+def start_from_env(port=METRICS_PORT, path=METRICS_FILE):
+    if port:
+        try:
+            bound = REGISTRY.serve(port)
+            logging.info(f"Metrics at http://127.0.0.1:{bound}/metrics")
+        except OSError as e:
+            # Another tool already serves this port; keep running without the endpoint
+            logging.warning(f"Metrics endpoint not started on port {port}: {str(e)}")
+    if path:
+        atexit.register(REGISTRY.dump, path)
+
+
+# Function to measure the cost of recording one event with each metric type
+def benchmark(events=200000):
+    registry = MetricsRegistry()
+    counter = registry.counter("bench_total", "benchmark").labels()
+    gauge = registry.gauge("bench_gauge", "benchmark").labels()
+    histogram = registry.histogram("bench_seconds", "benchmark").labels()
+    values = [(i % 5000) / 1000.0 for i in range(events)]
+    results = {}
+    for name, record in (("counter.inc", lambda value: counter.inc()), ("gauge.set", gauge.set), ("histogram.observe", histogram.observe)):
+        start_time = time.perf_counter()
+        for value in values:
+            record(value)
+        results[name] = (time.perf_counter() - start_time) / events * 1e9
+    # The loop and the lambda call are part of every figure, so subtract an empty call
+    start_time = time.perf_counter()
+    for value in values:
+        (lambda value: None)(value)
+    baseline = (time.perf_counter() - start_time) / events * 1e9
+    for name, nanoseconds in results.items():
+        print(f"{name:18s} {nanoseconds:6.0f} ns/event ({max(nanoseconds - baseline, 0):.0f} ns above an empty call)")
+    return results
+
+
+# Function to check histogram percentiles and the Prometheus output against known data
+def self_check():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("check_seconds", "check", ("stage",)).labels("a")
+    values = [i / 10000.0 for i in range(1, 10001)]
+    for value in values:
+        histogram.observe(value)
+    # The bucket arithmetic inlined in fold() must match bucket_index()
+    probe = registry.histogram("probe_seconds", "check").labels()
+    for value in range(0, 3000000, 997):
+        probe.observe(value / 1000000)
+        probe.fold()
+        assert list(probe.counts) == [bucket_index(value)], value
+        probe.counts.clear()
+        assert bucket_upper(bucket_index(value)) > value
+    for q in QUANTILES:
+        exact = values[int(q * len(values)) - 1]
+        assert abs(histogram.quantile(q) - exact) / exact < 0.02, (q, histogram.quantile(q), exact)
+    # A bucket straddling a bound is counted above it, so "le" counts may be slightly low
+    for expected, count in zip([5000, 10000, 10000], histogram.cumulative([0.5, 1.0, 2.0])):
+        assert expected * 0.98 <= count <= expected, (expected, count)
+    registry.counter("check_total", "check", ("result",)).labels("ok").inc(3)
+    text = registry.render_prometheus()
+    assert 'check_seconds_bucket{stage="a",le="+Inf"} 10000' in text
+    assert 'check_total{result="ok"} 3' in text
+    print("Metrics self-check passed")
+
+
+if __name__ == "__main__":
+    if "--self-check" in sys.argv:
+        self_check()
+    elif "--benchmark" in sys.argv:
+        benchmark()
+    else:
+        print("Usage: python metrics.py --self-check | --benchmark")
+        sys.exit(1)
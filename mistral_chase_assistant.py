@@ -1,7 +1,9 @@
 import tkinter as tk
 from tkinter import ttk, scrolledtext
 import os
-from ctransformers import AutoModelForCausalLM
+from inference_client import InferenceClient, PRIORITY_HIGH
+from prompt_templates import FAQ_REPHRASE_PREFIX, FAQ_ESCALATION_PREFIX
+from token_budget import TokenBudget
 import re
 import threading
 import queue
@@ -9,14 +11,31 @@ import logging
 import time
 import random
 import psutil
+from metrics import REGISTRY, STAGE_SECONDS, timed, start_from_env
+from profiling import profiled, traced, span, annotate
+from log_pipeline import setup_logging, get_logger
+from faq_matcher import load_semantic_index, record_stage
 
-logging.basicConfig(filename='chase_assistant.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# Rotating log written by a background thread; per-comparison traces are sampled and rate limited
+setup_logging('chase_assistant.log')
+COMPARE_LOG = get_logger("faq.compare")
+MATCH_LOG = get_logger("faq.match")
+DUMP_LOG = get_logger("faq.dump")
+RESPONSE_LOG = get_logger("llm.response")
 
 llm = None
+budget = None
 faq_pairs = []
+# Embedded FAQ questions for paraphrases word overlap misses (None: word overlap only)
+semantic_index = None
 model_queue = queue.Queue()
 response_queue = queue.Queue()
 
+FAQ_RESULTS = REGISTRY.counter("faq_queries_total", "FAQ questions by how they were handled", ("result",))
+UI_RESPONSE_SECONDS = STAGE_SECONDS.labels("ui_response")
+# Word overlap at or above this answers without the semantic stage (lowered from 0.5 to 0.4)
+CONFIDENCE_THRESHOLD = 0.4
+
 def check_system_resources():
     cpu_percent = psutil.cpu_percent(interval=1)
     if cpu_percent > 80:
@@ -24,27 +43,29 @@ def check_system_resources():
     return ""
 
 def initialize_models():
-    global llm, faq_pairs
+    global llm, budget, faq_pairs, semantic_index
     try:
-        mistral_model_path = os.path.expanduser("~/Documents/mistral_chat_agent/mistral-7b-instruct-v0.2.Q4_K_M.gguf")
-        if not os.path.exists(mistral_model_path):
-            raise FileNotFoundError(f"Mistral model file not found at {mistral_model_path}")
-        llm = AutoModelForCausalLM.from_pretrained(mistral_model_path, model_type="mistral", context_length=128)
-        logging.info("Loaded Mistral 7B model")
+        # FAQ rephrases are short, so they jump ahead of long stories in the shared daemon
+        llm = InferenceClient(priority=PRIORITY_HIGH)
+        health = llm.health(timeout=300)
+        budget = TokenBudget(llm, context_length=health["context_length"])
+        logging.info("Connected to Mistral 7B daemon: %s", health['model_path'])
 
         faq_path = "./Chase_FAQ/Chase Banking FAQ.txt"
         if os.path.exists(faq_path):
             with open(faq_path, "r", encoding="utf-8") as f:
                 faq_text = f.read()
             faq_pairs.extend(parse_faq(faq_text))
-            logging.info(f"Loaded and parsed FAQ: {len(faq_pairs)} question-answer pairs")
-            logging.debug(f"FAQ pairs: {faq_pairs}")
+            logging.info("Loaded and parsed FAQ: %d question-answer pairs", len(faq_pairs))
+            DUMP_LOG.debug("FAQ pairs: %s", faq_pairs)
         else:
             raise FileNotFoundError(f"FAQ file not found at {faq_path}")
 
         model_queue.put(("success", None))
+        # Loading the embedding model must not hold up the chat; until it is ready, word overlap decides alone
+        semantic_index = load_semantic_index(faq_pairs, clean_faq_question)
     except Exception as e:
-        logging.error(f"Error loading models: {str(e)}")
+        logging.error("Error loading models: %s", e)
         model_queue.put(("error", str(e)))
 
 def parse_faq(text):
@@ -66,31 +87,65 @@ def normalize_text(text):
     text = re.sub(r'\s+', ' ', text)
     return text
 
+# FAQ question without its number, normalized for matching
+def clean_faq_question(faq_question):
+    return normalize_text(faq_question.split('. ', 1)[-1])
+
+@timed(STAGE_SECONDS.labels("query_faq"))
+@traced("query_faq")
 def query_faq(question):
-    question = normalize_text(question)
+    with span("normalize_question"):
+        question = normalize_text(question)
     best_match = None
     best_score = 0
     best_question = None
-    for faq_question, faq_answer in faq_pairs:
-        faq_question_clean = normalize_text(faq_question.split('. ', 1)[-1])
-        question_words = set(question.split())
-        faq_words = set(faq_question_clean.split())
-        common_words = len(question_words & faq_words)
-        score = common_words / max(len(question_words), len(faq_words))
-        logging.debug(f"Comparing '{question}' with '{faq_question_clean}': Intersection = {question_words & faq_words}, Score = {score}")
-        if score > best_score:
-            best_score = score
-            best_match = faq_answer
-            best_question = faq_question_clean
-    logging.debug(f"Best FAQ match for '{question}': '{best_question}' with score {best_score}")
+    with span("score_faqs", faqs=len(faq_pairs)):
+        for faq_question, faq_answer in faq_pairs:
+            faq_question_clean = clean_faq_question(faq_question)
+            question_words = set(question.split())
+            faq_words = set(faq_question_clean.split())
+            common = question_words & faq_words
+            score = len(common) / max(len(question_words), len(faq_words))
+            COMPARE_LOG.debug("Comparing '%s' with '%s': Intersection = %s, Score = %s", question, faq_question_clean, common, score)
+            if score > best_score:
+                best_score = score
+                best_match = faq_answer
+                best_question = faq_question_clean
+    MATCH_LOG.debug("Best FAQ match for '%s': '%s' with score %s", question, best_question, best_score)
     return best_match, best_score
 
+# Function to answer from the FAQ: clear word-overlap hits right away, ambiguous questions re-scored
+# by embedding similarity against the FAQ questions. Returns (answer or None, score, stage)
+@timed(STAGE_SECONDS.labels("match_faq"))
+@traced("match_faq")
+def match_faq(question):
+    answer, score = query_faq(question)
+    if score >= CONFIDENCE_THRESHOLD and answer:
+        record_stage("lexical")
+        return answer, score, "lexical"
+    if semantic_index is not None:
+        with span("semantic_faq"):
+            best, similarity, gap = semantic_index.match(question)
+        MATCH_LOG.debug("Semantic FAQ match for '%s': %s, similarity %s, gap %s", question, best, similarity, gap)
+        if best is not None:
+            record_stage("semantic")
+            return faq_pairs[best][1], similarity, "semantic"
+    record_stage("none")
+    return None, score, "none"
+
+@timed(STAGE_SECONDS.labels("generate_mistral_response"))
+@traced("generate_mistral_response")
 def generate_mistral_response(question, faq_answer=None):
     try:
+        # The 7-second limit below is for generation; a reload after an idle unload takes longer
+        with span("llm_load"):
+            llm.load()
         if faq_answer:
-            prompt = f"Rephrase this answer in a friendly, conversational tone (max 50 words) and end with 'Thank you!': '{faq_answer}'"
-            response = llm(prompt, max_new_tokens=50, temperature=0.3, top_p=0.9, timeout=7)
-            logging.debug(f"Mistral 7B response: {response}")
+            prompt = f"{FAQ_REPHRASE_PREFIX}{faq_answer}'"
+            # Raises PromptTooLong (handled below) if a long answer leaves no room for the reply
+            max_new_tokens = budget.fit_max_new_tokens(prompt, 50)
+            response = llm(prompt, max_new_tokens=max_new_tokens, temperature=0.3, top_p=0.9, timeout=7)
+            RESPONSE_LOG.debug("Mistral 7B response: %s", response)
             if response and not re.search(r"subject:|hello \[customer\]|space|moon|teleport", response.lower()):
                 return response
             return f"{faq_answer} Thank you!"
@@ -98,39 +153,47 @@ def generate_mistral_response(question, faq_answer=None):
             action = random.choice(["case", "agent"])
             if action == "case":
                 case_number = f"CASE-{random.randint(100000, 999999)}"
-                prompt = f"Generate a friendly message (max 50 words) saying human intervention is needed for '{question}', create a case '{case_number}', and end with 'Thank you!'"
+                prompt = f"{FAQ_ESCALATION_PREFIX}{question}', create a case '{case_number}', and end with 'Thank you!'"
             else:
                 agent_name = random.choice(["Jeff", "Andrea", "Sarah", "Michael", "Emily"])
-                prompt = f"Generate a friendly message (max 50 words) saying human intervention is needed for '{question}', route to agent '{agent_name}', and end with 'Thank you!'"
-            response = llm(prompt, max_new_tokens=50, temperature=0.3, top_p=0.9, timeout=7)
-            logging.debug(f"Mistral 7B response: {response}")
+                prompt = f"{FAQ_ESCALATION_PREFIX}{question}', route to agent '{agent_name}', and end with 'Thank you!'"
+            # Raises PromptTooLong (handled below) if a long answer leaves no room for the reply
+            max_new_tokens = budget.fit_max_new_tokens(prompt, 50)
+            response = llm(prompt, max_new_tokens=max_new_tokens, temperature=0.3, top_p=0.9, timeout=7)
+            RESPONSE_LOG.debug("Mistral 7B response: %s", response)
             if response and not re.search(r"subject:|hello \[customer\]|space|moon|teleport", response.lower()):
                 return response
     except Exception as e:
-        logging.error(f"Mistral 7B error: {str(e)}")
+        logging.error("Mistral 7B error: %s", e)
     if not faq_answer:
         return "I’m sorry, I can’t assist with that. Thank you!"
     return f"{faq_answer} Thank you!"
 
+@timed(STAGE_SECONDS.labels("process_query"))
+@profiled("process_query")
 def process_query(app, user_input):
+    annotate(question=user_input)
     try:
         app.chat_display.config(state='normal')
         app.chat_display.insert(tk.END, "ChaseBot: Thinking...\n")
         app.chat_display.config(state='disabled')
         app.chat_display.see(tk.END)
 
-        retrieved_answer, score = query_faq(user_input)
-        logging.debug(f"Retrieved answer for '{user_input}': {retrieved_answer}, Score: {score}")
-        confidence_threshold = 0.4  # Lowered from 0.5 to 0.4
+        retrieved_answer, score, stage = match_faq(user_input)
+        MATCH_LOG.debug("Retrieved answer for '%s': %s, Score: %s, Stage: %s", user_input, retrieved_answer, score, stage)
+        annotate(stage=stage)
 
-        if score >= confidence_threshold and retrieved_answer:
+        if retrieved_answer:
+            FAQ_RESULTS.labels("answered").inc()
             response = generate_mistral_response(user_input, retrieved_answer)
         else:
+            FAQ_RESULTS.labels("escalated").inc()
             response = generate_mistral_response(user_input)
 
         response_queue.put((response, "answered"))
     except Exception as e:
-        logging.error(f"Error in process_query: {str(e)}")
+        logging.error("Error in process_query: %s", e)
+        FAQ_RESULTS.labels("error").inc()
         response_queue.put(("I’m sorry, I can’t assist with that. Thank you!", "answered"))
 
 class ChatApp:
@@ -214,6 +277,7 @@ class ChatApp:
     def check_response(self):
         try:
             response, action = response_queue.get_nowait()
+            UI_RESPONSE_SECONDS.observe(time.time() - self.response_start_time)
             self.chat_display.config(state='normal')
             self.chat_display.delete("end-2l", tk.END)
             self.chat_display.insert(tk.END, f"ChaseBot: {response}\n\n")
@@ -241,6 +305,7 @@ class ChatApp:
         self.root.quit()
 
 if __name__ == "__main__":
+    start_from_env()
     root = tk.Tk()
     app = ChatApp(root)
     root.mainloop()
\ No newline at end of file
@@ -1,14 +1,22 @@
 import tkinter as tk
 from tkinter import ttk
-from ctransformers import AutoModelForCausalLM
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+from inference_client import InferenceClient, InferenceCancelled, PRIORITY_LOW
+from token_budget import TokenBudget, PromptTooLong
+from story_generation import count_words, build_story_prompt, write_story, MIN_WORD_LIMIT, MAX_WORD_LIMIT
+from chat_store import ChatStore, parse_messages
+from conversation_memory import ConversationMemory, make_summarizer
+from voice_input import VoicePipeline, CalibrationCache, NoSpeechError, RecognitionServiceError
+from metrics import REGISTRY, STAGE_SECONDS, start_from_env
+from profiling import start_request, attach, finish, span
+from chat_journal import ChatJournal, JOURNAL_DIR, make_record, record_time, read_journal, render_records, index_missing_records
+from log_pipeline import get_logger
 import os
 import datetime
 import random
 import threading
+import queue
 import time
 import gc  # For memory management
-import speech_recognition as sr
 
 # Set up the Tkinter window
 root = tk.Tk()
@@ -21,6 +29,13 @@ CHAT_DIR = "chat_history"
 if not os.path.exists(CHAT_DIR):
     os.makedirs(CHAT_DIR)
 
+# Chat history database with a full-text index; old text files are imported on first run
+chat_store = ChatStore(os.path.join(CHAT_DIR, "chats.db"))
+chat_store.import_text_chats(CHAT_DIR)
+
+# Each chat's turns are appended to chat_history/journal/<chat>.jsonl as they happen
+JOURNAL_PATH = os.path.join(CHAT_DIR, os.path.basename(JOURNAL_DIR))
+
 # List of funny thinking messages
 THINKING_MESSAGES = [
     "Diving into the cosmic soup of knowledge...",
@@ -30,23 +45,31 @@ THINKING_MESSAGES = [
     "Shuffling through the stardust of ideas..."
 ]
 
-# Load the Mistral 7B model
-model = AutoModelForCausalLM.from_pretrained(
-    "mistral-7b-instruct-v0.2.Q4_K_M.gguf",
-    model_type="mistral",
-    gpu_layers=0,
-    context_length=2048
-)
+# Connect to the shared Mistral 7B inference daemon (started on first use)
+model = InferenceClient(priority=PRIORITY_LOW)
 
-# Initialize sentiment analyzer
-analyzer = SentimentIntensityAnalyzer()
+# Metrics endpoint / exit dump when MISTRAL_METRICS_PORT / MISTRAL_METRICS_FILE are set
+start_from_env()
+UI_RESPONSES = REGISTRY.counter("ui_responses_total", "Story requests by how they ended", ("status",))
+UI_RESPONSE_SECONDS = STAGE_SECONDS.labels("ui_response")
+PROMPT_BUILD_SECONDS = STAGE_SECONDS.labels("prompt_build")
+# Memory use and prompt size per story (to the log when logging is set up)
+PROMPT_LOG = get_logger("ui.prompt")
 
-# Initialize speech recognizer
-recognizer = sr.Recognizer()
+# Voice input runs on a worker thread; the offline Vosk engine is used when installed
+voice_pipeline = VoicePipeline(cache=CalibrationCache())
 
 # Model settings
-CONTEXT_LENGTH = 2048
 DEFAULT_WORD_COUNT = 150  # Default story length in words
+GENERATION_TIMEOUT = 180  # Seconds before a generation is cancelled
+POLL_INTERVAL_MS = 50  # How often the UI checks on a running generation
+SEARCH_DEBOUNCE_MS = 150  # Pause in typing before the chat history search runs
+
+# Generation currently in progress (None when idle)
+active_generation = None
+
+# Pending debounced chat history search (None when idle)
+search_after_id = None
 
 # Variables for UI toggles
 word_count_var = tk.StringVar(value=str(DEFAULT_WORD_COUNT))
@@ -54,9 +77,20 @@ dark_mode_var = tk.BooleanVar(value=False)
 auto_scroll_var = tk.BooleanVar(value=True)
 search_var = tk.StringVar()
 
-# Dictionary to store the open state of date nodes
+# Dictionary to store the open state of date nodes, keyed by day ("YYYY-MM-DD")
 date_node_states = {}
 
+# Days with chats (newest first) and the previews of days opened so far; both are
+# loaded once and then updated as chats are saved, never by rescanning the history
+history_days = chat_store.list_days()
+preview_cache = {}
+
+# Search matches grouped by day while the search box is not empty
+search_results = None
+
+# Chat being journaled ({"id": ..., "journal": ChatJournal}); None until the first prompt
+current_chat = None
+
 # Color schemes for light and dark modes
 LIGHT_COLORS = {
     "window_bg": "#F5E8C7",  # Sandy beige
@@ -77,57 +111,15 @@ DARK_COLORS = {
 # Current color scheme (default to light)
 current_colors = LIGHT_COLORS.copy()
 
+# Token accounting with the model's own tokenizer
+budget = TokenBudget(model)
+CONTEXT_LENGTH = budget.context_length
+
+# Earlier turns of the open chat; older ones are summarized in the background between turns
+memory = ConversationMemory(budget, summarize=make_summarizer(model, budget))
+
 # Log model loading for debugging
-print(f"Loaded model: Mistral 7B, Context length: {model.context_length}")
-
-# Function to estimate token count (simplified approximation)
-def estimate_token_count(text):
-    return len(text) // 4 + 1
-
-# Function to count words in a text
-def count_words(text):
-    words = [word for word in text.split() if word]
-    return len(words)
-
-# Function to count lines in a text
-def count_lines(text):
-    return len([line for line in text.splitlines() if line.strip()])
-
-# Function to truncate text to a specific word count, preserving sonnet structure if applicable
-def truncate_to_word_count(text, word_limit, is_sonnet=False):
-    words = text.split()
-    if len(words) <= word_limit:
-        return text
-    if is_sonnet:
-        lines = text.splitlines()
-        current_words = 0
-        truncated_lines = []
-        for i, line in enumerate(lines):
-            line_words = len(line.split())
-            # Allow the last line to complete, even if it exceeds the limit slightly
-            if i == len(lines) - 1 and current_words < word_limit:
-                truncated_lines.append(line)
-                break
-            if current_words + line_words > word_limit:
-                remaining_words = word_limit - current_words
-                truncated_line = " ".join(line.split()[:remaining_words])
-                if truncated_line:
-                    truncated_lines.append(truncated_line + "...")
-                break
-            truncated_lines.append(line)
-            current_words += line_words
-        return "\n".join(truncated_lines)
-    else:
-        truncated = " ".join(words[:word_limit])
-        last_period = truncated.rfind(".")
-        last_exclamation = truncated.rfind("!")
-        last_question = truncated.rfind("?")
-        last_boundary = max(last_period, last_exclamation, last_question)
-        if last_boundary != -1 and last_boundary > len(truncated) // 2:
-            truncated = truncated[:last_boundary + 1]
-        else:
-            truncated += "..."
-        return truncated
+print(f"Connected to Mistral 7B daemon, Context length: {CONTEXT_LENGTH}")
 
 # Function to toggle dark mode
 def toggle_dark_mode():
@@ -158,69 +150,155 @@ def toggle_dark_mode():
     clear_chat_button.configure(bg=current_colors["button_bg"], fg=current_colors["button_fg"])
     submit_button.configure(bg=current_colors["button_bg"], fg=current_colors["button_fg"])
     speak_button.configure(bg=current_colors["button_bg"], fg=current_colors["button_fg"])
+    cancel_button.configure(bg=current_colors["button_bg"], fg=current_colors["button_fg"])
     dark_mode_toggle.configure(bg=current_colors["window_bg"], fg=current_colors["text_fg"])
     auto_scroll_toggle.configure(bg=current_colors["window_bg"], fg=current_colors["text_fg"])
 
-# Function to analyze sentiment and determine mood
-def get_sentiment_mood(text):
-    sentiment = analyzer.polarity_scores(text)
-    compound_score = sentiment['compound']
-    if compound_score < -0.05:
-        return "sad and comforting"
-    elif compound_score > 0.05:
-        return "joyful and uplifting"
-    return None
-
-# Function to get list of chat files
-def get_chat_files():
-    return sorted([f for f in os.listdir(CHAT_DIR) if f.endswith(".txt")], reverse=True)
-
-# Function to parse timestamp from filename and extract date
-def parse_chat_timestamp(filename):
-    timestamp_str = filename.replace("chat_", "").replace(".txt", "")
+# Function to turn a stored day ("YYYY-MM-DD") into a date node label
+def format_day(day):
     try:
-        dt = datetime.datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S")
-        return dt, dt.strftime("%b %d, %Y %I:%M %p"), dt.strftime("%b %d, %Y")
+        return datetime.datetime.strptime(day, "%Y-%m-%d").strftime("%b %d, %Y")
     except ValueError:
-        return None, filename, filename
-
-# Function to extract the first prompt from a chat file (for preview)
-def get_prompt_preview(filename):
-    try:
-        with open(os.path.join(CHAT_DIR, filename), "r") as file:
-            content = file.read()
-            for line in content.splitlines():
-                if line.startswith("[") and "] You: " in line:
-                    prompt_start = line.find("] You: ") + 7
-                    prompt = line[prompt_start:].strip()
-                    if len(prompt) > 30:
-                        prompt = prompt[:27] + "..."
-                    return prompt
-        return "No prompt found"
-    except Exception:
-        return "Error reading file"
-
-# Function to save current chat to a file
+        return day
+
+# Function to get the (chat_id, preview) pairs shown under a date node
+def get_day_chats(day):
+    if search_results is not None:
+        return search_results.get(day, [])
+    if day not in preview_cache:
+        preview_cache[day] = [(chat_id, preview.lower()) for chat_id, _, preview in chat_store.chats_on_day(day)]
+    return preview_cache[day]
+
+# Function to insert a date node; its chats are only loaded when it is opened
+def insert_date_node(day, index="end"):
+    node = chat_tree.insert("", index, iid=f"day:{day}", text=format_day(day), open=False)
+    chat_tree.insert(node, "end", iid=f"placeholder:{day}", text="Loading...")
+    if date_node_states.get(day):
+        open_date_node(node)
+    return node
+
+# Function to replace a date node's placeholder with its chats the first time it is opened
+def load_date_children(node):
+    day = node[len("day:"):]
+    placeholder = f"placeholder:{day}"
+    if not chat_tree.exists(placeholder):
+        return
+    chat_tree.delete(placeholder)
+    for chat_id, prompt_preview in get_day_chats(day):
+        chat_tree.insert(node, "end", text=prompt_preview, tags=(str(chat_id),))
+
+def open_date_node(node):
+    load_date_children(node)
+    chat_tree.item(node, open=True)
+    date_node_states[node[len("day:"):]] = True
+
+def close_date_node(node):
+    chat_tree.item(node, open=False)
+    date_node_states[node[len("day:"):]] = False
+
+# Function to load a date node's chats when it is opened from the keyboard or its arrow
+def on_tree_open(event=None):
+    node = chat_tree.focus()
+    if node.startswith("day:"):
+        load_date_children(node)
+        date_node_states[node[len("day:"):]] = True
+
+def on_tree_close(event=None):
+    node = chat_tree.focus()
+    if node.startswith("day:"):
+        date_node_states[node[len("day:"):]] = False
+
+# Function to show a newly saved chat without reloading the sidebar
+def add_chat_to_sidebar(chat_id):
+    chat_id, started_at, prompt_preview = chat_store.chat_summary(chat_id)
+    day = started_at[:10]
+    if day in preview_cache:
+        preview_cache[day].insert(0, (chat_id, prompt_preview.lower()))
+    if day not in history_days[:1]:
+        history_days.insert(0, day)
+    if search_results is not None:
+        # Searches are cheap; re-run it so the new chat shows up if it matches
+        update_chat_list()
+        return
+    node = f"day:{day}"
+    if not chat_tree.exists(node):
+        insert_date_node(day, index=0)
+    elif not chat_tree.exists(f"placeholder:{day}"):
+        chat_tree.insert(node, 0, text=prompt_preview.lower(), tags=(str(chat_id),))
+
+# Function to open a chat's journal for appending and mark it as the one to recover after a crash
+def open_chat(chat_id, journal_path, records=None):
+    global current_chat
+    current_chat = {"id": chat_id, "journal": ChatJournal(journal_path)}
+    chat_store.set_meta("active_chat", str(chat_id))
+    # A reopened chat brings its earlier turns back into memory; a new chat keeps what is there
+    if records is not None:
+        memory.reset([(record["role"], record["text"]) for record in records if record.get("status", "ok") == "ok"])
+
+# Function to append one turn to the current chat, starting a new chat on its first prompt
+def record_turn(role, text, tokens=None, latency=None, status="ok"):
+    now = datetime.datetime.now()
+    if current_chat is None:
+        name = f"chat_{now.strftime('%Y%m%d_%H%M%S_%f')}"
+        journal_path = os.path.join(JOURNAL_PATH, f"{name}.jsonl")
+        chat_id = chat_store.create_chat(now, name, text, journal_path)
+        open_chat(chat_id, journal_path)
+        add_chat_to_sidebar(chat_id)
+    record = make_record(role, text, tokens=tokens, latency=latency, status=status, timestamp=now)
+    current_chat["journal"].append(record)
+    chat_store.add_message(current_chat["id"], role, record_time(record), text)
+
+# Function to close the current chat; its turns were already written as they happened
 def save_current_chat():
-    chat_content = chat_display.get("1.0", tk.END).strip()
-    if chat_content:
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        with open(os.path.join(CHAT_DIR, f"chat_{timestamp}.txt"), "w") as file:
-            file.write(chat_content)
+    global current_chat
+    if current_chat is not None:
+        current_chat["journal"].close()
+        current_chat = None
+    chat_store.delete_meta("active_chat")
+    memory.reset()
+
+# Function to reopen the chat that was open when the app last exited without closing it
+def resume_active_chat():
+    active_chat = chat_store.get_meta("active_chat")
+    if not active_chat:
+        return
+    row = chat_store.load_chat(int(active_chat))
+    if row is None or not row[1]:
+        chat_store.delete_meta("active_chat")
+        return
+    records = read_journal(row[1])
+    # Turns journaled just before the crash may not have reached the search index
+    index_missing_records(chat_store, int(active_chat), records)
+    open_chat(int(active_chat), row[1], records)
+    chat_display.insert(tk.END, render_records(records))
+    if auto_scroll_var.get():
+        chat_display.see(tk.END)
 
-# Function to load a chat from a file
+# Function to load a chat from the history; journaled chats can be continued
 def load_chat(event=None):
     selected = chat_tree.selection()
-    if not selected:
+    # The running generation's reply belongs to the chat on screen
+    if not selected or active_generation is not None:
         return
     item = selected[0]
     parent = chat_tree.parent(item)
     if not parent:
         return
-    filename = chat_tree.item(item, "tags")[0]
-    with open(os.path.join(CHAT_DIR, filename), "r") as file:
-        chat_display.delete("1.0", tk.END)
-        chat_display.insert(tk.END, file.read())
+    chat_id = int(chat_tree.item(item, "tags")[0])
+    row = chat_store.load_chat(chat_id)
+    if row is None:
+        return
+    content, journal_path = row
+    save_current_chat()
+    if journal_path:
+        records = read_journal(journal_path)
+        content = render_records(records)
+        open_chat(chat_id, journal_path, records)
+    else:
+        # Imported chats are not continued, but a follow-up prompt can still refer back to them
+        memory.reset([(role, text) for role, _, text in parse_messages(content)])
+    chat_display.delete("1.0", tk.END)
+    chat_display.insert(tk.END, content)
     if auto_scroll_var.get():
         chat_display.see(tk.END)
 
@@ -236,89 +314,96 @@ def toggle_date(event):
     if chat_tree.parent(item):
         return
     if chat_tree.item(item, "open"):
-        chat_tree.item(item, open=False)
-        date_node_states[item] = False
+        close_date_node(item)
     else:
-        chat_tree.item(item, open=True)
-        date_node_states[item] = True
+        open_date_node(item)
 
-# Function to clear the chat display and prompt without saving
+# Function to clear the chat display and prompt; turns already sent stay in the history
 def clear_chat():
+    save_current_chat()
     chat_display.delete("1.0", tk.END)
     prompt_entry.delete("1.0", tk.END)
 
-# Function to update chat history list with search filtering
+# Function to update chat history list with search filtering; only date nodes are inserted up front
 def update_chat_list(*args):
-    global date_node_states
-    current_open_states = {}
-    for item in chat_tree.get_children():
-        current_open_states[chat_tree.item(item, "text")] = chat_tree.item(item, "open")
-    
-    for item in chat_tree.get_children():
-        chat_tree.delete(item)
+    global search_results
+    chat_tree.delete(*chat_tree.get_children())
     
-    search_term = search_var.get().lower()
-    chats_by_date = {}
-    for chat_file in get_chat_files():
-        dt, full_timestamp, date_str = parse_chat_timestamp(chat_file)
-        if dt is None:
-            continue
-        prompt_preview = get_prompt_preview(chat_file).lower()
-        if search_term and search_term not in prompt_preview:
-            continue
-        if date_str not in chats_by_date:
-            chats_by_date[date_str] = []
-        chats_by_date[date_str].append((chat_file, prompt_preview))
-    
-    for date_str in sorted(chats_by_date.keys(), reverse=True):
-        date_node = chat_tree.insert("", "end", text=date_str, open=current_open_states.get(date_str, False))
-        for chat_file, prompt_preview in sorted(chats_by_date[date_str], key=lambda x: x[0], reverse=True):
-            child_node = chat_tree.insert(date_node, "end", text=prompt_preview, tags=(chat_file,))
-            chat_tree.selection_remove(child_node)
+    search_term = search_var.get().strip()
+    if search_term:
+        # Full-text search over every message, newest chats first
+        search_results = {}
+        for chat_id, started_at, prompt_preview in chat_store.search(search_term):
+            search_results.setdefault(started_at[:10], []).append((chat_id, prompt_preview.lower()))
+        days = list(search_results)
+    else:
+        search_results = None
+        days = history_days
     
-    date_node_states = {chat_tree.item(item, "text"): chat_tree.item(item, "open") for item in chat_tree.get_children()}
+    for day in days:
+        insert_date_node(day)
+
+# Function to run the chat history search once typing pauses instead of on every keystroke
+def schedule_chat_list_update(*args):
+    global search_after_id
+    if search_after_id is not None:
+        root.after_cancel(search_after_id)
+    search_after_id = root.after(SEARCH_DEBOUNCE_MS, run_chat_list_update)
+
+def run_chat_list_update():
+    global search_after_id
+    search_after_id = None
+    update_chat_list()
 
 # Function to start a new chat
 def new_chat():
     save_current_chat()
     chat_display.delete("1.0", tk.END)
     prompt_entry.delete("1.0", tk.END)
-    update_chat_list()
 
-# Function to handle voice input
+# Function to start voice input without blocking the Tk event loop
 def voice_input():
-    try:
-        with sr.Microphone() as source:
-            recognizer.adjust_for_ambient_noise(source, duration=1)
-            speak_button.config(text="Listening...", state="disabled")
-            root.update()
-            audio = recognizer.listen(source, timeout=5, phrase_time_limit=10)
-            text = recognizer.recognize_google(audio)
-            prompt_entry.delete("1.0", tk.END)
-            prompt_entry.insert(tk.END, text)
-    except sr.UnknownValueError:
-        current_time = datetime.datetime.now().strftime("%I:%M %p")
-        chat_display.insert(tk.END, f"[{current_time}] Mistral 7B: Sorry, I couldn't understand the audio.\n\n")
-    except sr.RequestError as e:
-        current_time = datetime.datetime.now().strftime("%I:%M %p")
-        chat_display.insert(tk.END, f"[{current_time}] Mistral 7B: Error with speech recognition: {str(e)}\n\n")
-    except Exception as e:
+    if not voice_pipeline.start():
+        return
+    speak_button.config(text="Listening...", state="disabled")
+    root.after(POLL_INTERVAL_MS, poll_voice_input)
+
+# Function to show partial transcripts as they arrive and the outcome once listening ends
+def poll_voice_input():
+    while True:
+        try:
+            kind, value = voice_pipeline.events.get_nowait()
+        except queue.Empty:
+            root.after(POLL_INTERVAL_MS, poll_voice_input)
+            return
         current_time = datetime.datetime.now().strftime("%I:%M %p")
-        chat_display.insert(tk.END, f"[{current_time}] Mistral 7B: Error during voice input: {str(e)}\n\n")
-    finally:
-        speak_button.config(text="Speak", state="normal")
-        if auto_scroll_var.get():
-            chat_display.see(tk.END)
-        root.update()
+        if kind in ("partial", "final"):
+            prompt_entry.delete("1.0", tk.END)
+            prompt_entry.insert(tk.END, value)
+        elif kind == "error" and isinstance(value, NoSpeechError):
+            chat_display.insert(tk.END, f"[{current_time}] Mistral 7B: Sorry, I couldn't understand the audio.\n\n")
+        elif kind == "error" and isinstance(value, RecognitionServiceError):
+            chat_display.insert(tk.END, f"[{current_time}] Mistral 7B: Error with speech recognition: {str(value)}\n\n")
+        elif kind == "error":
+            chat_display.insert(tk.END, f"[{current_time}] Mistral 7B: Error during voice input: {str(value)}\n\n")
+        elif kind == "done":
+            # A generation may have started meanwhile and disabled the button; leave that to finish_response
+            speak_button.config(text="Speak", state="disabled" if active_generation is not None else "normal")
+            if auto_scroll_var.get():
+                chat_display.see(tk.END)
+            return
 
 # Function to generate a response in a separate thread
 def generate_response(event=None):
+    global active_generation
+    if active_generation is not None:
+        return
     prompt = prompt_entry.get("1.0", tk.END).strip()
     if not prompt:
         return
     try:
         word_limit = int(word_count_var.get())
-        if word_limit < 50 or word_limit > 500:
+        if word_limit < MIN_WORD_LIMIT or word_limit > MAX_WORD_LIMIT:
             raise ValueError
     except ValueError:
         current_time = datetime.datetime.now().strftime("%I:%M %p")
@@ -326,35 +411,8 @@ def generate_response(event=None):
         if auto_scroll_var.get():
             chat_display.see(tk.END)
         return
-    is_sonnet = "sonnet" in prompt.lower()
-    if is_sonnet:
-        max_new_tokens = int(word_limit * 1.2) + 30
-    else:
-        max_new_tokens = int(word_limit * 1.33) + 50
-    if is_sonnet:
-        topic = prompt.lower().replace("write me a sonnet", "").replace("sonnet", "").strip()
-        if not topic:
-            topic = prompt
-        base_prompt = f"Write a 14-line sonnet with an ABAB CDCD EFEF GG rhyme scheme, approximately {word_limit} words, describing {topic}"
-    else:
-        base_prompt = f"Write a {word_limit}-word story about {prompt}"
-    mood = get_sentiment_mood(prompt)
-    if mood:
-        full_prompt = f"Write a {mood} {base_prompt}"
-    else:
-        full_prompt = base_prompt
-    prompt_tokens = estimate_token_count(full_prompt)
-    print(f"Prompt token estimate: {prompt_tokens}")
-    available_tokens = CONTEXT_LENGTH - prompt_tokens
-    if available_tokens <= 0:
-        current_time = datetime.datetime.now().strftime("%I:%M %p")
-        chat_display.insert(tk.END, f"[{current_time}] Mistral 7B: Error: Prompt is too long for the model's context length ({CONTEXT_LENGTH} tokens).\n\n")
-        prompt_entry.delete("1.0", tk.END)
-        if auto_scroll_var.get():
-            chat_display.see(tk.END)
-        return
-    adjusted_max_tokens = min(max_new_tokens, available_tokens)
-    print(f"Adjusted max_new_tokens: {adjusted_max_tokens}")
+    # Traced across the UI and inference threads when profiling is on (MISTRAL_PROFILE=1)
+    trace = start_request("generate_response", word_limit=word_limit, prompt=prompt)
     current_time = datetime.datetime.now().strftime("%I:%M %p")
     chat_display.insert(tk.END, f"[{current_time}] You: {prompt}\n\n")
     thinking_message = random.choice(THINKING_MESSAGES)
@@ -366,64 +424,146 @@ def generate_response(event=None):
     prompt_entry.config(state="disabled")
     speak_button.config(state="disabled")
     clear_chat_button.config(state="disabled")
+    new_chat_button.config(state="disabled")
+    cancel_button.config(state="normal")
     progress_bar.start()
     progress_frame.pack(pady=5)
     root.update()
-    response_container = {"response": None, "error": None}
-    start_time = time.time()
+    cancel_event = threading.Event()
+    results = queue.Queue()
+    response_stats = {"tokens": None}
     def inference_thread():
         try:
-            response = model(full_prompt, stream=False, max_new_tokens=adjusted_max_tokens, temperature=0.8, top_p=0.9, stop=None)
+            with attach(trace):
+                # The prompt is built here too: memory, token counting and fitting all ask the daemon,
+                # which may first have to load the model
+                build_start = time.perf_counter()
+                # Sentiment-tuned story or sonnet prompt (shared with batch_stories.py)
+                with span("build_story_prompt"):
+                    story_prompt, is_sonnet, max_new_tokens = build_story_prompt(prompt, word_limit)
+                # Earlier turns of this chat, within the memory budget and leaving room for the reply
+                with span("conversation_memory"):
+                    full_prompt = memory.assemble(lambda context: f"{context}\n\n{story_prompt}" if context else story_prompt, prompt, max_new_tokens)
+                PROMPT_LOG.info("Conversation memory: %s", memory.last_stats)
+                prompt_tokens = budget.count(full_prompt)
+                PROMPT_LOG.info("Prompt tokens: %d", prompt_tokens)
+                results.put(("prompt", prompt_tokens))
+                adjusted_max_tokens = budget.fit_max_new_tokens(full_prompt, max_new_tokens)
+                PROMPT_BUILD_SECONDS.observe(time.perf_counter() - build_start)
+                print(f"Adjusted max_new_tokens: {adjusted_max_tokens}")
+                # Streaming lets cancel_event close the request between tokens
+                with span("write_story", sonnet=is_sonnet, max_new_tokens=adjusted_max_tokens):
+                    response, story_stats = write_story(model, full_prompt, word_limit, is_sonnet, adjusted_max_tokens, cancel_event=cancel_event)
             if is_sonnet:
-                attempts = 0
-                while not (13 <= count_lines(response) <= 15) and attempts < 2:
-                    response = model(full_prompt, stream=False, max_new_tokens=adjusted_max_tokens, temperature=0.8, top_p=0.9, stop=None)
-                    attempts += 1
-                if not (13 <= count_lines(response) <= 15):
-                    response = "Mistral 7B: Sorry, I couldn't generate a proper sonnet (13-15 lines) after several attempts."
-            response = truncate_to_word_count(response, word_limit, is_sonnet=is_sonnet)
-            response_container["response"] = response
-            response_tokens = estimate_token_count(response)
+                print(f"Sonnet generation: {story_stats['tokens']} tokens, {story_stats['restarts']} tail restarts, {story_stats['wall_time']:.2f} seconds")
+            else:
+                print(f"Story generation: {story_stats['tokens']} tokens, stopped early: {story_stats['stopped_early']}")
+            response_tokens = budget.count(response)
             response_words = count_words(response)
-            print(f"Response token estimate: {response_tokens}")
+            print(f"Response tokens: {response_tokens}")
+            response_stats["tokens"] = response_tokens
             print(f"Response word count: {response_words}")
             print(f"Response length (characters): {len(response)}")
+            results.put(("response", response))
             gc.collect()
+        except PromptTooLong:
+            results.put(("prompt_too_long", None))
+        except InferenceCancelled:
+            results.put(("cancelled", None))
         except Exception as e:
             print(f"Error during inference: {str(e)}")
-            response_container["error"] = f"Model inference failed: {str(e)}"
-    thread = threading.Thread(target=inference_thread, daemon=True)
-    thread.start()
-    timeout = 180
-    thread.join(timeout)
-    elapsed_time = time.time() - start_time
+            results.put(("error", f"Model inference failed: {str(e)}"))
+    active_generation = {
+        "cancel_event": cancel_event,
+        "results": results,
+        "response_stats": response_stats,
+        "prompt": prompt,
+        "user_recorded": False,
+        "trace": trace,
+        "start_time": time.time(),
+        "cancel_time": None,
+        "reason": None
+    }
+    threading.Thread(target=inference_thread, daemon=True).start()
+    root.after(POLL_INTERVAL_MS, poll_response)
+
+# Function to stop the running generation (Cancel button, timeout or window close)
+def cancel_generation(reason="cancelled"):
+    if active_generation is None or active_generation["cancel_event"].is_set():
+        return
+    active_generation["reason"] = reason
+    active_generation["cancel_time"] = time.time()
+    active_generation["cancel_event"].set()
+    cancel_button.config(state="disabled")
+
+# Function to check for a finished generation without blocking the Tk event loop
+def poll_response():
+    try:
+        kind, value = active_generation["results"].get_nowait()
+    except queue.Empty:
+        if time.time() - active_generation["start_time"] > GENERATION_TIMEOUT:
+            cancel_generation("timeout")
+        root.after(POLL_INTERVAL_MS, poll_response)
+        return
+    if kind == "prompt":
+        # The prompt is built; journal the user's turn with its size while the story is written
+        record_turn("user", active_generation["prompt"], tokens=value)
+        active_generation["user_recorded"] = True
+        root.after(POLL_INTERVAL_MS, poll_response)
+        return
+    finish_response(kind, value)
+
+# Function to display the outcome of a generation and re-enable the controls
+def finish_response(kind, value):
+    global active_generation
+    generation = active_generation
+    active_generation = None
+    elapsed_time = time.time() - generation["start_time"]
     print(f"Inference took {elapsed_time:.2f} seconds")
+    if generation["cancel_time"] is not None:
+        print(f"Generation stopped {time.time() - generation['cancel_time']:.2f} seconds after {generation['reason']}")
     progress_bar.stop()
     progress_frame.pack_forget()
-    if response_container["response"] is not None:
+    current_time = datetime.datetime.now().strftime("%I:%M %p")
+    chat_display.delete("end-2l", "end-1l")
+    if kind == "response":
         print("Response received, displaying in chat window")
-        current_time = datetime.datetime.now().strftime("%I:%M %p")
-        chat_display.delete("end-2l", "end-1l")
-        chat_display.insert(tk.END, f"[{current_time}] Mistral 7B: {response_container['response']}\n\n")
-        word_count = count_words(response_container['response'])
+        message, status = value, "ok"
+        memory.add_turn("user", generation["prompt"])
+        memory.add_turn("assistant", value)
+        word_count = count_words(value)
         word_count_display.config(text=f"Word Count: {word_count}")
-    elif response_container["error"]:
+    elif kind == "error":
         print("Error occurred, displaying error in chat window")
-        current_time = datetime.datetime.now().strftime("%I:%M %p")
-        chat_display.delete("end-2l", "end-1l")
-        chat_display.insert(tk.END, f"[{current_time}] Mistral 7B: Error: {response_container['error']}\n\n")
+        message, status = f"Error: {value}", "error"
+    elif kind == "prompt_too_long":
+        message, status = f"Error: Prompt is too long for the model's context length ({CONTEXT_LENGTH} tokens).", "prompt_too_long"
+    elif generation["reason"] == "timeout":
+        print("Generation timed out, displaying timeout message")
+        message, status = f"Error: Inference timed out after {GENERATION_TIMEOUT} seconds.", "timeout"
     else:
-        print("No response or error, displaying timeout message")
-        current_time = datetime.datetime.now().strftime("%I:%M %p")
-        chat_display.delete("end-2l", "end-1l")
-        chat_display.insert(tk.END, f"[{current_time}] Mistral 7B: Error: Inference timed out after {timeout} seconds.\n\n")
+        print("Generation cancelled by user")
+        message, status = "Generation cancelled.", "cancelled"
+    if kind != "response":
+        # Nothing to remember from this turn, but it is over
+        memory.resume()
+    chat_display.insert(tk.END, f"[{current_time}] Mistral 7B: {message}\n\n")
+    UI_RESPONSE_SECONDS.observe(elapsed_time)
+    UI_RESPONSES.labels(status).inc()
+    finish(generation["trace"], status=status)
+    if not generation["user_recorded"]:
+        record_turn("user", generation["prompt"])
+    record_turn("assistant", message, tokens=generation["response_stats"]["tokens"], latency=round(elapsed_time, 3), status=status)
     if auto_scroll_var.get():
         chat_display.see(tk.END)
-    root.update()
     submit_button.config(state="normal")
     prompt_entry.config(state="normal")
-    speak_button.config(state="normal")
+    if kind == "prompt_too_long":
+        prompt_entry.delete("1.0", tk.END)
+    speak_button.config(state="disabled" if voice_pipeline.running() else "normal")
     clear_chat_button.config(state="normal")
+    new_chat_button.config(state="normal")
+    cancel_button.config(state="disabled")
 
 # Create main frame for layout
 main_frame = tk.Frame(root, bg=current_colors["window_bg"])
@@ -442,7 +582,7 @@ search_label.pack(side=tk.LEFT, padx=5)
 
 search_entry = tk.Entry(search_frame, textvariable=search_var)
 search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
-search_var.trace("w", update_chat_list)
+search_var.trace("w", schedule_chat_list_update)
 
 chat_list_label = tk.Label(side_panel, text="Previous Chats:", bg=current_colors["window_bg"], fg=current_colors["text_fg"])
 chat_list_label.pack(pady=(5, 5))
@@ -455,6 +595,8 @@ chat_tree = ttk.Treeview(
 chat_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
 chat_tree.bind("<Double-1>", load_chat)
 chat_tree.bind("<Button-1>", toggle_date)
+chat_tree.bind("<<TreeviewOpen>>", on_tree_open)
+chat_tree.bind("<<TreeviewClose>>", on_tree_close)
 
 update_chat_list()
 
@@ -561,6 +703,17 @@ speak_button = tk.Button(
 )
 speak_button.pack(side=tk.LEFT, padx=5)
 
+cancel_button = tk.Button(
+    button_frame,
+    text="Cancel",
+    command=cancel_generation,
+    state="disabled",
+    fg=current_colors["button_fg"],
+    bg=current_colors["button_bg"],
+    font=("Arial", 11, "bold")
+)
+cancel_button.pack(side=tk.LEFT, padx=5)
+
 word_count_label = tk.Label(button_frame, text="Word Count:", bg=current_colors["window_bg"], fg=current_colors["text_fg"])
 word_count_label.pack(side=tk.LEFT, padx=5)
 
@@ -598,7 +751,10 @@ disclaimer_label.pack(side=tk.BOTTOM, pady=5)
 prompt_entry.bind("<Return>", generate_response)
 
 # Bind window close event to save chat history
-root.protocol("WM_DELETE_WINDOW", lambda: [save_current_chat(), root.destroy()])
+root.protocol("WM_DELETE_WINDOW", lambda: [cancel_generation(), voice_pipeline.stop(), save_current_chat(), root.destroy()])
+
+# Pick up the chat that was open if the app did not exit cleanly last time
+resume_active_chat()
 
 # Start the Tkinter event loop
 root.mainloop()
\ No newline at end of file
@@ -1,19 +1,37 @@
 import tkinter as tk
 from tkinter import ttk, scrolledtext
+import logging
 import os
+import queue
 import chromadb
-from sentence_transformers import SentenceTransformer
 import re
-from ctransformers import AutoModelForCausalLM
+import time
+from inference_client import InferenceClient, PRIORITY_NORMAL
+from prompt_templates import RAG_ANSWER_PREFIX
+from token_budget import TokenBudget, PromptTooLong
+from metrics import STAGE_SECONDS, timed, start_from_env
+from embeddings import load_embedder
+from dedup import deduplicate, chunk_metadata, describe_savings
+from retrieval import PartitionedIndex
+from extractive import fast_answer, load_thresholds, record_answer, describe_fast_path, polish_in_background, POLISH_IN_BACKGROUND
+from profiling import profile_request, traced, span
+from conversation_memory import ConversationMemory, make_summarizer
+from utils import split_text
 
-# Initialize Mistral 7B with ctransformers (CPU-only)
-mistral_model_path = os.path.expanduser("~/Documents/mistral_chat_agent/mistral-7b-instruct-v0.2.Q4_K_M.gguf")
-llm = AutoModelForCausalLM.from_pretrained(mistral_model_path, model_type="mistral", context_length=2048)
+# Use the shared Mistral 7B inference daemon (CPU-only, started on first use)
+llm = InferenceClient(priority=PRIORITY_NORMAL)
+budget = TokenBudget(llm)
 
-# Initialize Chroma client and embedding model
+# Initialize Chroma client and embedding model (MISTRAL_EMBEDDING_BACKEND=onnx_int8 for the quantized ONNX path)
 chroma_client = chromadb.Client()
-model = SentenceTransformer('all-mpnet-base-v2')
-collection = chroma_client.get_or_create_collection(name="salesforce_asa_docs")
+EMBEDDING_MODEL = 'all-mpnet-base-v2'
+model = load_embedder(EMBEDDING_MODEL)
+# Confidence thresholds for answering straight from retrieval (calibrated by "python extractive.py")
+fast_path_thresholds = load_thresholds(EMBEDDING_MODEL)
+# One partition per source document; a router decides which ones each question searches
+collection = PartitionedIndex(chroma_client, "salesforce_asa_docs")
+
+UI_RESPONSE_SECONDS = STAGE_SECONDS.labels("ui_response")
 
 # Load and process the document (same as rag_mistral.py)
 def load_document(file_path):
@@ -27,53 +45,71 @@ def clean_text(text):
     text = re.sub(r'^(Q:|A:)', '', text, flags=re.MULTILINE)
     return text.strip()
 
-def split_text(text, max_length=100):
-    sentences = re.split(r'(?<=[.!?])\s+', text)
-    chunks = []
-    current_chunk = ""
-    for sentence in sentences:
-        if len(current_chunk) + len(sentence) <= max_length:
-            current_chunk += " " + sentence
-        else:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = sentence
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    return chunks
-
+@timed(STAGE_SECONDS.labels("get_hf_embedding"))
+@traced("get_hf_embedding")
 def get_hf_embedding(text):
     embedding = model.encode(text, convert_to_numpy=True)
     return embedding.tolist()
 
-def store_document_in_chroma(doc):
-    doc_id = doc["id"]
-    text = doc["text"]
-    chunks = split_text(text)
-    for i, chunk in enumerate(chunks):
-        chunk_id = f"{doc_id}_chunk_{i}"
-        embedding = get_hf_embedding(chunk)
+# Several texts in one encode call (the fast path embeds a chunk's sentences together)
+def get_hf_embeddings(texts):
+    return model.encode(texts, convert_to_numpy=True).tolist()
+
+def store_documents_in_chroma(docs):
+    chunks = [{"id": f"{doc['id']}_chunk_{i}", "text": chunk, "source": doc["id"]} for doc in docs for i, chunk in enumerate(split_text(doc["text"]))]
+    # Boilerplate repeated within and across the FAQs (near-duplicate chunks, MinHash/LSH) is embedded and stored once
+    kept, report = deduplicate(chunks)
+    embed_start = time.perf_counter()
+    embedding = []
+    for chunk in kept:
+        embedding = get_hf_embedding(chunk["text"])
         collection.upsert(
-            ids=[chunk_id],
+            ids=[chunk["id"]],
             embeddings=[embedding],
-            documents=[chunk],
-            metadatas=[{"source": doc_id}]
+            documents=[chunk["text"]],
+            metadatas=[chunk_metadata(chunk)]
         )
+    print(describe_savings(report, time.perf_counter() - embed_start, len(embedding)))
 
-# Query documents (same as rag_mistral.py)
-def query_documents(question, top_k=5):
+# Query documents (same as rag_mistral.py); returns the question embedding and the Chroma result
+@timed(STAGE_SECONDS.labels("query_documents"))
+@traced("query_documents")
+def retrieve(question, top_k=5, where=None):
     question_embedding = get_hf_embedding(question)
-    results = collection.query(
-        query_embeddings=[question_embedding],
-        n_results=top_k
-    )
-    return results["documents"][0]
-
-# Generate answer with Mistral using retrieved documents
-def generate_answer_with_mistral(question, retrieved_docs):
-    context = " ".join(retrieved_docs)
-    prompt = f"Answer based only on the provided context. Do not add information beyond the context. Question: '{question}' Context:\n\n{context}\n\nAnswer in a friendly way: "
-    response = llm(prompt, max_new_tokens=500, temperature=0.7, top_p=0.9)
+    with span("chroma_query", top_k=top_k):
+        # An explicit where filter (e.g. {"source": "Salesforce ASA FAQ.txt"}) overrides the router
+        results = collection.query(
+            query_embeddings=[question_embedding],
+            n_results=top_k,
+            where=where,
+            questions=[question]
+        )
+    return question_embedding, results
+
+def query_documents(question, top_k=5, where=None):
+    return retrieve(question, top_k, where)[1]["documents"][0]
+
+# Generate answer with Mistral using retrieved documents and earlier turns of the conversation
+@timed(STAGE_SECONDS.labels("generate_answer"))
+@traced("generate_answer_with_mistral")
+def generate_answer_with_mistral(question, retrieved_docs, memory=None):
+    conversation = ""
+    def build_prompt(docs):
+        earlier = f"{conversation}\n\n" if conversation else ""
+        return f"{RAG_ANSWER_PREFIX}{question}' {earlier}Context:\n\n{' '.join(docs)}\n\nAnswer in a friendly way: "
+    if memory is not None:
+        # Memory is capped by its own budget; documents then fill what is left
+        room = budget.context_length - 500 - budget.count(build_prompt([]))
+        if room > 0:
+            with span("conversation_memory"):
+                conversation = memory.context(question, room)
+    try:
+        # Drop trailing (least relevant) chunks until prompt and reply fit the context window
+        with span("fit_documents", retrieved=len(retrieved_docs)):
+            docs = budget.fit_documents(build_prompt, retrieved_docs, 500)
+    except PromptTooLong:
+        return "Sorry, that question is too long for me to answer."
+    response = llm(build_prompt(docs), max_new_tokens=500, temperature=0.7, top_p=0.9)
     return response
 
 # Load multiple documents at startup
@@ -82,14 +118,17 @@ doc_paths = [
     "./test_data/Salesforce Data Cloud Sandbox FAQ.txt"
 ]
 
+# All documents are chunked first, so duplicates are found across the whole corpus before embedding
+docs = []
 for doc_path in doc_paths:
     if os.path.exists(doc_path):
         doc = load_document(doc_path)
         doc["text"] = clean_text(doc["text"])
-        store_document_in_chroma(doc)
+        docs.append(doc)
         print(f"Loaded and processed document: {doc['id']}")
     else:
         print(f"Document not found: {doc_path}")
+store_documents_in_chroma(docs)
 
 # Tkinter UI
 class ChatApp:
@@ -97,6 +136,12 @@ class ChatApp:
         self.root = root
         self.root.title("Mistral Chat Agent")
         
+        # Recent turns verbatim; older ones summarized in the background and recalled by embedding similarity.
+        # Embedded without get_hf_embedding's timing, which measures retrieval only
+        self.memory = ConversationMemory(budget, summarize=make_summarizer(llm, budget), embed=lambda text: model.encode(text, convert_to_numpy=True).tolist())
+        # Rephrased fast answers arrive from background threads; the UI thread shows them
+        self.polished = queue.Queue()
+        
         # Chat display
         self.chat_display = scrolledtext.ScrolledText(root, wrap=tk.WORD, width=60, height=20)
         self.chat_display.grid(row=0, column=0, columnspan=2, padx=10, pady=10)
@@ -131,21 +176,58 @@ class ChatApp:
             self.exit_app()
             return
         
-        # Get RAG response
-        retrieved_docs = query_documents(user_input)
-        response = generate_answer_with_mistral(user_input, retrieved_docs)
+        # Get RAG response; a confident top hit is answered with its best sentence, skipping the LLM
+        start_time = time.perf_counter()
+        with profile_request("rag_answer", question=user_input):
+            question_embedding, results = retrieve(user_input)
+            retrieved_docs = results["documents"][0]
+            response = fast_answer(question_embedding, results, get_hf_embeddings, fast_path_thresholds)
+            path = "extractive" if response is not None else "llm"
+            if response is None:
+                try:
+                    response = generate_answer_with_mistral(user_input, retrieved_docs, self.memory)
+                except Exception:
+                    # The turn ends unanswered; background summaries may run again
+                    self.memory.resume()
+                    raise
+        record_answer(path, time.perf_counter() - start_time)
+        self.memory.add_turn("user", user_input)
+        answer_turn = self.memory.add_turn("assistant", response)
         
         # Display response
+        self.show_response(response)
+        UI_RESPONSE_SECONDS.observe(time.perf_counter() - start_time)
+        if path == "extractive" and POLISH_IN_BACKGROUND:
+            polish_in_background(lambda: generate_answer_with_mistral(user_input, retrieved_docs), lambda result: self.polished.put((answer_turn, result)))
+            self.root.after(200, self.show_polished)
+
+    def show_response(self, response, label="Agent"):
         self.chat_display.config(state='normal')
-        self.chat_display.insert(tk.END, f"Agent: {response}\n\n")
+        self.chat_display.insert(tk.END, f"{label}: {response}\n\n")
         self.chat_display.see(tk.END)
         self.chat_display.config(state='disabled')
 
+    # Poll for a rephrased fast answer (Tk widgets are only touched from the UI thread); it replaces the
+    # fast answer in the conversation memory. A failed rephrasing ends the polling and keeps the fast answer
+    def show_polished(self):
+        try:
+            answer_turn, polished = self.polished.get_nowait()
+        except queue.Empty:
+            self.root.after(200, self.show_polished)
+            return
+        if isinstance(polished, Exception):
+            logging.warning("Could not rephrase the answer: %s", polished)
+            return
+        self.memory.replace_turn(answer_turn, polished)
+        self.show_response(polished, "Agent (in more detail)")
+
     def exit_app(self):
+        print(describe_fast_path())
         self.root.quit()
 
 # Run the app
 if __name__ == "__main__":
+    start_from_env()
     root = tk.Tk()
     app = ChatApp(root)
     root.mainloop()
\ No newline at end of file
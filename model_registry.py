@@ -0,0 +1,158 @@
+import argparse
+import glob
+import json
+import os
+import re
+
+# Directories searched for model files (MISTRAL_MODEL_DIR is searched first)
+MODEL_DIRS = [
+    os.environ.get("MISTRAL_MODEL_DIR", ""),
+    os.path.expanduser("~/Documents/mistral_chat_agent"),
+    os.path.dirname(os.path.abspath(__file__)),
+    "."
+]
+MODEL_PATTERN = "mistral-7b-instruct-v0.2.*.gguf"
+
+# Quantizations from best to worst quality; the first one that fits the memory budget is used
+QUANT_ORDER = ["Q8_0", "Q6_K", "Q5_K_M", "Q5_K_S", "Q5_0", "Q4_K_M", "Q4_K_S", "Q4_0", "Q3_K_L", "Q3_K_M", "Q3_K_S", "Q2_K"]
+
+# Memory needed on top of the weights: f16 KV cache per context token (32 layers x 1024 KV dims x K and V)
+KV_BYTES_PER_TOKEN = 2 * 32 * 1024 * 2
+# Scratch buffers and the Python process itself
+RUNTIME_OVERHEAD_BYTES = 400 * 1024 ** 2
+# Share of the currently available RAM the model may take
+AVAILABLE_RAM_SHARE = 0.9
+
+GB = 1024 ** 3
+
+
+# Function to read the quantization name from a GGUF file name
+def parse_quant(path):
+    match = re.search(r"\.((?:Q|IQ)\d\w*|F16|F32)\.gguf$", os.path.basename(path), re.IGNORECASE)
+    return match.group(1).upper() if match else None
+
+
+# Function to estimate resident memory for a model file served with a given context window.
+# With continuous batching the batch decoder's context has its own KV cache next to the serial one
+def estimate_memory(size_bytes, context_length, batch_context_length=0):
+    return size_bytes + (context_length + batch_context_length) * KV_BYTES_PER_TOKEN + RUNTIME_OVERHEAD_BYTES
+
+
+# Function to list the model files on disk, best quality first
+def find_variants(dirs=None):
+    variants = {}
+    for directory in dirs or MODEL_DIRS:
+        if not directory:
+            continue
+        for path in glob.glob(os.path.join(os.path.expanduser(directory), MODEL_PATTERN)):
+            quant = parse_quant(path)
+            # The same quantization in several directories: the first directory wins
+            if quant and quant not in variants:
+                variants[quant] = {"quant": quant, "path": os.path.abspath(path), "size_bytes": os.path.getsize(path)}
+    rank = {quant: i for i, quant in enumerate(QUANT_ORDER)}
+    return sorted(variants.values(), key=lambda variant: (rank.get(variant["quant"], len(QUANT_ORDER)), variant["size_bytes"]))
+
+
+# Function to get the RAM free for a model right now
+def available_memory():
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        return None
+
+
+# Function to pick the best variant that fits both the available RAM and the configured budget
+def select_variant(variants, context_length, available=None, budget=None, batch_context_length=0):
+    limits = []
+    if available is not None:
+        limits.append((available * AVAILABLE_RAM_SHARE, f"{AVAILABLE_RAM_SHARE:.0%} of {available / GB:.1f} GB available RAM"))
+    if budget is not None:
+        limits.append((budget, f"the {budget / GB:.1f} GB memory budget"))
+    limit, limit_reason = min(limits) if limits else (None, "no memory limit known")
+    for variant in variants:
+        needed = estimate_memory(variant["size_bytes"], context_length, batch_context_length)
+        if limit is None or needed <= limit:
+            skipped = variants.index(variant)
+            better = f"; {skipped} better variant(s) do not fit" if skipped else ""
+            return variant, f"best quality that fits {limit_reason} (needs about {needed / GB:.1f} GB{better})"
+    smallest = min(variants, key=lambda variant: variant["size_bytes"])
+    needed = estimate_memory(smallest["size_bytes"], context_length, batch_context_length)
+    return smallest, f"no variant fits {limit_reason}; using the smallest (needs about {needed / GB:.1f} GB)"
+
+
+# Knows which model files exist, which one the daemon serves and why
+class ModelRegistry:
+    def __init__(self, context_length, memory_budget=None, dirs=None, pinned_path=None, batch_context_length=0):
+        self.context_length = context_length
+        self.batch_context_length = batch_context_length
+        self.memory_budget = memory_budget
+        self.dirs = dirs
+        self.pinned_path = pinned_path
+        self.variants = []
+        self.selected = None
+        self.reason = None
+        self.available_at_selection = None
+
+    # Picks the model file; MISTRAL_MODEL_PATH or --model pins one file and skips the selection
+    def select(self):
+        self.variants = find_variants(self.dirs)
+        self.available_at_selection = available_memory()
+        if self.pinned_path:
+            if not os.path.exists(self.pinned_path):
+                raise FileNotFoundError(f"Mistral model file not found: {self.pinned_path}")
+            size = os.path.getsize(self.pinned_path)
+            self.selected = {"quant": parse_quant(self.pinned_path), "path": os.path.abspath(self.pinned_path), "size_bytes": size}
+            self.reason = "pinned by --model or MISTRAL_MODEL_PATH"
+            return self.selected
+        if not self.variants:
+            searched = ", ".join(os.path.join(d, MODEL_PATTERN) for d in (self.dirs or MODEL_DIRS) if d)
+            raise FileNotFoundError(f"Mistral model file not found (searched: {searched})")
+        self.selected, self.reason = select_variant(self.variants, self.context_length, self.available_at_selection, self.memory_budget,
+                                                    self.batch_context_length)
+        return self.selected
+
+    def report(self):
+        return {
+            "selected": self.selected["quant"] if self.selected else None,
+            "path": self.selected["path"] if self.selected else None,
+            "reason": self.reason,
+            "memory_budget_gb": self.memory_budget / GB if self.memory_budget else None,
+            "available_gb_at_selection": self.available_at_selection / GB if self.available_at_selection else None,
+            "variants": [
+                {"quant": variant["quant"], "path": variant["path"], "size_gb": variant["size_bytes"] / GB,
+                 "estimated_gb": estimate_memory(variant["size_bytes"], self.context_length, self.batch_context_length) / GB}
+                for variant in self.variants
+            ]
+        }
+
+
+# Function to read the memory budget (GB) from the environment
+def memory_budget_from_env():
+    value = os.environ.get("MISTRAL_MEMORY_BUDGET_GB")
+    return float(value) * GB if value else None
+
+
+# Function to find the model file to serve with the default settings (continuous batching on)
+def find_model_path(context_length=2048):
+    from batch_scheduler import BATCH_CONTEXT_TOKENS
+    registry = ModelRegistry(context_length, memory_budget_from_env(), pinned_path=os.environ.get("MISTRAL_MODEL_PATH"),
+                             batch_context_length=max(BATCH_CONTEXT_TOKENS, context_length))
+    return registry.select()["path"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the Mistral model variants on disk and show which one fits this host")
+    parser.add_argument("--context-length", type=int, default=2048)
+    parser.add_argument("--memory-budget-gb", type=float, default=None, help="Most memory the model may use (default: MISTRAL_MEMORY_BUDGET_GB)")
+    parser.add_argument("--no-batching", action="store_true", help="Leave out the continuous batching context's KV cache")
+    args = parser.parse_args()
+    budget = args.memory_budget_gb * GB if args.memory_budget_gb else memory_budget_from_env()
+    from batch_scheduler import BATCH_CONTEXT_TOKENS
+    batch_context_length = 0 if args.no_batching else max(BATCH_CONTEXT_TOKENS, args.context_length)
+    registry = ModelRegistry(args.context_length, budget, pinned_path=os.environ.get("MISTRAL_MODEL_PATH"), batch_context_length=batch_context_length)
+    try:
+        registry.select()
+    except FileNotFoundError as e:
+        print(str(e))
+    print(json.dumps(registry.report(), indent=2))
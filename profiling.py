@@ -0,0 +1,305 @@
+import cProfile
+import functools
+import itertools
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# Profiling is off unless MISTRAL_PROFILE=1 or --profile is given; spans then cost a flag check
+PROFILE_ENABLED = os.environ.get("MISTRAL_PROFILE") == "1" or "--profile" in sys.argv
+PROFILE_DIR = os.environ.get("MISTRAL_PROFILE_DIR", "profiles")
+# Requests slower than this also keep their cProfile stats and tracemalloc snapshot
+SLOW_REQUEST_SECONDS = float(os.environ.get("MISTRAL_PROFILE_SLOW_SECONDS", "2.0"))
+# Which deep profilers run alongside the span trace: "cprofile", "tracemalloc", both or neither
+PROFILE_DEEP = {name for name in os.environ.get("MISTRAL_PROFILE_DEEP", "cprofile").split(",") if name}
+TRACEMALLOC_TOP = 25
+
+request_ids = itertools.count(1)
+local = threading.local()
+tracemalloc_lock = threading.Lock()
+tracemalloc_users = 0
+
+
+# Does nothing; returned by span() when no request is being traced
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        stack = local.__dict__.setdefault("stack", [])
+        self.parent = stack[-1] if stack and stack[-1] is not None else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter()
+        # A generator closed late (after its caller opened other spans) is not on top of the stack
+        if local.stack and local.stack[-1] is self:
+            local.stack.pop()
+        elif self in local.stack:
+            local.stack.remove(self)
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.trace.add(self, end)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def path(self):
+        names = []
+        span = self
+        while span is not None:
+            names.append(span.name)
+            span = span.parent
+        return ";".join(reversed(names))
+
+
+# One traced request: a tree of spans (possibly on several threads) plus optional deep profiles
+class RequestTrace:
+    def __init__(self, name, directory=PROFILE_DIR, slow_seconds=SLOW_REQUEST_SECONDS, deep=None, **args):
+        global tracemalloc_users
+        self.id = next(request_ids)
+        self.name = name
+        self.directory = directory
+        self.slow_seconds = slow_seconds
+        self.deep = PROFILE_DEEP if deep is None else set(deep)
+        self.spans = []
+        self.instants = []
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.finished = False
+        if "tracemalloc" in self.deep:
+            with tracemalloc_lock:
+                if tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start(10)
+                tracemalloc_users += 1
+        self.root = Span(self, name, dict(args))
+        self.root.parent = None
+        self.root.start = time.perf_counter()
+        self.root_thread = threading.get_ident()
+        self.thread_names = {}
+
+    # Makes this request the current one on the calling thread (worker threads call it too)
+    def attach(self):
+        return Attachment(self)
+
+    def add(self, span, end):
+        with self.lock:
+            self.spans.append((span, end, threading.get_ident()))
+
+    def instant(self, name, **args):
+        with self.lock:
+            self.instants.append((name, time.perf_counter(), threading.get_ident(), args))
+
+    def finish(self, **args):
+        global tracemalloc_users
+        if self.finished:
+            return None
+        self.finished = True
+        end = time.perf_counter()
+        self.root.args.update(args)
+        elapsed = end - self.root.start
+        slow = elapsed >= self.slow_seconds
+        snapshot = None
+        if "tracemalloc" in self.deep:
+            with tracemalloc_lock:
+                if slow:
+                    snapshot = tracemalloc.take_snapshot()
+                tracemalloc_users -= 1
+                if tracemalloc_users == 0:
+                    tracemalloc.stop()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        stem = os.path.join(self.directory, f"{time.strftime('%Y%m%d_%H%M%S')}_{self.id:04d}_{self.name}")
+        with self.lock:
+            spans = list(self.spans) + [(self.root, end, self.root_thread)]
+            instants = list(self.instants)
+        with open(stem + ".trace.json", "w") as file:
+            json.dump(self.chrome_trace(spans, instants), file)
+        with open(stem + ".folded", "w") as file:
+            file.write(self.folded(spans))
+        written = [stem + ".trace.json", stem + ".folded"]
+        if slow and self.profiles:
+            stats = pstats.Stats(self.profiles[0])
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(stem + ".prof")
+            written.append(stem + ".prof")
+        if snapshot is not None:
+            with open(stem + ".tracemalloc.txt", "w") as file:
+                file.write(f"Top {TRACEMALLOC_TOP} allocation sites for {self.name} ({elapsed:.2f}s)\n")
+                for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                    file.write(f"{stat}\n")
+            written.append(stem + ".tracemalloc.txt")
+        logging.info(f"Profile of {self.name} ({elapsed:.2f}s{', slow' if slow else ''}): {', '.join(written)}")
+        return written
+
+    # Chrome trace event format: opens in chrome://tracing, Perfetto and speedscope
+    def chrome_trace(self, spans, instants):
+        origin = self.root.start
+        events = []
+        for span, end, thread in spans:
+            events.append({"name": span.name, "ph": "X", "pid": os.getpid(), "tid": thread,
+                           "ts": (span.start - origin) * 1e6, "dur": (end - span.start) * 1e6, "args": span.args})
+        for name, at, thread, args in instants:
+            events.append({"name": name, "ph": "i", "s": "t", "pid": os.getpid(), "tid": thread, "ts": (at - origin) * 1e6, "args": args})
+        for thread, name in self.thread_names.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread, "args": {"name": name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    # Folded stacks ("request;stage;step microseconds") for flamegraph.pl, inferno and speedscope
+    def folded(self, spans):
+        child_time = {}
+        for span, end, _ in spans:
+            if span.parent is not None:
+                child_time[id(span.parent)] = child_time.get(id(span.parent), 0.0) + (end - span.start)
+        totals = {}
+        for span, end, _ in spans:
+            self_time = max((end - span.start) - child_time.get(id(span), 0.0), 0.0)
+            path = span.path()
+            totals[path] = totals.get(path, 0) + int(self_time * 1e6)
+        return "".join(f"{path} {value}\n" for path, value in totals.items() if value > 0)
+
+
+# Puts a request on the current thread for the duration of a with-block, with cProfile if asked for
+class Attachment:
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        stack = local.__dict__.setdefault("stack", [])
+        stack.append(self.trace.root)
+        self.trace.thread_names[threading.get_ident()] = threading.current_thread().name
+        self.profile = None
+        if "cprofile" in self.trace.deep:
+            try:
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+            except ValueError:
+                # Another profiler is already active on this interpreter (one at a time on 3.12+)
+                self.profile = None
+        return self.trace
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.profile is not None:
+            self.profile.disable()
+            with self.trace.lock:
+                self.trace.profiles.append(self.profile)
+        local.stack.pop()
+        return False
+
+
+# Function to start tracing a request; returns None when profiling is off.
+# Use "with trace.attach():" on each thread that works on it, then trace.finish()
+def start_request(name, **args):
+    if not PROFILE_ENABLED:
+        return None
+    return RequestTrace(name, **args)
+
+
+# Function to attach a request that may be None (profiling off) to the current thread
+def attach(trace):
+    return trace.attach() if trace is not None else NULL_SPAN
+
+
+# Function to finish a request that may be None (profiling off)
+def finish(trace, **args):
+    if trace is not None:
+        trace.finish(**args)
+
+
+# Traces a whole request that runs on one thread: "with profile_request("process_query"):"
+class profile_request:
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.trace = start_request(self.name, **self.args)
+        if self.trace is not None:
+            self.attachment = self.trace.attach()
+            self.attachment.__enter__()
+        return self.trace
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.trace is not None:
+            self.attachment.__exit__(exc_type, exc, traceback)
+            self.trace.finish(error=exc_type.__name__ if exc_type else None)
+        return False
+
+
+# Function to time a step of the current request: "with span("chroma_query"):"
+def span(name, **args):
+    if not PROFILE_ENABLED:
+        return NULL_SPAN
+    stack = getattr(local, "stack", None)
+    if not stack:
+        return NULL_SPAN
+    return Span(stack[-1].trace, name, args)
+
+
+# Decorator tracing each call of a function as a request of its own
+def profiled(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILE_ENABLED:
+                return function(*args, **kwargs)
+            with profile_request(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Decorator running a function as a span of the current request
+def traced(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILE_ENABLED:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Function to add details (question, sizes, outcome) to the innermost open span
+def annotate(**args):
+    if not PROFILE_ENABLED:
+        return
+    stack = getattr(local, "stack", None)
+    if stack:
+        stack[-1].args.update(args)
+
+
+# Function to mark a moment in the current request (e.g. the first streamed token)
+def instant(name, **args):
+    if not PROFILE_ENABLED:
+        return
+    stack = getattr(local, "stack", None)
+    if stack:
+        stack[-1].trace.instant(name, **args)
@@ -0,0 +1,35 @@
+# Fixed instruction prefixes shared by the entry points.
+# Prompts are built as prefix + variable suffix so the inference daemon can
+# reuse the prefix's KV state instead of re-evaluating it on every call.
+
+# mistral_chase_assistant.py: rephrase a retrieved FAQ answer
+FAQ_REPHRASE_PREFIX = "Rephrase this answer in a friendly, conversational tone (max 50 words) and end with 'Thank you!': '"
+
+# mistral_chase_assistant.py: human escalation message
+FAQ_ESCALATION_PREFIX = "Generate a friendly message (max 50 words) saying human intervention is needed for '"
+
+# mistral_chat_ui_rag.py: grounded RAG answer
+RAG_ANSWER_PREFIX = "Answer based only on the provided context. Do not add information beyond the context. Question: '"
+
+# rag_mistral.py: command-line RAG answer
+RAG_CLI_PREFIX = "Hey there! You asked: '"
+
+# conversation_memory.py: background summary of older chat turns
+CONVERSATION_SUMMARY_PREFIX = "Summarize this conversation in at most three sentences. Keep names, facts and requests the user may refer back to.\n\n"
+
+TEMPLATES = {
+    "faq_rephrase": FAQ_REPHRASE_PREFIX,
+    "faq_escalation": FAQ_ESCALATION_PREFIX,
+    "rag_answer": RAG_ANSWER_PREFIX,
+    "rag_cli": RAG_CLI_PREFIX,
+    "conversation_summary": CONVERSATION_SUMMARY_PREFIX
+}
+
+# Representative suffixes, used when measuring time-to-first-token per template
+EXAMPLE_SUFFIXES = {
+    "faq_rephrase": "You can deposit checks using the Chase Mobile app by selecting Deposit Checks and following the prompts.'",
+    "faq_escalation": "I think someone used my card without permission', create a case 'CASE-123456', and end with 'Thank you!'",
+    "rag_answer": "What is a sandbox?' Context:\n\nA sandbox is an isolated copy of your org used for development and testing. Data Cloud sandboxes mirror production configuration.\n\nAnswer in a friendly way: ",
+    "rag_cli": "How do I enable ASA?' Here's what I found in the Salesforce ASA FAQ:\n\nAn administrator enables the feature from Setup and assigns the required permission set.\n\nBased on this, let me answer in a friendly way: ",
+    "conversation_summary": "Summary so far: The user asked for a story about a lighthouse keeper.\n\nUser: Make the seagull the hero this time\nAssistant: The seagull spotted the ship first and led it home.\n\nSummary:"
+}
@@ -1,16 +1,33 @@
+import argparse
+import json
 import os
+import queue
+import threading
 import chromadb
-from sentence_transformers import SentenceTransformer
 import re
-from ctransformers import AutoModelForCausalLM
+import time
+from inference_client import InferenceClient, PRIORITY_NORMAL, PRIORITY_LOW
+from prompt_templates import RAG_CLI_PREFIX
+from token_budget import TokenBudget, PromptTooLong
+from metrics import STAGE_SECONDS, timed, start_from_env
+from embeddings import load_embedder
+from dedup import deduplicate, chunk_metadata, describe_savings
+from retrieval import PartitionedIndex
+from extractive import fast_answer, load_thresholds, record_answer, fast_path_report, describe_fast_path
+from profiling import profiled, traced, span, annotate
+from batch_stories import Checkpoint, load_done
+from utils import split_text, percentile
 
-# Initialize Mistral 7B with ctransformers (CPU-only)
-mistral_model_path = os.path.expanduser("~/Documents/mistral_chat_agent/mistral-7b-instruct-v0.2.Q4_K_M.gguf")
-llm = AutoModelForCausalLM.from_pretrained(mistral_model_path, model_type="mistral", context_length=2048)
+# Use the shared Mistral 7B inference daemon (CPU-only, started on first use)
+llm = InferenceClient(priority=PRIORITY_NORMAL)
+budget = TokenBudget(llm)
 
-# Initialize Chroma client and embedding model
+# Initialize Chroma client and embedding model (MISTRAL_EMBEDDING_BACKEND=onnx_int8 for the quantized ONNX path)
 chroma_client = chromadb.Client()
-model = SentenceTransformer('all-MiniLM-L6-v2')
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+model = load_embedder(EMBEDDING_MODEL)
+# Confidence thresholds for answering straight from retrieval (calibrated by "python extractive.py")
+fast_path_thresholds = load_thresholds(EMBEDDING_MODEL)
 
 def load_document(file_path):
     with open(file_path, "r", encoding="utf-8") as f:
@@ -23,68 +40,236 @@ def clean_text(text):
     text = re.sub(r'^(Q:|A:)', '', text, flags=re.MULTILINE)
     return text.strip()
 
-def split_text(text, max_length=100):
-    sentences = re.split(r'(?<=[.!?])\s+', text)
-    chunks = []
-    current_chunk = ""
-    for sentence in sentences:
-        if len(current_chunk) + len(sentence) <= max_length:
-            current_chunk += " " + sentence
-        else:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = sentence
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    return chunks
-
+@timed(STAGE_SECONDS.labels("get_hf_embedding"))
+@traced("get_hf_embedding")
 def get_hf_embedding(text):
     embedding = model.encode(text, convert_to_numpy=True)
     return embedding.tolist()
 
-def store_document_in_chroma(doc, collection_name="salesforce_asa_docs"):
-    collection = chroma_client.get_or_create_collection(name=collection_name)
-    doc_id = doc["id"]
-    text = doc["text"]
-    chunks = split_text(text)
-    for i, chunk in enumerate(chunks):
-        chunk_id = f"{doc_id}_chunk_{i}"
-        embedding = get_hf_embedding(chunk)
+# Several texts in one encode call (batch mode embeds upcoming questions together)
+@timed(STAGE_SECONDS.labels("get_hf_embeddings"))
+@traced("get_hf_embeddings")
+def get_hf_embeddings(texts):
+    embeddings = model.encode(texts, convert_to_numpy=True)
+    return embeddings.tolist()
+
+def store_documents_in_chroma(docs, collection_name="salesforce_asa_docs"):
+    # One partition per source document; a router decides which ones each question searches
+    collection = PartitionedIndex(chroma_client, collection_name)
+    chunks = [{"id": f"{doc['id']}_chunk_{i}", "text": chunk, "source": doc["id"]} for doc in docs for i, chunk in enumerate(split_text(doc["text"]))]
+    # Repeated boilerplate (near-duplicate chunks, MinHash/LSH) is embedded and stored once (MISTRAL_DEDUP=0 keeps all)
+    kept, report = deduplicate(chunks)
+    embed_start = time.perf_counter()
+    embedding = []
+    for chunk in kept:
+        embedding = get_hf_embedding(chunk["text"])
         collection.upsert(
-            ids=[chunk_id],
+            ids=[chunk["id"]],
             embeddings=[embedding],
-            documents=[chunk],
-            metadatas=[{"source": doc_id}]
+            documents=[chunk["text"]],
+            metadatas=[chunk_metadata(chunk)]
         )
+    print(describe_savings(report, time.perf_counter() - embed_start, len(embedding)))
     return collection
 
-def query_documents(question, collection, top_k=5):
+# Embed the question and search; returns the embedding and the Chroma result (with distances)
+@timed(STAGE_SECONDS.labels("query_documents"))
+@traced("query_documents")
+def retrieve(question, collection, top_k=5, where=None):
     question_embedding = get_hf_embedding(question)
-    results = collection.query(
-        query_embeddings=[question_embedding],
-        n_results=top_k
-    )
-    return results["documents"][0]
+    with span("chroma_query", top_k=top_k):
+        # An explicit where filter (e.g. {"source": "Salesforce ASA FAQ.txt"}) overrides the router
+        results = collection.query(
+            query_embeddings=[question_embedding],
+            n_results=top_k,
+            where=where,
+            questions=[question]
+        )
+    return question_embedding, results
 
+def query_documents(question, collection, top_k=5, where=None):
+    return retrieve(question, collection, top_k, where)[1]["documents"][0]
+
+@timed(STAGE_SECONDS.labels("generate_answer"))
+@traced("generate_answer_with_mistral")
 def generate_answer_with_mistral(question, retrieved_docs):
-    context = " ".join(retrieved_docs)
-    prompt = f"Hey there! You asked: '{question}' Here's what I found in the Salesforce ASA FAQ:\n\n{context}\n\nBased on this, let me answer in a friendly way: "
-    response = llm(prompt, max_new_tokens=500, temperature=0.7, top_p=0.9)
+    def build_prompt(docs):
+        return f"{RAG_CLI_PREFIX}{question}' Here's what I found in the Salesforce ASA FAQ:\n\n{' '.join(docs)}\n\nBased on this, let me answer in a friendly way: "
+    try:
+        # Drop trailing (least relevant) chunks until prompt and reply fit the context window
+        with span("fit_documents", retrieved=len(retrieved_docs)):
+            docs = budget.fit_documents(build_prompt, retrieved_docs, 500)
+    except PromptTooLong:
+        return "Sorry, that question is too long for me to answer."
+    response = llm(build_prompt(docs), max_new_tokens=500, temperature=0.7, top_p=0.9)
     return response
 
+# Retrieve and answer one question (traced as one request when profiling is on)
+@profiled("rag_answer")
+def answer_question(question, collection):
+    annotate(question=question)
+    start_time = time.perf_counter()
+    question_embedding, results = retrieve(question, collection)
+    # A confident top hit is answered with its best sentence, skipping the LLM
+    answer = fast_answer(question_embedding, results, get_hf_embeddings, fast_path_thresholds)
+    if answer is not None:
+        annotate(path="extractive")
+        record_answer("extractive", time.perf_counter() - start_time)
+        return answer
+    answer = generate_answer_with_mistral(question, results["documents"][0])
+    record_answer("llm", time.perf_counter() - start_time)
+    return answer
+
+# Read questions: plain text (one per line) or JSONL with {"question": ...} and an optional "id".
+# The id defaults to the line number, which is what a resumed run matches on
+def load_questions(path):
+    questions = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                item = json.loads(line)
+                questions.append({"id": str(item.get("id", line_number)), "question": item["question"]})
+            else:
+                questions.append({"id": str(line_number), "question": line})
+    return questions
+
+# Put an item on the lookahead queue, giving up if the run is stopping
+def put_ready(ready, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            ready.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+# Retrieve context for upcoming questions, a batch at a time (one encode call, one query per partition),
+# while the main thread generates; runs in its own thread and stays at most `lookahead` questions ahead
+def retrieve_ahead(pending, collection, ready, stop_event, batch_size, top_k=5):
+    try:
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            questions = [item["question"] for item in batch]
+            embed_start = time.perf_counter()
+            embeddings = get_hf_embeddings(questions)
+            query_start = time.perf_counter()
+            results = collection.query(query_embeddings=embeddings, n_results=top_k, questions=questions)
+            query_end = time.perf_counter()
+            for row, item in enumerate(batch):
+                item = dict(item, embedding=embeddings[row], docs=results["documents"][row], chunk_ids=results["ids"][row],
+                            distances=results["distances"][row], timings={
+                    "embed_seconds": (query_start - embed_start) / len(batch),
+                    "retrieve_seconds": (query_end - query_start) / len(batch)
+                })
+                if not put_ready(ready, item, stop_event):
+                    return
+    except Exception as e:
+        put_ready(ready, e, stop_event)
+        return
+    put_ready(ready, None, stop_event)
+
+# Summarize a batch run: throughput and per-stage latency
+def summarize_batch(results, wall_time):
+    summary = {
+        "answers": len(results),
+        "errors": sum(1 for result in results if "error" in result),
+        "wall_seconds": wall_time,
+        "answers_per_hour": len(results) * 3600 / wall_time if wall_time else 0.0,
+        "fast_path": fast_path_report()
+    }
+    for stage in ("embed_seconds", "retrieve_seconds", "wait_seconds", "generate_seconds"):
+        values = [result["timings"][stage] for result in results]
+        summary[stage] = {"total": sum(values), "p50": percentile(values, 50), "p95": percentile(values, 95)} if values else None
+    return summary
+
+# Answer every question in a file, writing one JSONL line per answer; questions already in the output are skipped
+def run_batch(collection, questions_path, output_path, batch_size, lookahead, report_path=None):
+    questions = load_questions(questions_path)
+    done = load_done(output_path)
+    # Answers that failed (e.g. the daemon went away) are retried; the later line supersedes the earlier one
+    pending = [item for item in questions if item["id"] not in done or "error" in done[item["id"]]]
+    print(f"{len(questions)} questions, {len(questions) - len(pending)} already answered, {len(pending)} to answer")
+    if not pending:
+        return None
+    # Nightly runs yield to interactive tools sharing the daemon
+    llm.priority = PRIORITY_LOW
+    checkpoint = Checkpoint(output_path)
+    ready = queue.Queue(maxsize=lookahead)
+    stop_event = threading.Event()
+    threading.Thread(target=retrieve_ahead, args=(pending, collection, ready, stop_event, batch_size), daemon=True).start()
+    results = []
+    start_time = time.time()
+    try:
+        while True:
+            wait_start = time.perf_counter()
+            item = ready.get()
+            wait = time.perf_counter() - wait_start
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            generate_start = time.perf_counter()
+            result = {"id": item["id"], "question": item["question"], "chunk_ids": item["chunk_ids"], "path": "extractive"}
+            try:
+                result["answer"] = fast_answer(item["embedding"], {"documents": [item["docs"]], "distances": [item["distances"]]},
+                                               get_hf_embeddings, fast_path_thresholds)
+                if result["answer"] is None:
+                    result["path"] = "llm"
+                    result["answer"] = generate_answer_with_mistral(item["question"], item["docs"])
+            except Exception as e:
+                result.update({"answer": None, "error": str(e)})
+            result["timings"] = dict(item["timings"], wait_seconds=wait, generate_seconds=time.perf_counter() - generate_start)
+            if "error" not in result:
+                record_answer(result["path"], item["timings"]["embed_seconds"] + item["timings"]["retrieve_seconds"] + result["timings"]["generate_seconds"])
+            checkpoint.write(result)
+            results.append(result)
+            elapsed = time.time() - start_time
+            print(f"[{len(results)}/{len(pending)}] {item['id']}: {result.get('error') or 'answered (' + result['path'] + ')'} in {result['timings']['generate_seconds']:.1f}s"
+                  f" (waited {wait:.2f}s for retrieval) | {len(results) * 3600 / elapsed:.0f} answers/hour")
+    except KeyboardInterrupt:
+        print("Interrupted; finished answers are saved and will be skipped when the run is resumed")
+    finally:
+        stop_event.set()
+        checkpoint.close()
+    summary = summarize_batch(results, time.time() - start_time)
+    print(json.dumps(summary, indent=2))
+    print(describe_fast_path())
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+parser = argparse.ArgumentParser(description="Answer questions about the Salesforce ASA FAQ, interactively or in batch from a file")
+parser.add_argument("--questions", default=None, help="Question file (text, one per line, or JSONL with \"question\"); answers are written to --output")
+parser.add_argument("--output", default="rag_answers.jsonl", help="JSONL file answers are appended to; questions already in it are skipped")
+parser.add_argument("--retrieval-batch", type=int, default=32, help="Questions embedded and queried together")
+parser.add_argument("--lookahead", type=int, default=64, help="Most questions retrieved ahead of generation")
+parser.add_argument("--report", default=None, help="Write the batch summary as JSON to this file")
+parser.add_argument("--profile", action="store_true", help="Trace each answer (see profiling.py)")
+args = parser.parse_args()
+
+# Metrics endpoint / exit dump when MISTRAL_METRICS_PORT / MISTRAL_METRICS_FILE are set
+start_from_env()
+
 # Load and process the document
 doc_path = "./test_data/Salesforce ASA FAQ.txt"
 doc = load_document(doc_path)
 doc["text"] = clean_text(doc["text"])
-collection = store_document_in_chroma(doc)
+collection = store_documents_in_chroma([doc])
 print(f"Loaded and processed document: {doc['id']}")
 
-# Main loop for querying
-while True:
-    question = input("Ask a question (or type 'exit' to quit): ")
-    if question.lower() in ['exit', 'quit']:
-        break
-    retrieved_docs = query_documents(question, collection)
-    answer = generate_answer_with_mistral(question, retrieved_docs)
-    print(f"Question: {question}")
-    print(f"Answer: {answer}")
\ No newline at end of file
+if args.questions:
+    run_batch(collection, args.questions, args.output, args.retrieval_batch, args.lookahead, args.report)
+else:
+    # Main loop for querying
+    while True:
+        question = input("Ask a question (or type 'exit' to quit): ")
+        if question.lower() in ['exit', 'quit']:
+            break
+        answer = answer_question(question, collection)
+        print(f"Question: {question}")
+        print(f"Answer: {answer}")
+    print(describe_fast_path())
\ No newline at end of file
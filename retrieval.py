@@ -0,0 +1,291 @@
+import argparse
+import os
+import re
+import sys
+import time
+import numpy as np
+from profiling import span
+from utils import percentile
+
+# "partitioned" (default): a router picks which source partitions to search; "global": search them all
+RETRIEVAL_MODE = os.environ.get("MISTRAL_RETRIEVAL", "partitioned")
+# The router searches at most this many partitions, and only those whose centroid similarity is within
+# ROUTE_MARGIN of the best one (partitions named in the question are always searched)
+ROUTE_MAX_PARTITIONS = int(os.environ.get("MISTRAL_ROUTE_PARTITIONS", "2"))
+ROUTE_MARGIN = 0.05
+# Words in document names that say nothing about the product
+GENERIC_NAME_TERMS = {"faq", "faqs", "doc", "docs", "txt", "the", "and", "of", "for", "guide"}
+
+
+# Function to turn a source name into a valid Chroma collection name suffix
+def partition_slug(source):
+    return re.sub(r"[^a-z0-9]+", "_", os.path.splitext(source)[0].lower()).strip("_")[:40] or "source"
+
+
+# Function to find the sources an explicit where filter pins the search to (None if it does not)
+def sources_in_filter(where):
+    if not where:
+        return None
+    value = where.get("source")
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        if "$eq" in value:
+            return [value["$eq"]]
+        if "$in" in value:
+            return list(value["$in"])
+    for clause in where.get("$and", []):
+        sources = sources_in_filter(clause)
+        if sources is not None:
+            return sources
+    return None
+
+
+# One Chroma collection per source document, with a router in front. upsert() and query() take the
+# same arguments as a Chroma collection, so callers switch from one global collection without changes
+class PartitionedIndex:
+    def __init__(self, chroma_client, name, mode=None):
+        self.chroma_client = chroma_client
+        self.name = name
+        self.mode = mode or RETRIEVAL_MODE
+        self.partitions = {}
+        self.name_terms = None
+        self.last_route = []
+
+    def partition(self, source):
+        if source not in self.partitions:
+            collection_name = f"{self.name}_{partition_slug(source)}"[:63].rstrip("_")
+            taken = {partition["collection"].name for partition in self.partitions.values()}
+            if collection_name in taken:
+                collection_name = f"{collection_name[:58]}_{len(self.partitions)}"
+            self.partitions[source] = {
+                "collection": self.chroma_client.get_or_create_collection(name=collection_name),
+                "ids": set(),
+                "sum": None
+            }
+            self.name_terms = None
+        return self.partitions[source]
+
+    # A chunk deduplicated across documents (metadata "sources", see dedup.chunk_metadata) is stored in
+    # the partition of every document it came from, with "source" set to that document, so routing and
+    # where={"source": ...} filters find it from any of them
+    def upsert(self, ids, embeddings, documents, metadatas):
+        for chunk_id, embedding, document, metadata in zip(ids, embeddings, documents, metadatas):
+            sources = [source for source in metadata.get("sources", "").split(",") if source] or [metadata["source"]]
+            for source in sources:
+                partition = self.partition(source)
+                partition["collection"].upsert(ids=[chunk_id], embeddings=[embedding], documents=[document], metadatas=[dict(metadata, source=source)])
+                if chunk_id not in partition["ids"]:
+                    partition["ids"].add(chunk_id)
+                    vector = np.asarray(embedding, dtype=np.float64)
+                    vector = vector / max(np.linalg.norm(vector), 1e-12)
+                    partition["sum"] = vector if partition["sum"] is None else partition["sum"] + vector
+
+    def count(self):
+        return len(set().union(*(partition["ids"] for partition in self.partitions.values())))
+
+    # Function to find, per partition, the words of its document name no other partition shares
+    def keyword_rules(self):
+        if self.name_terms is None:
+            terms = {source: set(re.findall(r"[a-z]+", os.path.splitext(source)[0].lower())) - GENERIC_NAME_TERMS for source in self.partitions}
+            self.name_terms = {source: {term for term in own if not any(term in other for name, other in terms.items() if name != source)}
+                               for source, own in terms.items()}
+        return self.name_terms
+
+    # Function to pick the partitions to search for one question
+    def route(self, embedding, question=None, where=None):
+        pinned = sources_in_filter(where)
+        if pinned is not None:
+            return [source for source in pinned if source in self.partitions]
+        sources = [source for source, partition in self.partitions.items() if partition["ids"]]
+        if self.mode == "global" or len(sources) <= 1:
+            return sources
+        chosen = set()
+        if question:
+            words = set(re.findall(r"[a-z]+", question.lower()))
+            chosen.update(source for source, terms in self.keyword_rules().items() if terms & words and source in sources)
+        vector = np.asarray(embedding, dtype=np.float64)
+        vector = vector / max(np.linalg.norm(vector), 1e-12)
+        scores = {}
+        for source in sources:
+            centroid = self.partitions[source]["sum"]
+            scores[source] = float(vector @ centroid) / max(np.linalg.norm(centroid), 1e-12)
+        ranked = sorted(sources, key=scores.get, reverse=True)
+        chosen.update(source for source in ranked[:ROUTE_MAX_PARTITIONS] if scores[source] >= scores[ranked[0]] - ROUTE_MARGIN)
+        return [source for source in ranked if source in chosen]
+
+    # Function to search the routed partitions for each query and merge the hits by distance.
+    # Queries routed to the same partition are sent to it in one call; a chunk stored in several
+    # searched partitions is returned once
+    def query(self, query_embeddings, n_results=5, where=None, questions=None, partitions=None):
+        with span("route"):
+            plans = [partitions if partitions is not None else self.route(embedding, questions[i] if questions else None, where)
+                     for i, embedding in enumerate(query_embeddings)]
+        self.last_route = plans
+        hits = [[] for _ in query_embeddings]
+        for source, partition in self.partitions.items():
+            members = [i for i, plan in enumerate(plans) if source in plan]
+            if not members or not partition["ids"]:
+                continue
+            with span("partition_query", source=source, queries=len(members)):
+                result = partition["collection"].query(query_embeddings=[query_embeddings[i] for i in members],
+                                                       n_results=min(n_results, len(partition["ids"])), where=where)
+            for row, i in enumerate(members):
+                hits[i].extend(zip(result["distances"][row], result["ids"][row], result["documents"][row], result["metadatas"][row]))
+        merged = []
+        for query_hits in hits:
+            seen = set()
+            unique = [hit for hit in sorted(query_hits, key=lambda hit: hit[0]) if not (hit[1] in seen or seen.add(hit[1]))]
+            merged.append(unique[:n_results])
+        return {
+            "ids": [[hit[1] for hit in query_hits] for query_hits in merged],
+            "documents": [[hit[2] for hit in query_hits] for query_hits in merged],
+            "metadatas": [[hit[3] for hit in query_hits] for query_hits in merged],
+            "distances": [[hit[0] for hit in query_hits] for query_hits in merged]
+        }
+
+
+# Function to chunk documents as the assistants do and take their "...?" sentences as test questions;
+# a question's relevant chunks are those containing it
+def benchmark_questions(paths):
+    from utils import split_text
+    chunks = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            text = re.sub(r"\s+", " ", f.read()).strip()
+        source = os.path.basename(path)
+        chunks.extend({"id": f"{source}_chunk_{i}", "text": chunk, "source": source} for i, chunk in enumerate(split_text(text)))
+    questions = []
+    for chunk in chunks:
+        for sentence in re.split(r"(?<=[.!?])\s+", chunk["text"]):
+            if sentence.endswith("?") and len(sentence) > 15 and sentence not in questions:
+                questions.append(sentence)
+    relevant = [{chunk["id"] for chunk in chunks if question in chunk["text"]} for question in questions]
+    return chunks, questions, relevant
+
+
+# Function to compare routed, partitioned retrieval with one global collection on latency and recall@k
+def benchmark(paths, model_name, k, repetitions):
+    import chromadb
+    from embeddings import load_embedder
+    embedder = load_embedder(model_name)
+    chunks, questions, relevant = benchmark_questions(paths)
+    embeddings = np.asarray(embedder.encode([chunk["text"] for chunk in chunks], convert_to_numpy=True)).tolist()
+    question_embeddings = np.asarray(embedder.encode(questions, convert_to_numpy=True)).tolist()
+    print(f"{len(paths)} documents, {len(chunks)} chunks, {len(questions)} questions, top {k}")
+
+    client = chromadb.Client()
+    single = client.get_or_create_collection(name="retrieval_benchmark_global")
+    index = PartitionedIndex(client, "retrieval_benchmark")
+    metadatas = [{"source": chunk["source"]} for chunk in chunks]
+    ids = [chunk["id"] for chunk in chunks]
+    documents = [chunk["text"] for chunk in chunks]
+    single.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+    index.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def run(search):
+        latencies = []
+        found = []
+        for _ in range(repetitions):
+            found = []
+            for question, embedding in zip(questions, question_embeddings):
+                start_time = time.perf_counter()
+                result = search(question, embedding)
+                latencies.append(time.perf_counter() - start_time)
+                found.append(result["ids"][0])
+        recall = float(np.mean([len(set(top) & ids) / min(len(ids), k) for top, ids in zip(found, relevant)]))
+        return {"p50_ms": percentile(latencies, 50) * 1000, "p95_ms": percentile(latencies, 95) * 1000, "recall": recall, "top": found}
+
+    results = {
+        "global": run(lambda question, embedding: single.query(query_embeddings=[embedding], n_results=k)),
+        "partitioned": run(lambda question, embedding: index.query([embedding], n_results=k, questions=[question]))
+    }
+    routed = [len(index.route(embedding, question)) for question, embedding in zip(questions, question_embeddings)]
+    overlap = float(np.mean([len(set(a) & set(b)) / k for a, b in zip(results["global"]["top"], results["partitioned"]["top"])]))
+    for name, result in results.items():
+        print(f"  {name:12s} p50 {result['p50_ms']:7.2f} ms  p95 {result['p95_ms']:7.2f} ms  recall@{k} {result['recall']:.4f}")
+    print(f"  router searched {np.mean(routed):.2f} of {len(index.partitions)} partitions on average; top-{k} overlap with global {overlap:.4f}")
+    return results
+
+
+# In-memory stand-in for a Chroma collection (squared L2, "source" filters only), for the self-check
+class MemoryCollection:
+    def __init__(self, name):
+        self.name = name
+        self.rows = {}
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        for chunk_id, embedding, document, metadata in zip(ids, embeddings, documents, metadatas):
+            self.rows[chunk_id] = (np.asarray(embedding, dtype=np.float64), document, metadata)
+
+    def query(self, query_embeddings, n_results, where=None):
+        allowed = sources_in_filter(where)
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for embedding in query_embeddings:
+            hits = sorted((float(((vector - np.asarray(embedding)) ** 2).sum()), chunk_id, document, metadata)
+                          for chunk_id, (vector, document, metadata) in self.rows.items()
+                          if allowed is None or metadata["source"] in allowed)[:n_results]
+            for key, column in (("distances", 0), ("ids", 1), ("documents", 2), ("metadatas", 3)):
+                result[key].append([hit[column] for hit in hits])
+        return result
+
+
+class MemoryClient:
+    def __init__(self):
+        self.collections = {}
+
+    def get_or_create_collection(self, name):
+        return self.collections.setdefault(name, MemoryCollection(name))
+
+
+# Function to check routing, merging and chunks shared between documents against the in-memory stand-in
+def self_check():
+    def unit(*values):
+        vector = np.asarray(values, dtype=np.float64)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    index = PartitionedIndex(MemoryClient(), "check", mode="partitioned")
+    index.upsert(
+        ids=["asa_0", "asa_1", "sandbox_0", "sandbox_1", "shared"],
+        embeddings=[unit(1, 0.1, 0), unit(1, 0.2, 0), unit(0, 1, 0.1), unit(0, 1, 0.2), unit(0.5, 0.5, 1)],
+        documents=["ASA agents", "ASA setup", "Sandbox refresh", "Sandbox copy", "Contact support"],
+        metadatas=[{"source": "ASA FAQ.txt"}, {"source": "ASA FAQ.txt"}, {"source": "Sandbox FAQ.txt"}, {"source": "Sandbox FAQ.txt"},
+                   {"source": "ASA FAQ.txt", "sources": "ASA FAQ.txt,Sandbox FAQ.txt", "duplicates": 1}]
+    )
+    assert len(index.partitions) == 2 and index.count() == 5, (index.partitions.keys(), index.count())
+    # The centroid router picks the partition the question is close to; a document's name word pins it
+    assert index.route(unit(1, 0.15, 0)) == ["ASA FAQ.txt"], index.route(unit(1, 0.15, 0))
+    assert "Sandbox FAQ.txt" in index.route(unit(1, 0.15, 0), "how do sandbox refreshes work")
+    # Hits are merged by distance and cut to n_results
+    result = index.query([unit(1, 0.05, 0)], n_results=2, partitions=["ASA FAQ.txt", "Sandbox FAQ.txt"])
+    assert result["ids"][0] == ["asa_0", "asa_1"], result["ids"]
+    assert result["distances"][0] == sorted(result["distances"][0])
+    # The deduplicated chunk is found from the second document too, and returned once when both are searched
+    for where, partitions in (({"source": "Sandbox FAQ.txt"}, None), (None, ["Sandbox FAQ.txt"])):
+        result = index.query([unit(0.5, 0.5, 1)], n_results=3, where=where, partitions=partitions)
+        assert result["ids"][0][0] == "shared" and result["metadatas"][0][0]["source"] == "Sandbox FAQ.txt", result
+    result = index.query([unit(0.5, 0.5, 1)], n_results=5, partitions=["ASA FAQ.txt", "Sandbox FAQ.txt"])
+    assert result["ids"][0].count("shared") == 1 and len(result["ids"][0]) == 5, result["ids"]
+    # A where filter naming an unknown document searches nothing
+    assert index.query([unit(1, 0, 0)], where={"source": "Missing.txt"})["ids"] == [[]]
+    # Global mode searches every partition
+    index.mode = "global"
+    assert index.route(unit(1, 0.15, 0)) == ["ASA FAQ.txt", "Sandbox FAQ.txt"]
+    print("Retrieval self-check passed")
+
+
+if __name__ == "__main__":
+    if "--self-check" in sys.argv:
+        self_check()
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description="Compare routed, source-partitioned retrieval with a single global collection")
+    parser.add_argument("docs", nargs="*", default=["./test_data/Salesforce ASA FAQ.txt", "./test_data/Salesforce Data Cloud Sandbox FAQ.txt"])
+    parser.add_argument("--model", default="all-mpnet-base-v2")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repetitions", type=int, default=3)
+    args = parser.parse_args()
+    paths = [path for path in args.docs if os.path.exists(path)]
+    if not paths:
+        parser.error("none of the documents exist")
+    benchmark(paths, args.model, args.k, args.repetitions)
+    sys.exit(0)
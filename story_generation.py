@@ -0,0 +1,229 @@
+import time
+
+# Sonnet structure: accepted output has 13-15 non-empty lines, ideally 14
+SONNET_LINES = 14
+SONNET_MIN_LINES = 13
+SONNET_MAX_LINES = 15
+# A "line" longer than this is prose, not verse
+MAX_SONNET_LINE_WORDS = 16
+# Total token budget is this many full attempts, as in the old regenerate loop
+MAX_SONNET_ATTEMPTS = 3
+MAX_TAIL_RESTARTS = 6
+
+# Word limits the story generator accepts
+DEFAULT_WORD_LIMIT = 150
+MIN_WORD_LIMIT = 50
+MAX_WORD_LIMIT = 500
+
+# Sampling settings used for stories and sonnets
+STORY_PARAMS = {"temperature": 0.8, "top_p": 0.9, "stop": None}
+
+SONNET_FAILURE_MESSAGE = "Mistral 7B: Sorry, I couldn't generate a proper sonnet (13-15 lines) after several attempts."
+
+# Sentiment analyzer, created on first use so headless tools that never ask for a mood skip loading it
+analyzer = None
+
+
+# Function to analyze sentiment and determine mood
+def get_sentiment_mood(text):
+    global analyzer
+    if analyzer is None:
+        from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+        analyzer = SentimentIntensityAnalyzer()
+    sentiment = analyzer.polarity_scores(text)
+    compound_score = sentiment['compound']
+    if compound_score < -0.05:
+        return "sad and comforting"
+    elif compound_score > 0.05:
+        return "joyful and uplifting"
+    return None
+
+
+# Function to build the sentiment-tuned story or sonnet prompt; returns (full_prompt, is_sonnet, max_new_tokens)
+def build_story_prompt(prompt, word_limit):
+    is_sonnet = "sonnet" in prompt.lower()
+    if is_sonnet:
+        max_new_tokens = int(word_limit * 1.2) + 30
+    else:
+        max_new_tokens = int(word_limit * 1.33) + 50
+    if is_sonnet:
+        topic = prompt.lower().replace("write me a sonnet", "").replace("sonnet", "").strip()
+        if not topic:
+            topic = prompt
+        base_prompt = f"Write a 14-line sonnet with an ABAB CDCD EFEF GG rhyme scheme, approximately {word_limit} words, describing {topic}"
+    else:
+        base_prompt = f"Write a {word_limit}-word story about {prompt}"
+    mood = get_sentiment_mood(prompt)
+    if mood:
+        full_prompt = f"Write a {mood} {base_prompt}"
+    else:
+        full_prompt = base_prompt
+    return full_prompt, is_sonnet, max_new_tokens
+
+
+# Function to count words in a text
+def count_words(text):
+    words = [word for word in text.split() if word]
+    return len(words)
+
+
+# Function to count lines in a text
+def count_lines(text):
+    return len([line for line in text.splitlines() if line.strip()])
+
+
+# Function to truncate text to a specific word count, preserving sonnet structure if applicable
+def truncate_to_word_count(text, word_limit, is_sonnet=False):
+    words = text.split()
+    if len(words) <= word_limit:
+        return text
+    if is_sonnet:
+        lines = text.splitlines()
+        current_words = 0
+        truncated_lines = []
+        for i, line in enumerate(lines):
+            line_words = len(line.split())
+            # Allow the last line to complete, even if it exceeds the limit slightly
+            if i == len(lines) - 1 and current_words < word_limit:
+                truncated_lines.append(line)
+                break
+            if current_words + line_words > word_limit:
+                remaining_words = word_limit - current_words
+                truncated_line = " ".join(line.split()[:remaining_words])
+                if truncated_line:
+                    truncated_lines.append(truncated_line + "...")
+                break
+            truncated_lines.append(line)
+            current_words += line_words
+        return "\n".join(truncated_lines)
+    else:
+        truncated = " ".join(words[:word_limit])
+        last_period = truncated.rfind(".")
+        last_exclamation = truncated.rfind("!")
+        last_question = truncated.rfind("?")
+        last_boundary = max(last_period, last_exclamation, last_question)
+        if last_boundary != -1 and last_boundary > len(truncated) // 2:
+            truncated = truncated[:last_boundary + 1]
+        else:
+            truncated += "..."
+        return truncated
+
+
+# Counts words in streamed text; truncate_to_word_count only looks at the first
+# word_limit words and whether any follow, so nothing past word_limit + 1 words is needed
+class WordLimitTracker:
+    def __init__(self, word_limit):
+        self.word_limit = word_limit
+        self.words = 0
+        self.in_word = False
+        self.pieces = []
+
+    # Returns True once the text is known to run past the word limit
+    def feed(self, piece):
+        self.pieces.append(piece)
+        for char in piece:
+            if char.isspace():
+                self.in_word = False
+            elif not self.in_word:
+                self.in_word = True
+                self.words += 1
+        return self.words > self.word_limit
+
+    def text(self):
+        return "".join(self.pieces)
+
+
+# Function to stream a story and stop as soon as the word limit is passed
+def generate_story(model, full_prompt, word_limit, max_new_tokens, cancel_event=None, **params):
+    start_time = time.time()
+    tracker = WordLimitTracker(word_limit)
+    stats = {"tokens": 0, "stopped_early": False}
+    for piece in model(full_prompt, stream=True, cancel_event=cancel_event, max_new_tokens=max_new_tokens, **params):
+        stats["tokens"] += 1
+        if tracker.feed(piece):
+            stats["stopped_early"] = True
+            break
+    stats["wall_time"] = time.time() - start_time
+    # Same sentence-boundary rules as before, applied to the same leading words
+    return truncate_to_word_count(tracker.text(), word_limit), stats
+
+
+# Follows streamed sonnet text line by line and flags when it is done or off the rails
+class SonnetTracker:
+    def __init__(self, accepted_lines=None):
+        self.lines = list(accepted_lines or [])
+        self.current = ""
+
+    def verse_count(self):
+        return len([line for line in self.lines if line.strip()])
+
+    # Returns "continue", "complete" or "diverged"
+    def feed(self, piece):
+        self.current += piece
+        while "\n" in self.current:
+            line, self.current = self.current.split("\n", 1)
+            if line.strip() and len(line.split()) > MAX_SONNET_LINE_WORDS:
+                return "diverged"
+            # Blank lines are stanza breaks and are kept as they are
+            self.lines.append(line)
+            if self.verse_count() >= SONNET_LINES:
+                return "complete"
+        if len(self.current.split()) > MAX_SONNET_LINE_WORDS:
+            return "diverged"
+        return "continue"
+
+    # Called when the model stops on its own
+    def finish(self):
+        if self.current.strip():
+            self.lines.append(self.current)
+            self.current = ""
+        return "complete" if SONNET_MIN_LINES <= self.verse_count() <= SONNET_MAX_LINES else "diverged"
+
+    def text(self):
+        return "\n".join(self.lines).strip("\n")
+
+
+# Function to stream a sonnet, stopping after line 14 and regenerating only the tail that went wrong
+def generate_sonnet(model, full_prompt, max_new_tokens, cancel_event=None, **params):
+    start_time = time.time()
+    stats = {"tokens": 0, "restarts": 0, "wall_time": 0.0}
+    budget = max_new_tokens * MAX_SONNET_ATTEMPTS
+    accepted = []
+    while stats["restarts"] <= MAX_TAIL_RESTARTS and stats["tokens"] < budget:
+        prompt = full_prompt
+        if accepted:
+            # Continue from the good lines so they are not paid for again
+            prompt = f"{full_prompt}\n\n" + "\n".join(accepted) + "\n"
+        tracker = SonnetTracker(accepted)
+        status = "continue"
+        for piece in model(prompt, stream=True, cancel_event=cancel_event, max_new_tokens=min(max_new_tokens, budget - stats["tokens"]), **params):
+            stats["tokens"] += 1
+            status = tracker.feed(piece)
+            if status != "continue":
+                break
+        if status == "continue":
+            status = tracker.finish()
+        if status == "complete":
+            stats["wall_time"] = time.time() - start_time
+            return tracker.text(), stats
+        # Keep the finished lines; the line that went wrong is never added to them
+        accepted = tracker.lines
+        stats["restarts"] += 1
+    stats["wall_time"] = time.time() - start_time
+    return None, stats
+
+
+# Function to generate a story or sonnet for a built prompt and apply the word-limit post-processing
+def write_story(model, full_prompt, word_limit, is_sonnet, max_new_tokens, cancel_event=None, **params):
+    params = {**STORY_PARAMS, **params}
+    if is_sonnet:
+        # Stops after the 14th line and only regenerates the part that went wrong
+        response, stats = generate_sonnet(model, full_prompt, max_new_tokens, cancel_event=cancel_event, **params)
+        stats["complete"] = response is not None
+        if response is None:
+            response = SONNET_FAILURE_MESSAGE
+        response = truncate_to_word_count(response, word_limit, is_sonnet=True)
+    else:
+        # Stops once the word limit is passed instead of generating tokens that get cut
+        response, stats = generate_story(model, full_prompt, word_limit, max_new_tokens, cancel_event=cancel_event, **params)
+    return response, stats
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import threading
+import pytest
+from inference_client import InferenceClient, InferenceError
+from inference_server import InferenceDaemon, RequestHandler, UnixServer
+from model_registry import ModelRegistry
+from token_budget import TokenBudget, PromptTooLong, MIN_NEW_TOKENS
+
+# Small window so prompts that do and do not fit are cheap to build
+CONTEXT_LENGTH = 64
+
+
+# Function to start an in-process daemon serving the stand-in model (one token per word, plus BOS)
+@pytest.fixture(scope="module")
+def client():
+    os.environ["MISTRAL_BACKEND"] = "stand_in"
+    # Unix socket paths are limited to about 100 characters, so stay out of pytest's deep tmp_path
+    directory = tempfile.mkdtemp(prefix="budget_", dir="/tmp")
+    model_path = os.path.join(directory, "mistral-7b-instruct-v0.2.Q4_0.gguf")
+    open(model_path, "wb").close()
+    socket_path = os.path.join(directory, "daemon.sock")
+    registry = ModelRegistry(CONTEXT_LENGTH, pinned_path=model_path)
+    daemon = InferenceDaemon(registry, CONTEXT_LENGTH, batching=False, autotune=False, idle_unload=0)
+    daemon.load()
+    server = UnixServer(socket_path, RequestHandler)
+    server.inference = daemon
+    threading.Thread(target=daemon.run_worker, daemon=True).start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield InferenceClient(socket_path=socket_path, autostart=False)
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(directory)
+    del os.environ["MISTRAL_BACKEND"]
+
+
+def words(count, word="w"):
+    return " ".join([word] * count)
+
+
+def test_count_uses_the_daemon_tokenizer(client):
+    budget = TokenBudget(client)
+    assert budget.context_length == CONTEXT_LENGTH
+    assert budget.count(words(10)) == client.count_tokens(words(10)) == 11
+
+
+def test_fit_max_new_tokens_leaves_room_for_the_prompt(client):
+    budget = TokenBudget(client)
+    prompt = words(40)
+    max_new_tokens = budget.fit_max_new_tokens(prompt, 100)
+    assert max_new_tokens == CONTEXT_LENGTH - 41
+    assert budget.fit_max_new_tokens(prompt, 5) == 5
+    # The daemon accepts what the budget allows
+    client.generate(prompt, max_new_tokens=max_new_tokens, seed=1)
+
+
+def test_fit_max_new_tokens_rejects_a_prompt_without_room(client):
+    budget = TokenBudget(client)
+    with pytest.raises(PromptTooLong):
+        budget.fit_max_new_tokens(words(CONTEXT_LENGTH - MIN_NEW_TOKENS), 100)
+
+
+def test_fit_documents_keeps_the_leading_documents_that_fit(client):
+    budget = TokenBudget(client)
+    documents = [words(10, f"d{i}") for i in range(8)]
+    build_prompt = lambda docs: " ".join(["question"] + docs)
+    kept = budget.fit_documents(build_prompt, documents, 20)
+    assert kept == documents[:4]
+    assert budget.count(build_prompt(kept)) + 20 <= CONTEXT_LENGTH
+    assert budget.count(build_prompt(documents[:5])) + 20 > CONTEXT_LENGTH
+    with pytest.raises(PromptTooLong):
+        budget.fit_documents(lambda docs: " ".join([words(50)] + docs), documents, 20)
+
+
+def test_daemon_rejects_a_prompt_that_fills_the_window(client):
+    with pytest.raises(InferenceError, match="context window is 64 tokens"):
+        client.generate(words(CONTEXT_LENGTH - 1), max_new_tokens=1)
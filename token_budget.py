@@ -0,0 +1,87 @@
+import functools
+import random
+import sys
+
+# Smallest reply worth asking the model for
+MIN_NEW_TOKENS = 16
+# Distinct strings whose token counts are remembered (templates, FAQ answers, prompts)
+COUNT_CACHE_SIZE = 4096
+
+
+class PromptTooLong(ValueError):
+    pass
+
+
+# Token accounting with the served model's real tokenizer; counts are memoized per string
+class TokenBudget:
+    def __init__(self, client=None, context_length=None, count_fn=None, cache_size=COUNT_CACHE_SIZE):
+        self.client = client
+        self._context_length = context_length
+        self._count = functools.lru_cache(maxsize=cache_size)(count_fn or client.count_tokens)
+
+    @property
+    def context_length(self):
+        if self._context_length is None:
+            self._context_length = self.client.context_length
+        return self._context_length
+
+    def count(self, text):
+        return self._count(text)
+
+    def available(self, prompt):
+        return self.context_length - self.count(prompt)
+
+    # Largest reply that still fits in the context window after the prompt
+    def fit_max_new_tokens(self, prompt, requested, min_new_tokens=MIN_NEW_TOKENS):
+        available = self.available(prompt)
+        if available < min_new_tokens:
+            raise PromptTooLong(f"Prompt uses {self.count(prompt)} of {self.context_length} tokens, leaving {max(available, 0)} for the reply")
+        return min(requested, available)
+
+    # Keeps as many leading documents as fit with room for max_new_tokens of reply
+    def fit_documents(self, build_prompt, documents, max_new_tokens):
+        low, high = 0, len(documents)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(build_prompt(documents[:middle])) + max_new_tokens <= self.context_length:
+                low = middle
+            else:
+                high = middle - 1
+        if self.count(build_prompt(documents[:low])) + max_new_tokens > self.context_length:
+            raise PromptTooLong(f"Prompt does not fit in {self.context_length} tokens even without context documents")
+        return documents[:low]
+
+    def cache_info(self):
+        return self._count.cache_info()
+
+
+# Function to check the budget helpers against a stand-in tokenizer: no request may exceed the window
+def self_check(iterations=2000):
+    rng = random.Random(0)
+    budget = TokenBudget(context_length=256, count_fn=lambda text: len(text.split()) + 1)
+    for _ in range(iterations):
+        prompt = " ".join("w" for _ in range(rng.randint(0, 300)))
+        requested = rng.randint(1, 600)
+        try:
+            max_new_tokens = budget.fit_max_new_tokens(prompt, requested)
+        except PromptTooLong:
+            assert budget.count(prompt) + MIN_NEW_TOKENS > budget.context_length
+            continue
+        assert budget.count(prompt) + max_new_tokens <= budget.context_length
+        documents = [" ".join("d" for _ in range(rng.randint(1, 80))) for _ in range(rng.randint(0, 6))]
+        try:
+            kept = budget.fit_documents(lambda docs: prompt + " " + " ".join(docs), documents, max_new_tokens)
+        except PromptTooLong:
+            continue
+        assert budget.count(prompt + " " + " ".join(kept)) + max_new_tokens <= budget.context_length
+    print(f"Token budget self-check passed ({iterations} random requests, cache {budget.cache_info()})")
+
+
+if __name__ == "__main__":
+    if "--self-check" in sys.argv:
+        self_check()
+    else:
+        from inference_client import InferenceClient
+        budget = TokenBudget(InferenceClient())
+        text = sys.stdin.read()
+        print(f"{budget.count(text)} tokens of {budget.context_length}")
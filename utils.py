@@ -0,0 +1,26 @@
+import re
+
+
+# Function to split text into chunks of whole sentences of at most max_length characters
+# (a longer sentence is a chunk of its own); the RAG tools and their benchmarks all chunk this way
+def split_text(text, max_length=100):
+    sentences = re.split(r'(?<=[.!?])\s+', text)
+    chunks = []
+    current_chunk = ""
+    for sentence in sentences:
+        if len(current_chunk) + len(sentence) <= max_length:
+            current_chunk += " " + sentence
+        else:
+            if current_chunk:
+                chunks.append(current_chunk.strip())
+            current_chunk = sentence
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    return chunks
+
+
+# Function to pick a percentile (pct from 0 to 100) from a list of numbers
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
@@ -0,0 +1,401 @@
+import argparse
+import array
+import json
+import math
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+# Audio format every engine accepts: 16 kHz, 16-bit mono PCM
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+CHUNK_FRAMES = 1024
+
+# Same listening limits as the old recognizer.listen(timeout=5, phrase_time_limit=10)
+START_TIMEOUT = 5
+PHRASE_TIME_LIMIT = 10
+# Silence that ends a phrase (speech_recognition's default pause_threshold)
+PAUSE_SECONDS = 0.8
+# Audio kept from just before speech starts so the first syllable is not clipped
+PRE_ROLL_SECONDS = 0.3
+
+# Ambient-noise calibration is measured once per device and reused for an hour
+CALIBRATION_SECONDS = 1.0
+CALIBRATION_MAX_AGE = 3600
+CALIBRATION_PATH = os.path.join(os.path.expanduser("~"), ".mistral_voice_calibration.json")
+# speech_recognition's defaults for the energy threshold
+MIN_ENERGY_THRESHOLD = 300
+ENERGY_RATIO = 1.5
+
+# Offline Vosk model directory (https://alphacephei.com/vosk/models)
+VOSK_MODEL_PATH = os.environ.get("VOSK_MODEL_PATH", "vosk-model-small-en-us-0.15")
+
+
+class VoiceInputError(Exception):
+    pass
+
+
+# Nothing above the energy threshold before START_TIMEOUT, or nothing recognized
+class NoSpeechError(VoiceInputError):
+    pass
+
+
+# The recognition engine itself failed (e.g. the online service is unreachable)
+class RecognitionServiceError(VoiceInputError):
+    pass
+
+
+# Function to measure the loudness (RMS) of a chunk of 16-bit PCM
+def chunk_energy(chunk):
+    samples = array.array("h", chunk[:len(chunk) - len(chunk) % 2])
+    if sys.byteorder == "big":
+        samples.byteswap()
+    if not samples:
+        return 0.0
+    return math.sqrt(sum(sample * sample for sample in samples) / len(samples))
+
+
+# Reads a recorded 16-bit mono WAV file in chunks, optionally at real-time pace
+class WavFileSource:
+    def __init__(self, path, chunk_frames=CHUNK_FRAMES, realtime=False):
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.realtime = realtime
+        self.wav = None
+        self.sample_rate = None
+        self.key = f"wav:{os.path.basename(path)}"
+
+    def open(self):
+        self.wav = wave.open(self.path, "rb")
+        if self.wav.getnchannels() != 1 or self.wav.getsampwidth() != SAMPLE_WIDTH:
+            self.wav.close()
+            raise VoiceInputError(f"{self.path}: expected 16-bit mono audio")
+        self.sample_rate = self.wav.getframerate()
+
+    def read(self):
+        chunk = self.wav.readframes(self.chunk_frames)
+        if self.realtime and chunk:
+            time.sleep(len(chunk) / SAMPLE_WIDTH / self.sample_rate)
+        return chunk
+
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+
+
+# Reads the microphone through speech_recognition's PyAudio wrapper
+class MicrophoneSource:
+    def __init__(self, device_index=None, sample_rate=SAMPLE_RATE, chunk_frames=CHUNK_FRAMES):
+        self.device_index = device_index
+        self.sample_rate = sample_rate
+        self.chunk_frames = chunk_frames
+        self.microphone = None
+        self.key = f"microphone:{device_index}:{sample_rate}"
+
+    def open(self):
+        import speech_recognition as sr
+        self.microphone = sr.Microphone(device_index=self.device_index, sample_rate=self.sample_rate, chunk_size=self.chunk_frames)
+        self.microphone.__enter__()
+
+    def read(self):
+        return self.microphone.stream.read(self.chunk_frames)
+
+    def close(self):
+        if self.microphone is not None:
+            self.microphone.__exit__(None, None, None)
+            self.microphone = None
+
+
+# Offline streaming engine; accept() returns the transcript so far
+class VoskRecognizer:
+    name = "vosk"
+
+    def __init__(self, model_path=VOSK_MODEL_PATH):
+        from vosk import Model, SetLogLevel
+        SetLogLevel(-1)
+        # Loading the model is the slow part, so it happens once per recognizer
+        self.model = Model(model_path)
+        self.recognizer = None
+        self.done = []
+
+    def start(self, sample_rate):
+        from vosk import KaldiRecognizer
+        self.recognizer = KaldiRecognizer(self.model, sample_rate)
+        self.done = []
+
+    def accept(self, chunk):
+        if self.recognizer.AcceptWaveform(chunk):
+            self.done.append(json.loads(self.recognizer.Result()).get("text", ""))
+            partial = ""
+        else:
+            partial = json.loads(self.recognizer.PartialResult()).get("partial", "")
+        return " ".join(text for text in self.done + [partial] if text)
+
+    def finish(self):
+        final = json.loads(self.recognizer.FinalResult()).get("text", "")
+        return " ".join(text for text in self.done + [final] if text)
+
+
+# The previous Google Web Speech path; needs a network connection and has no partial results
+class GoogleRecognizer:
+    name = "google"
+
+    def __init__(self):
+        import speech_recognition as sr
+        self.sr = sr
+        self.recognizer = sr.Recognizer()
+        self.frames = []
+        self.sample_rate = SAMPLE_RATE
+
+    def start(self, sample_rate):
+        self.frames = []
+        self.sample_rate = sample_rate
+
+    def accept(self, chunk):
+        self.frames.append(chunk)
+        return None
+
+    def finish(self):
+        audio = self.sr.AudioData(b"".join(self.frames), self.sample_rate, SAMPLE_WIDTH)
+        try:
+            return self.recognizer.recognize_google(audio)
+        except self.sr.UnknownValueError:
+            return ""
+        except self.sr.RequestError as e:
+            raise RecognitionServiceError(str(e))
+
+
+# Function to pick a recognition engine, preferring the offline one (MISTRAL_VOICE_ENGINE overrides)
+def load_recognizer(engine=None, model_path=VOSK_MODEL_PATH):
+    engine = engine or os.environ.get("MISTRAL_VOICE_ENGINE")
+    if engine in (None, "vosk"):
+        try:
+            import vosk
+        except ImportError:
+            if engine == "vosk":
+                raise
+        else:
+            if os.path.isdir(model_path):
+                return VoskRecognizer(model_path)
+            if engine == "vosk":
+                raise VoiceInputError(f"Vosk model not found at {model_path} (set VOSK_MODEL_PATH)")
+    return GoogleRecognizer()
+
+
+# Energy thresholds per audio source, kept on disk so calibration is not repeated on every press
+class CalibrationCache:
+    def __init__(self, path=CALIBRATION_PATH, max_age=CALIBRATION_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as file:
+                    self.entries = json.load(file)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry["time"] > self.max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["threshold"]
+
+    def put(self, key, threshold):
+        self.entries[key] = {"threshold": threshold, "time": time.time()}
+        if self.path:
+            with open(self.path, "w") as file:
+                json.dump(self.entries, file)
+
+
+# Function to measure ambient noise and derive the energy threshold for speech
+def calibrate(source, seconds=CALIBRATION_SECONDS):
+    energies = []
+    heard = 0.0
+    while heard < seconds:
+        chunk = source.read()
+        if not chunk:
+            break
+        energies.append(chunk_energy(chunk))
+        heard += len(chunk) / SAMPLE_WIDTH / source.sample_rate
+    ambient = sum(energies) / len(energies) if energies else 0.0
+    return max(MIN_ENERGY_THRESHOLD, ambient * ENERGY_RATIO)
+
+
+# Function to capture one phrase and recognize it, reporting partial transcripts as audio arrives
+def transcribe(source, recognizer, cache=None, on_partial=None, stop_event=None,
+               start_timeout=START_TIMEOUT, phrase_time_limit=PHRASE_TIME_LIMIT, pause_seconds=PAUSE_SECONDS):
+    source.open()
+    try:
+        threshold = cache.get(source.key) if cache is not None else None
+        if threshold is None:
+            threshold = calibrate(source)
+            if cache is not None:
+                cache.put(source.key, threshold)
+        recognizer.start(source.sample_rate)
+        pre_roll = []
+        waited = 0.0
+        spoken = 0.0
+        silence = 0.0
+        started = False
+        last_partial = None
+        while stop_event is None or not stop_event.is_set():
+            chunk = source.read()
+            if not chunk:
+                break
+            seconds = len(chunk) / SAMPLE_WIDTH / source.sample_rate
+            loud = chunk_energy(chunk) >= threshold
+            if not started:
+                if not loud:
+                    waited += seconds
+                    pre_roll = (pre_roll + [chunk])[-max(int(PRE_ROLL_SECONDS / seconds), 1):]
+                    if waited >= start_timeout:
+                        raise NoSpeechError("No speech detected")
+                    continue
+                started = True
+                for earlier in pre_roll:
+                    recognizer.accept(earlier)
+            partial = recognizer.accept(chunk)
+            if partial and partial != last_partial and on_partial is not None:
+                on_partial(partial)
+                last_partial = partial
+            spoken += seconds
+            silence = 0.0 if loud else silence + seconds
+            if silence >= pause_seconds or spoken >= phrase_time_limit:
+                break
+        if not started:
+            raise NoSpeechError("No speech detected")
+        text = recognizer.finish()
+        if not text:
+            raise NoSpeechError("Speech was not recognized")
+        return text
+    finally:
+        source.close()
+
+
+# Runs capture and recognition on a worker thread; the UI polls events instead of blocking
+class VoicePipeline:
+    def __init__(self, recognizer_factory=load_recognizer, source_factory=MicrophoneSource, cache=None):
+        self.recognizer_factory = recognizer_factory
+        self.source_factory = source_factory
+        self.cache = cache
+        self.recognizer = None
+        self.events = queue.Queue()
+        self.stop_event = None
+        self.worker = None
+
+    def running(self):
+        return self.worker is not None and self.worker.is_alive()
+
+    # Events: ("partial", text), ("final", text), ("error", exception), then ("done", None)
+    def start(self):
+        if self.running():
+            return False
+        self.stop_event = threading.Event()
+        self.worker = threading.Thread(target=self.run, args=(self.stop_event,), daemon=True)
+        self.worker.start()
+        return True
+
+    def stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+
+    def run(self, stop_event):
+        try:
+            if self.recognizer is None:
+                self.recognizer = self.recognizer_factory()
+            text = transcribe(self.source_factory(), self.recognizer, self.cache,
+                              on_partial=lambda partial: self.events.put(("partial", partial)), stop_event=stop_event)
+            self.events.put(("final", text))
+        except Exception as e:
+            self.events.put(("error", e))
+        finally:
+            self.events.put(("done", None))
+
+
+# Function to write a 16 kHz mono WAV file from a list of samples
+def write_wav(path, samples, sample_rate=SAMPLE_RATE):
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(SAMPLE_WIDTH)
+        wav.setframerate(sample_rate)
+        data = array.array("h", samples)
+        if sys.byteorder == "big":
+            data.byteswap()
+        wav.writeframes(data.tobytes())
+
+
+# Function to check endpointing, partials and the calibration cache on a synthetic recording
+def self_check():
+    import random
+    rng = random.Random(0)
+
+    # Stand-in engine: "hears" one word per 0.25 s of loud audio
+    class CountingRecognizer:
+        def start(self, sample_rate):
+            self.sample_rate = sample_rate
+            self.loud = 0.0
+
+        def accept(self, chunk):
+            if chunk_energy(chunk) >= MIN_ENERGY_THRESHOLD:
+                self.loud += len(chunk) / SAMPLE_WIDTH / self.sample_rate
+            return " ".join("word" for _ in range(int(self.loud / 0.25)))
+
+        def finish(self):
+            return " ".join("word" for _ in range(int(self.loud / 0.25)))
+
+    noise = lambda seconds: [rng.randint(-60, 60) for _ in range(int(seconds * SAMPLE_RATE))]
+    tone = lambda seconds: [int(4000 * math.sin(2 * math.pi * 220 * i / SAMPLE_RATE)) for i in range(int(seconds * SAMPLE_RATE))]
+    with tempfile.TemporaryDirectory() as tmp:
+        phrase = os.path.join(tmp, "phrase.wav")
+        write_wav(phrase, noise(1.2) + tone(1.5) + noise(2.0) + tone(1.0))
+        silent = os.path.join(tmp, "silent.wav")
+        write_wav(silent, noise(7.0))
+        cache = CalibrationCache(os.path.join(tmp, "calibration.json"))
+        for attempt in range(2):
+            partials = []
+            text = transcribe(WavFileSource(phrase), CountingRecognizer(), cache, on_partial=partials.append)
+            # The second tone comes after a pause longer than PAUSE_SECONDS, so it is not heard
+            assert text.split() == ["word"] * 6, text
+            assert len(partials) >= 5 and partials[-1] == text, partials
+        assert cache.misses == 1 and cache.hits == 1, (cache.misses, cache.hits)
+        try:
+            transcribe(WavFileSource(silent), CountingRecognizer(), cache)
+            raise AssertionError("silence was transcribed")
+        except NoSpeechError:
+            pass
+        pipeline = VoicePipeline(recognizer_factory=CountingRecognizer, source_factory=lambda: WavFileSource(phrase, realtime=True), cache=cache)
+        start_time = time.time()
+        pipeline.start()
+        events = []
+        while not events or events[-1][0] != "done":
+            events.append(pipeline.events.get())
+        assert [kind for kind, _ in events if kind != "partial"] == ["final", "done"], events
+    print(f"Voice input self-check passed (pipeline returned in {time.time() - start_time:.2f}s of real-time audio)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transcribe a WAV recording or the microphone with the voice input pipeline")
+    parser.add_argument("--wav", help="16-bit mono WAV file to use instead of the microphone")
+    parser.add_argument("--engine", choices=["vosk", "google"], default=None)
+    parser.add_argument("--realtime", action="store_true", help="Feed the WAV file at real-time pace")
+    parser.add_argument("--self-check", action="store_true")
+    args = parser.parse_args()
+    if args.self_check:
+        self_check()
+        sys.exit(0)
+    source = WavFileSource(args.wav, realtime=args.realtime) if args.wav else MicrophoneSource()
+    recognizer = load_recognizer(args.engine)
+    print(f"Engine: {recognizer.name}")
+    start_time = time.time()
+    text = transcribe(source, recognizer, CalibrationCache(), on_partial=lambda partial: print(f"  partial ({time.time() - start_time:5.2f}s): {partial}"))
+    print(f"Final ({time.time() - start_time:.2f}s): {text}")